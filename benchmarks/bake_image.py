@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Bakes an image for a job against a FakeS3 and FakeEC2 (the builder "boots" by running the node agent's bake mode
+# in a temporary directory), then runs a node with and without the baked install to show the download and install
+# phases it saves.  Also checks that a second job with the same install section reuses the image and that
+# changing the install commands doesn't.
+
+import argparse
+import json
+import logging
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "wiglaf", "node"))
+
+import agent
+import wiglaf.bake
+import work_queue
+from fakes import FakeAutoScaling, FakeEC2, FakeS3
+
+BUCKET = "bench"
+
+def no_metadata(path):
+    # As on an on-demand instance with nothing to report: no interruption notice or rebalance recommendation.
+    raise LookupError(path)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches",
+                        help='Number of batches in the job.',
+                        type=int,
+                        default=8)
+    parser.add_argument("--resources",
+                        help='Number of resource files.',
+                        type=int,
+                        default=50)
+    parser.add_argument("--install",
+                        help='Seconds the install commands take.',
+                        type=float,
+                        default=1.0)
+    parser.add_argument("--latency",
+                        help='Simulated per-request S3 latency in seconds.',
+                        type=float,
+                        default=0.02)
+    return parser.parse_args()
+
+def run_node(s3, manifest, workdir, baked_file):
+    s3.objects[agent.CURRENT_MANIFEST_KEY] = json.dumps(manifest).encode("utf-8")
+    os.makedirs(workdir)
+    node = agent.Agent(BUCKET, "unused", instance_id="i-00000000", s3=s3, ec2=FakeEC2(), queue=work_queue.LocalWorkQueue(),
+                       work_directory=os.path.join(workdir, "work"), slot_directory=os.path.join(workdir, "slots"),
+                       cache_directory=os.path.join(workdir, "cache"), log_directory=workdir, metadata=no_metadata, baked_file=baked_file)
+    start = time.perf_counter()
+    node.run()
+    total = time.perf_counter() - start
+    with open(os.path.join(workdir, agent.METRICS_LOG)) as f:
+        entries = [json.loads(line) for line in f]
+    setup = sum(e["wall"] for e in entries if e["event"] == "end" and e["phase"] in ("DownloadingFiles", "InstallCommands"))
+    return total, setup
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARN)
+    s3 = FakeS3(latency=args.latency, bandwidth=100 * 1024 * 1024)
+    resources = {}
+    for i in range(args.resources):
+        digest = "{:064x}".format(i)
+        s3.objects["cas/{}".format(digest)] = os.urandom(64 * 1024)
+        resources["input.{}.dat".format(i)] = digest
+    manifest = {
+        "JobName":"bench",
+        "NumberOfBatches":args.batches,
+        "ConcurrencyPerNode":4,
+        "Resources":resources,
+        "InstallCommands":["sleep {} && touch installed".format(args.install)],
+        # Fails unless the work directory has both the resources and what the install made.
+        "CommandsToRun":["test -f installed && test -f input.0.dat && echo ok > out.dat"],
+        "FilesToUpload":["out.dat"],
+        "CommandTimeoutSeconds":60,
+        "LeaseSeconds":3
+    }
+    workdir = tempfile.mkdtemp()
+    baked_file = os.path.join(workdir, "baked.json")
+
+    def boot(instance):
+        # Stands in for the builder's UserData, which runs the agent with --bake.
+        command = shlex.split(next(line for line in instance["UserData"].splitlines() if "--bake" in line))
+        builder = agent.Agent(BUCKET, None, instance_id=instance["InstanceId"], s3=s3, ec2=ec2, queue=work_queue.LocalWorkQueue(),
+                              work_directory=os.path.join(workdir, "baked-work"), cache_directory=os.path.join(workdir, "baked-cache"),
+                              log_directory=workdir, metadata=no_metadata, baked_file=baked_file)
+        builder.bake(command[command.index("--bake") + 1])
+
+    ec2 = FakeEC2(boot=boot)
+    try:
+        settings = wiglaf.bake.launch_settings("wiglaf-asg", FakeAutoScaling(), ec2)
+        start = time.perf_counter()
+        record = wiglaf.bake.bake(BUCKET, manifest, settings["ImageId"], settings, s3=s3, ec2=ec2, poll_seconds=0)
+        print("baked {} in {:.2f}s with {} EC2 calls".format(record["ImageId"], time.perf_counter() - start, ec2.call_count))
+
+        digest = wiglaf.bake.install_hash(manifest, settings["ImageId"])
+        changed = wiglaf.bake.install_hash(dict(manifest, InstallCommands=["true"]), settings["ImageId"])
+        print("same install section reuses it: {}".format(wiglaf.bake.find_image(BUCKET, digest, s3=s3) == record))
+        print("changed install commands reuse it: {}".format(wiglaf.bake.find_image(BUCKET, changed, s3=s3) is not None))
+
+        for name, job, node_baked_file in [("unbaked", dict(manifest), os.path.join(workdir, "missing.json")),
+                                           ("baked", dict(manifest, InstallHash=digest), baked_file)]:
+            for key in [k for k in s3.objects if k.startswith("jobs/bench/results/")]:
+                del s3.objects[key]
+            total, setup = run_node(s3, job, os.path.join(workdir, name), node_baked_file)
+            results = len([k for k in s3.objects if k.startswith("jobs/bench/results/")])
+            print("{:<8} node: wall clock {:.2f}s, download and install {:.2f}s, {} results".format(name, total, setup, results))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Compares node startup (resource download) time for per-file `aws s3 cp` against a single resource bundle.
+#
+# Per-file cost is modelled as one CLI process start (measured here with a bare interpreter start, which is a
+# lower bound for the aws CLI) plus one simulated S3 round trip per file.  Bundle cost is measured directly:
+# building the bundle at submit time, one simulated download, and extraction on the node.
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import wiglaf.bundle
+import wiglaf.cas
+from fakes import FakeS3
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts",
+                        help='Numbers of input files to compare.',
+                        type=int,
+                        nargs="+",
+                        default=[1, 100, 10000])
+    parser.add_argument("--size",
+                        help='Size of each input file in bytes.',
+                        type=int,
+                        default=4096)
+    parser.add_argument("--latency",
+                        help='Simulated per-request S3 latency in seconds.',
+                        type=float,
+                        default=0.02)
+    parser.add_argument("--bandwidth",
+                        help='Simulated per-connection bandwidth in bytes/s.',
+                        type=float,
+                        default=100 * 1024 * 1024)
+    return parser.parse_args()
+
+def process_start_time(samples=10):
+    start = time.perf_counter()
+    for _ in range(samples):
+        subprocess.check_call([sys.executable, "-c", "pass"])
+    return (time.perf_counter() - start) / samples
+
+def main():
+    args = parse_args()
+    spawn = process_start_time()
+    print("Measured process start: {:.1f}ms".format(spawn * 1000))
+    print("{:>7} {:>12} {:>12} {:>12} {:>12}".format("files", "per-file", "bundle", "(build)", "speedup"))
+    for count in args.counts:
+        workdir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(workdir, "source")
+            os.makedirs(source)
+            filenames = ["input.{:05d}.dat".format(i) for i in range(count)]
+            for filename in filenames:
+                with open(os.path.join(source, filename), "wb") as f:
+                    f.write(os.urandom(args.size // 2) + bytes(args.size - args.size // 2))
+            s3 = FakeS3(latency=args.latency, bandwidth=args.bandwidth)
+
+            per_file = count * (spawn + args.latency + float(args.size) / args.bandwidth)
+
+            start = time.perf_counter()
+            path = os.path.join(workdir, "bundle.zip")
+            digest = wiglaf.bundle.create_bundle(source, filenames, path)
+            with open(path, "rb") as f:
+                s3.put_object(Bucket="bench", Key=wiglaf.cas.key(digest), Body=f)
+            build = time.perf_counter() - start
+
+            start = time.perf_counter()
+            fetched = os.path.join(workdir, "fetched.zip")
+            with open(fetched, "wb") as f:
+                f.write(s3.get_object(Bucket="bench", Key=wiglaf.cas.key(digest))["Body"].read())
+            wiglaf.bundle.extract_bundle(fetched, os.path.join(workdir, "node"))
+            bundle = spawn + time.perf_counter() - start
+
+            print("{:>7} {:>11.2f}s {:>11.2f}s {:>11.2f}s {:>11.1f}x".format(count, per_file, bundle, build, per_file / bundle))
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Times how long the wiglaf CLI takes to start: importing wiglaf.cli, and running subcommands until their first
+# output and until they exit.  Subcommands that don't talk to AWS shouldn't import boto3 (see wiglaf/dispatch.py),
+# so they have a time budget and the script exits non-zero if one goes over it, or if importing wiglaf.cli pulls
+# in boto3.  The ones that do talk to AWS are run with a profile that doesn't exist, so they fail as soon as
+# they've set up a session; they're reported for comparison but have no budget.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SCRIPT = os.path.join(ROOT, "scripts", "wiglaf")
+LOCAL = ["--profile", "wiglaf-startup-benchmark", "--cluster-name", "bench"]
+
+# (name, arguments, whether it has a budget)
+COMMANDS = [
+    ("help", ["--help"], True),
+    ("generate-manifest", ["--generate-manifest"] + LOCAL, True),
+    ("missing-args", ["--describe-cluster"], True),
+    ("describe-cluster", ["--describe-cluster"] + LOCAL, False),
+    ("describe-job", ["--describe-job", "--job-name", "bench"] + LOCAL, False),
+]
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs",
+                        help='Times to run each command.  Medians are reported.',
+                        type=int,
+                        default=5)
+    parser.add_argument("--budget",
+                        help='Most seconds a local subcommand may take to produce its first output.',
+                        type=float,
+                        default=0.25)
+    return parser.parse_args()
+
+def environment():
+    env = dict(os.environ, PYTHONPATH=os.path.join(ROOT, "src") + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    # Keep real credentials and config out of it, so the AWS commands fail the same way everywhere.
+    env.update({"AWS_CONFIG_FILE":os.devnull, "AWS_SHARED_CREDENTIALS_FILE":os.devnull})
+    return env
+
+def time_command(command, env):
+    """
+    Returns (seconds until the first byte of output, seconds until it exited).
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    process.stdout.read(1)
+    first = time.perf_counter() - start
+    process.stdout.read()
+    process.wait()
+    return first, time.perf_counter() - start
+
+def import_time(env):
+    """
+    Returns (seconds to import wiglaf.cli, whether that imported boto3), from a fresh interpreter.
+    """
+    code = "import sys, time; t = time.perf_counter(); import wiglaf.cli; print(time.perf_counter() - t, 'boto3' in sys.modules)"
+    seconds, boto3 = subprocess.check_output([sys.executable, "-c", code], env=env).decode("utf-8").split()
+    return float(seconds), boto3 == "True"
+
+def main():
+    args = parse_args()
+    env = environment()
+    failures = []
+    imports = [import_time(env) for _ in range(args.runs)]
+    seconds = statistics.median(i[0] for i in imports)
+    print("import wiglaf.cli: {:.3f}s{}".format(seconds, ", imports boto3" if any(i[1] for i in imports) else ""))
+    if any(i[1] for i in imports):
+        failures.append("import wiglaf.cli imports boto3")
+    # What any Python script costs, for comparison.
+    baseline = statistics.median(time_command([sys.executable, "-c", "print()"], env)[0] for _ in range(args.runs))
+    print("python startup: {:.3f}s".format(baseline))
+    print("{:<20} {:>12} {:>12} {:>10}".format("command", "first output", "exit", "budget"))
+    for name, arguments, budgeted in COMMANDS:
+        timings = [time_command([sys.executable, SCRIPT] + arguments, env) for _ in range(args.runs)]
+        first = statistics.median(t[0] for t in timings)
+        total = statistics.median(t[1] for t in timings)
+        over = budgeted and first > args.budget
+        print("{:<20} {:>11.3f}s {:>11.3f}s {:>10}".format(name, first, total, ("{:.2f}s".format(args.budget) if budgeted else "-") + (" OVER" if over else "")))
+        if over:
+            failures.append("{} took {:.3f}s to start".format(name, first))
+    if failures:
+        print("Over budget: " + "; ".join(failures))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+# Replays a job's batch durations through a simulated cluster to compare running MaxSize nodes until the job is
+# done with the Lambda's adaptive sizing (lambda/sizing.py): how long the job takes, and how many node-hours it
+# costs.  Batch durations come from a recorded timeline (a JSON list of entries as wiglaf.report.build_timeline
+# or wiglaf.metrics.timeline return them, which --save-timeline writes for a job in S3), or are made up.
+
+import argparse
+import heapq
+import json
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import sizing
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--timeline",
+                        help='JSON file with a recorded job timeline to replay.')
+    parser.add_argument("--cluster-name",
+                        help='Read the timeline of --job from this cluster instead (needs AWS credentials).')
+    parser.add_argument("--job",
+                        help='The job to read with --cluster-name.')
+    parser.add_argument("--save-timeline",
+                        help='Write the timeline read with --cluster-name to this file, to replay offline later.')
+    parser.add_argument("--batches",
+                        help='Without a timeline, the number of made-up batches.',
+                        type=int,
+                        default=1000)
+    parser.add_argument("--mean",
+                        help='Without a timeline, the mean batch time in seconds.',
+                        type=float,
+                        default=600)
+    parser.add_argument("--spread",
+                        help='Without a timeline, the standard deviation of log batch time.',
+                        type=float,
+                        default=0.5)
+    parser.add_argument("--slots",
+                        help='Batches per node.  Defaults to the most any node ran at once in the timeline, or 4.',
+                        type=int,
+                        default=None)
+    parser.add_argument("--max-size",
+                        help='MaxSize of the cluster.',
+                        type=int,
+                        default=50)
+    parser.add_argument("--startup",
+                        help='Seconds from launching a node to it starting its first batch.',
+                        type=float,
+                        default=sizing.DEFAULT_STARTUP_SECONDS)
+    parser.add_argument("--interval",
+                        help='Seconds between the adaptive controller\'s resizes.',
+                        type=float,
+                        default=60)
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0)
+    return parser.parse_args()
+
+def load_timeline(args):
+    if args.timeline:
+        with open(args.timeline) as f:
+            return json.load(f)
+    if args.cluster_name:
+        import wiglaf.cloudformation
+        import wiglaf.metrics
+        import wiglaf.report
+        bucket = wiglaf.cloudformation.stack_outputs(args.cluster_name)["DataBucket"]
+        records = wiglaf.metrics.read_metrics(bucket, args.job)
+        timeline = wiglaf.metrics.timeline(records) if records else wiglaf.report.build_timeline(wiglaf.report.iter_checkpoints(bucket, args.job))
+        if args.save_timeline:
+            with open(args.save_timeline, "w") as f:
+                json.dump(timeline, f, indent=2, sort_keys=True)
+        return timeline
+    return None
+
+def observed_slots(batches):
+    # The most batches any one instance had running at once.
+    most = 1
+    by_instance = {}
+    for e in batches:
+        by_instance.setdefault(e["instance"], []).append(e)
+    for entries in by_instance.values():
+        events = sorted([(e["start"], 1) for e in entries] + [(e["end"], -1) for e in entries])
+        running = 0
+        for _, change in events:
+            running += change
+            most = max(most, running)
+    return most
+
+def simulate(durations, slots, max_size, startup, adaptive, interval):
+    """
+    Runs the batches (in order, as slots come free) on a simulated cluster.  Nodes take startup seconds to start
+    working.  With adaptive, the desired capacity comes from sizing.desired_capacity every interval seconds, and
+    scaling in only ever removes idle nodes, as scale-in protection would; otherwise it's MaxSize throughout.
+    Returns (seconds until the last batch finished, node-seconds, busy slot-seconds).
+    """
+    pending = list(durations)
+    pending.reverse()
+    nodes = []
+    finished = []
+    running = []
+    now = 0.0
+
+    def live():
+        return [n for n in nodes if n["stopped"] is None]
+
+    def resize():
+        current = live()
+        busy = [n for n in current if n["running"]]
+        remaining = len(pending) + len(running)
+        if adaptive:
+            batch_seconds = sorted(finished)[len(finished) // 2] if finished else None
+            desired = sizing.desired_capacity(remaining, slots, max_size, batch_seconds, len(current), len(busy), startup)
+        else:
+            desired = max_size
+        for _ in range(desired - len(current)):
+            nodes.append({"launched":now, "ready":now + startup, "running":0, "stopped":None})
+        idle = [n for n in reversed(current) if not n["running"]]
+        for node in idle[:max(0, len(current) - desired)]:
+            node["stopped"] = now
+
+    resize()
+    next_resize = interval if adaptive else math.inf
+    while pending or running:
+        for node in live():
+            while node["ready"] <= now and node["running"] < slots and pending:
+                duration = pending.pop()
+                node["running"] += 1
+                heapq.heappush(running, (now + duration, id(node), duration, node))
+        upcoming = [running[0][0] if running else math.inf, next_resize] + [n["ready"] for n in live() if n["ready"] > now]
+        now = min(upcoming)
+        while running and running[0][0] <= now:
+            _, _, duration, node = heapq.heappop(running)
+            node["running"] -= 1
+            finished.append(duration)
+        if now >= next_resize:
+            resize()
+            next_resize = now + interval
+    node_seconds = sum((n["stopped"] if n["stopped"] is not None else now) - n["launched"] for n in nodes)
+    return now, node_seconds, sum(durations)
+
+def main():
+    args = parse_args()
+    timeline = load_timeline(args)
+    slots = args.slots
+    if timeline is not None:
+        batches = sorted([e for e in timeline if e["kind"] == "CommandsToRun" and e["seconds"] is not None], key=lambda e: e["start"])
+        durations = [e["seconds"] for e in batches]
+        slots = slots or observed_slots(batches)
+        print("Replaying {} batches from the timeline, {} per node.".format(len(durations), slots))
+    else:
+        rng = random.Random(args.seed)
+        sigma = args.spread
+        durations = [rng.lognormvariate(math.log(args.mean) - sigma * sigma / 2, sigma) for _ in range(args.batches)]
+        slots = slots or 4
+        print("Simulating {} batches (mean {:.0f}s), {} per node.".format(len(durations), args.mean, slots))
+    print("{:<10} {:>12} {:>12} {:>12}".format("sizing", "makespan", "node-hours", "utilization"))
+    for name, adaptive in [("static", False), ("adaptive", True)]:
+        makespan, node_seconds, busy_seconds = simulate(durations, slots, args.max_size, args.startup, adaptive, args.interval)
+        print("{:<10} {:>11.2f}h {:>12.1f} {:>11.0f}%".format(name, makespan / 3600, node_seconds / 3600, 100 * busy_seconds / (node_seconds * slots)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# Compares download_files throughput at different concurrency levels against a FakeS3 with per-request latency.
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import wiglaf.s3
+from fakes import FakeS3
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files",
+                        help='Number of result files in the job.',
+                        type=int,
+                        default=500)
+    parser.add_argument("--size",
+                        help='Size of each result file in bytes.',
+                        type=int,
+                        default=256 * 1024)
+    parser.add_argument("--latency",
+                        help='Simulated per-request latency in seconds.',
+                        type=float,
+                        default=0.02)
+    parser.add_argument("--concurrency",
+                        help='Concurrency levels to compare.',
+                        type=int,
+                        nargs="+",
+                        default=[1, 4, 16, 64])
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARN)
+    s3 = FakeS3(latency=args.latency, bandwidth=50 * 1024 * 1024)
+    prefix = "jobs/bench/results"
+    for i in range(args.files):
+        s3.objects["{}/out.csv.{}.i-{:08x}".format(prefix, i % 10, i // 10)] = os.urandom(args.size)
+    directory = tempfile.mkdtemp()
+    try:
+        for concurrency in args.concurrency:
+            shutil.rmtree(directory)
+            os.makedirs(directory)
+            stats = wiglaf.s3.download_files("bench", prefix, directory, concurrency=concurrency, s3=s3)
+            print("concurrency={:<4} {:6.2f}s  {:7.1f} MB/s  {} files".format(concurrency, stats["seconds"], stats["bytes_per_second"] / 1e6, stats["files"]))
+        stats = wiglaf.s3.download_files("bench", prefix, directory, concurrency=args.concurrency[-1], s3=s3)
+        print("re-run (all unchanged)  {:6.2f}s  {} skipped".format(stats["seconds"], stats["skipped"]))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
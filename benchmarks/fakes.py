@@ -0,0 +1,1030 @@
+#!/usr/bin/env python3
+
+# In-process stand-ins for the AWS clients wiglaf uses, so benchmarks can run without an account.
+# Only the calls and response fields wiglaf actually touches are implemented.
+
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from botocore.exceptions import ClientError
+from datetime import datetime, timezone
+
+class FakeExceptions(object):
+    # What wiglaf catches from client.exceptions.
+    ClientError = ClientError
+
+    class ConditionalCheckFailedException(ClientError):
+        def __init__(self, operation):
+            super(FakeExceptions.ConditionalCheckFailedException, self).__init__(
+                {"Error":{"Code":"ConditionalCheckFailedException", "Message":"The conditional request failed"}}, operation)
+
+    class TransactionCanceledException(ClientError):
+        def __init__(self, operation, reasons):
+            super(FakeExceptions.TransactionCanceledException, self).__init__(
+                {"Error":{"Code":"TransactionCanceledException", "Message":"Transaction cancelled"}, "CancellationReasons":reasons}, operation)
+
+    class TransactionConflictException(ClientError):
+        def __init__(self, operation):
+            super(FakeExceptions.TransactionConflictException, self).__init__(
+                {"Error":{"Code":"TransactionConflictException", "Message":"Transaction is ongoing for the item"}}, operation)
+
+class FakeBody(io.BytesIO):
+    def iter_chunks(self, chunk_size=1024):
+        for chunk in iter(lambda: self.read(chunk_size), b""):
+            yield chunk
+
+class FakeS3(object):
+    """
+    Keeps objects in a dict.  latency is added to every call and bandwidth (bytes/s) throttles bodies,
+    to roughly mimic the cost of a round trip to S3 from a single connection.  on_put, if given, is called with
+    the bucket and key of every object written, like the bucket's event notifications.  Objects are last
+    modified when they're written, by clock.
+    """
+    exceptions = FakeExceptions
+
+    def __init__(self, latency=0, bandwidth=None, on_put=None, clock=time.time):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.on_put = on_put
+        self.clock = clock
+        self.objects = {}
+        self.metadata = {}
+        self.etags = {}
+        self.modified = {}
+        self.uploads = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def _call(self, operation, size=0):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        delay = self.latency + (float(size) / self.bandwidth if self.bandwidth else 0)
+        if delay:
+            time.sleep(delay)
+
+    @property
+    def call_count(self):
+        return sum(self.calls.values())
+
+    def _metadata(self, key):
+        body = self.objects[key]
+        etag = self.etags.get(key) or hashlib.md5(body).hexdigest()
+        modified = datetime.fromtimestamp(self.modified.get(key, self.clock()), timezone.utc)
+        return {"Key":key, "Size":len(body), "ETag":'"{}"'.format(etag), "LastModified":modified}
+
+    def _not_found(self, operation):
+        return ClientError({"Error":{"Code":"404", "Message":"Not Found"}}, operation)
+
+    def put_object(self, Bucket, Key, Body=b"", Metadata=None, **kwargs):
+        body = Body.read() if hasattr(Body, "read") else Body
+        self._call("PutObject", len(body))
+        with self.lock:
+            self.objects[Key] = body
+            self.metadata[Key] = Metadata or {}
+            self.etags.pop(Key, None)
+            self.modified[Key] = self.clock()
+        if self.on_put:
+            self.on_put(Bucket, Key)
+        return {"ETag":self._metadata(Key)["ETag"]}
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None, **kwargs):
+        self._call("CreateMultipartUpload")
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = {"Key":Key, "Metadata":Metadata or {}, "Parts":{}}
+        return {"UploadId":upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        body = Body.read() if hasattr(Body, "read") else Body
+        self._call("UploadPart", len(body))
+        with self.lock:
+            self.uploads[UploadId]["Parts"][PartNumber] = body
+        return {"ETag":'"{}"'.format(hashlib.md5(body).hexdigest())}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._call("CompleteMultipartUpload")
+        with self.lock:
+            upload = self.uploads.pop(UploadId)
+            parts = [upload["Parts"][part["PartNumber"]] for part in MultipartUpload["Parts"]]
+            self.objects[Key] = b"".join(parts)
+            self.metadata[Key] = upload["Metadata"]
+            digests = b"".join(hashlib.md5(part).digest() for part in parts)
+            self.etags[Key] = "{}-{}".format(hashlib.md5(digests).hexdigest(), len(parts))
+            self.modified[Key] = self.clock()
+        if self.on_put:
+            self.on_put(Bucket, Key)
+        return {"ETag":self._metadata(Key)["ETag"]}
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective="COPY", Metadata=None, **kwargs):
+        self._call("CopyObject")
+        with self.lock:
+            if CopySource["Key"] not in self.objects:
+                raise ClientError({"Error":{"Code":"NoSuchKey", "Message":"The specified key does not exist."}}, "CopyObject")
+            if CopySource["Key"] == Key and MetadataDirective != "REPLACE":
+                raise ClientError({"Error":{"Code":"InvalidRequest", "Message":"This copy request is illegal"}}, "CopyObject")
+            self.objects[Key] = self.objects[CopySource["Key"]]
+            self.metadata[Key] = (Metadata or {}) if MetadataDirective == "REPLACE" else dict(self.metadata.get(CopySource["Key"], {}))
+            self.etags.pop(Key, None)
+            self.modified[Key] = self.clock()
+        if self.on_put:
+            self.on_put(Bucket, Key)
+        return {"CopyObjectResult":{"ETag":self._metadata(Key)["ETag"], "LastModified":self._metadata(Key)["LastModified"]}}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._call("AbortMultipartUpload")
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if Key not in self.objects:
+            raise self._not_found("GetObject")
+        body = self.objects[Key]
+        if kwargs.get("Range"):
+            start, end = kwargs["Range"][len("bytes="):].split("-")
+            body = body[int(start):int(end) + 1]
+        self._call("GetObject", len(body))
+        response = self._metadata(Key)
+        response["Size"] = len(body)
+        response["Body"] = FakeBody(body)
+        response["ContentLength"] = len(body)
+        return response
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, "rb") as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f.read())
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        with open(Filename, "wb") as f:
+            f.write(self.get_object(Bucket=Bucket, Key=Key)["Body"].read())
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._call("HeadObject")
+        if Key not in self.objects:
+            raise self._not_found("HeadObject")
+        response = self._metadata(Key)
+        response["ContentLength"] = response["Size"]
+        response["Metadata"] = self.metadata.get(Key, {})
+        return response
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call("DeleteObject")
+        with self.lock:
+            self.objects.pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._call("DeleteObjects")
+        with self.lock:
+            for obj in Delete["Objects"]:
+                self.objects.pop(obj["Key"], None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", MaxKeys=1000, ContinuationToken=None, StartAfter=None, Delimiter=None, **kwargs):
+        self._call("ListObjectsV2")
+        with self.lock:
+            keys = sorted(k for k in self.objects if k.startswith(Prefix))
+        after = ContinuationToken or StartAfter
+        if after:
+            keys = [k for k in keys if k > after]
+        entries = []
+        for key in keys:
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                common = Prefix + rest[:rest.index(Delimiter) + len(Delimiter)]
+                if not entries or entries[-1] != (common, True):
+                    entries.append((common, True))
+            else:
+                entries.append((key, False))
+        page = entries[:MaxKeys]
+        response = {"KeyCount":len(page)}
+        contents = [self._metadata(k) for k, is_prefix in page if not is_prefix]
+        prefixes = [{"Prefix":k} for k, is_prefix in page if is_prefix]
+        if contents:
+            response["Contents"] = contents
+        if prefixes:
+            response["CommonPrefixes"] = prefixes
+        if len(entries) > MaxKeys:
+            last, is_prefix = page[-1]
+            response["IsTruncated"] = True
+            # Skipping past everything under a common prefix means continuing after its last possible key.
+            response["NextContinuationToken"] = last + "\uffff" if is_prefix else last
+        return response
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        return "https://{}.s3.amazonaws.com/{}?Expires={}".format(Params["Bucket"], Params["Key"], ExpiresIn)
+
+class FakeAutoScaling(object):
+    exceptions = FakeExceptions
+
+    def __init__(self, asg_name="wiglaf-asg", max_size=5, launch_configuration=None):
+        self.asg_name = asg_name
+        self.max_size = max_size
+        self.launch_configuration = launch_configuration or {"ImageId":"ami-base", "InstanceType":"c5.large", "IamInstanceProfile":"wiglaf-node"}
+        self.desired_capacity = 0
+        self.instances = []
+        self.protected = set()
+        self.calls = {}
+
+    def _call(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    @property
+    def call_count(self):
+        return sum(self.calls.values())
+
+    def describe_tags(self, Filters):
+        self._call("DescribeTags")
+        return {"Tags":[{"ResourceId":self.asg_name}]}
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        self._call("DescribeAutoScalingGroups")
+        instances = [{"InstanceId":i, "LifecycleState":"InService", "ProtectedFromScaleIn":i in self.protected} for i in self.instances]
+        return {"AutoScalingGroups":[{"AutoScalingGroupName":self.asg_name, "MaxSize":self.max_size, "DesiredCapacity":self.desired_capacity, "Instances":instances,
+                                      "LaunchConfigurationName":"{}-launch".format(self.asg_name), "VPCZoneIdentifier":"subnet-0"}]}
+
+    def update_auto_scaling_group(self, AutoScalingGroupName, DesiredCapacity=None, **kwargs):
+        self._call("UpdateAutoScalingGroup")
+        if DesiredCapacity is not None:
+            self.desired_capacity = DesiredCapacity
+
+    def describe_launch_configurations(self, LaunchConfigurationNames):
+        self._call("DescribeLaunchConfigurations")
+        return {"LaunchConfigurations":[dict(self.launch_configuration, LaunchConfigurationName=name) for name in LaunchConfigurationNames]}
+
+    def set_instance_protection(self, AutoScalingGroupName, InstanceIds, ProtectedFromScaleIn):
+        self._call("SetInstanceProtection")
+        if ProtectedFromScaleIn:
+            self.protected.update(InstanceIds)
+        else:
+            self.protected.difference_update(InstanceIds)
+
+class FakeEC2(object):
+    """
+    Instances and images in dicts.  run_instances hands each new instance to boot (if given), which stands in for
+    it running its UserData; afterwards the instance is stopped or terminated, per its shutdown behaviour, as if
+    the UserData had shut it down.  Images are available as soon as they're created.
+    """
+    exceptions = FakeExceptions
+
+    def __init__(self, boot=None, launch_templates=None):
+        self.boot = boot
+        self.instances = {}
+        self.images = {}
+        self.launch_templates = launch_templates or {}
+        self.calls = {}
+
+    def _call(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    @property
+    def call_count(self):
+        return sum(self.calls.values())
+
+    def run_instances(self, ImageId, MinCount=1, MaxCount=1, InstanceInitiatedShutdownBehavior="stop", **kwargs):
+        self._call("RunInstances")
+        instances = []
+        for _ in range(MaxCount):
+            instance = dict(kwargs, InstanceId="i-{}".format(uuid.uuid4().hex[:17]), ImageId=ImageId, State={"Name":"running"})
+            self.instances[instance["InstanceId"]] = instance
+            if self.boot:
+                self.boot(instance)
+            instance["State"] = {"Name":"stopped" if InstanceInitiatedShutdownBehavior == "stop" else "terminated"}
+            instances.append(instance)
+        return {"Instances":instances}
+
+    def describe_instances(self, InstanceIds):
+        self._call("DescribeInstances")
+        return {"Reservations":[{"Instances":[self.instances[i] for i in InstanceIds]}]}
+
+    def terminate_instances(self, InstanceIds):
+        self._call("TerminateInstances")
+        for instance_id in InstanceIds:
+            if instance_id in self.instances:
+                self.instances[instance_id]["State"] = {"Name":"terminated"}
+        return {"TerminatingInstances":[{"InstanceId":i} for i in InstanceIds]}
+
+    def create_image(self, InstanceId, Name, **kwargs):
+        self._call("CreateImage")
+        image_id = "ami-{}".format(uuid.uuid4().hex[:17])
+        self.images[image_id] = {"ImageId":image_id, "Name":Name, "State":"available", "SourceInstanceId":InstanceId, "Tags":[]}
+        return {"ImageId":image_id}
+
+    def describe_images(self, ImageIds):
+        self._call("DescribeImages")
+        return {"Images":[self.images[i] for i in ImageIds]}
+
+    def create_tags(self, Resources, Tags):
+        self._call("CreateTags")
+        for resource in Resources:
+            target = self.images.get(resource) or self.instances.get(resource)
+            target.setdefault("Tags", []).extend(Tags)
+
+    def describe_launch_template_versions(self, LaunchTemplateId, Versions):
+        self._call("DescribeLaunchTemplateVersions")
+        return {"LaunchTemplateVersions":[{"LaunchTemplateId":LaunchTemplateId, "LaunchTemplateData":self.launch_templates[LaunchTemplateId]}]}
+
+class FakeEventQueue(object):
+    """
+    Stands in for the SQS queue between the data bucket and the Lambda (see EventBatchSize in the stack template).
+    S3 notifications are queued as message bodies, and drain() hands them to the handler batch_size at a time,
+    like the Lambda event source mapping would, putting back any the handler reports as failed.
+    """
+
+    def __init__(self, batch_size=10, max_receives=3):
+        self.batch_size = batch_size
+        self.max_receives = max_receives
+        self.messages = []
+        self.receives = {}
+        self.dead_letters = []
+        self.invocations = 0
+
+    def send(self, bucket, key):
+        body = json.dumps({"Records":[{"s3":{"bucket":{"name":bucket},"object":{"key":key}}}]})
+        self.messages.append({"messageId":uuid.uuid4().hex, "eventSource":"aws:sqs", "body":body})
+
+    def drain(self, handler):
+        while self.messages:
+            batch, self.messages = self.messages[:self.batch_size], self.messages[self.batch_size:]
+            self.invocations += 1
+            response = handler({"Records":batch}, None) or {}
+            failed = set(failure["itemIdentifier"] for failure in response.get("batchItemFailures", []))
+            for message in batch:
+                if message["messageId"] not in failed:
+                    continue
+                self.receives[message["messageId"]] = self.receives.get(message["messageId"], 0) + 1
+                if self.receives[message["messageId"]] < self.max_receives:
+                    self.messages.append(message)
+                else:
+                    self.dead_letters.append(message)
+
+class FakeSNS(object):
+    exceptions = FakeExceptions
+
+    def __init__(self):
+        self.messages = []
+        self.calls = {}
+
+    @property
+    def call_count(self):
+        return sum(self.calls.values())
+
+    def publish(self, TopicArn, Message, Subject=None, **kwargs):
+        self.calls["Publish"] = self.calls.get("Publish", 0) + 1
+        self.messages.append({"TopicArn":TopicArn, "Subject":Subject, "Message":Message})
+        return {"MessageId":uuid.uuid4().hex}
+
+class VirtualClock(object):
+    """
+    Time that only passes when something sleeps, so that stack operations taking minutes can be followed instantly.
+    Stands in for the time module where a benchmark patches it in: time(), perf_counter(), monotonic() and sleep().
+    """
+
+    def __init__(self, start=1700000000.0):
+        self.now = start
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    perf_counter = monotonic = time
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.now += max(0, seconds)
+
+# Rough seconds CloudFormation takes to create or change each type of resource, for FakeCloudFormation.  They're
+# typical of what the console shows rather than measured, and only their proportions matter to the benchmarks.
+STACK_RESOURCE_SECONDS = {
+    "AWS::AutoScaling::AutoScalingGroup":60,
+    "AWS::AutoScaling::LaunchConfiguration":5,
+    "AWS::DynamoDB::Table":15,
+    "AWS::EC2::InternetGateway":15,
+    "AWS::EC2::LaunchTemplate":5,
+    "AWS::EC2::Route":15,
+    "AWS::EC2::RouteTable":5,
+    "AWS::EC2::Subnet":5,
+    "AWS::EC2::SubnetRouteTableAssociation":5,
+    "AWS::EC2::VPC":15,
+    "AWS::EC2::VPCGatewayAttachment":15,
+    "AWS::IAM::InstanceProfile":120,
+    "AWS::IAM::Role":20,
+    "AWS::Lambda::EventSourceMapping":60,
+    "AWS::Lambda::Function":15,
+    "AWS::Lambda::Permission":10,
+    "AWS::S3::Bucket":20,
+    "AWS::SNS::Topic":10,
+    "AWS::SQS::Queue":30,
+    "AWS::SQS::QueuePolicy":10,
+}
+ROLLBACK_SECONDS = 60
+
+_NO_VALUE = object()
+
+def _template_error(message, operation):
+    return ClientError({"Error":{"Code":"ValidationError", "Message":message}}, operation)
+
+def _conditions(template, parameters):
+    conditions = {}
+
+    def value(node):
+        if isinstance(node, dict):
+            if "Ref" in node:
+                return parameters.get(node["Ref"])
+            if "Condition" in node:
+                return truth(node["Condition"])
+            if "Fn::Equals" in node:
+                return value(node["Fn::Equals"][0]) == value(node["Fn::Equals"][1])
+            if "Fn::Not" in node:
+                return not value(node["Fn::Not"][0])
+            if "Fn::And" in node:
+                return all(value(n) for n in node["Fn::And"])
+            if "Fn::Or" in node:
+                return any(value(n) for n in node["Fn::Or"])
+        return node
+
+    def truth(name):
+        if name not in conditions:
+            conditions[name] = value(template["Conditions"][name])
+        return conditions[name]
+
+    for name in template.get("Conditions", {}):
+        truth(name)
+    return conditions
+
+def _resolve(node, conditions, parameters):
+    # Picks the branches of Fn::Ifs and fills in parameters, leaving references to resources as they are.
+    if isinstance(node, list):
+        return [n for n in (_resolve(n, conditions, parameters) for n in node) if n is not _NO_VALUE]
+    if isinstance(node, dict):
+        if "Fn::If" in node:
+            condition, yes, no = node["Fn::If"]
+            return _resolve(yes if conditions[condition] else no, conditions, parameters)
+        if node.get("Ref") == "AWS::NoValue":
+            return _NO_VALUE
+        if "Ref" in node and node["Ref"] in parameters:
+            return parameters[node["Ref"]]
+        resolved = {k:_resolve(v, conditions, parameters) for k, v in node.items()}
+        return {k:v for k, v in resolved.items() if v is not _NO_VALUE}
+    return node
+
+def _references(node):
+    if isinstance(node, list):
+        return set().union(*[_references(n) for n in node]) if node else set()
+    if isinstance(node, dict):
+        found = set().union(*[_references(v) for v in node.values()]) if node else set()
+        if "Ref" in node:
+            found.add(node["Ref"])
+        if "Fn::GetAtt" in node:
+            found.add(node["Fn::GetAtt"][0])
+        if "Fn::Sub" in node:
+            text = node["Fn::Sub"] if isinstance(node["Fn::Sub"], str) else node["Fn::Sub"][0]
+            found.update(re.findall(r"\$\{([A-Za-z0-9]+)(?:\.[A-Za-z0-9]+)?\}", text))
+        return found
+    return set()
+
+class FakeCloudFormation(object):
+    """
+    Stacks built from their templates over (clock) time.  Creating or updating one works out which resources are
+    added, changed or removed, and runs each after the resources it depends on (Refs, GetAtts, Subs and DependsOn,
+    including ones in Metadata), taking STACK_RESOURCE_SECONDS for its type.  That plays out as stack events, which
+    describe_stack_events and describe_stacks show as the clock reaches them.  Like CloudFormation it rejects
+    DependsOn and Refs to resources whose condition is false, and like S3 a bucket whose notifications go to a
+    function or queue fails (rolling the stack back) unless the function's permission or the queue's policy is in
+    place when the bucket is set up.  Stacks added with add_stack have no template: they're complete, and updating
+    their parameters is instant.
+    """
+    exceptions = FakeExceptions
+
+    def __init__(self, clock=time, durations=None, jitter=0, seed=None, page_size=100):
+        self.clock = clock
+        self.durations = dict(STACK_RESOURCE_SECONDS, **(durations or {}))
+        # Each resource takes its type's time, give or take this fraction of it.
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.page_size = page_size
+        self.stacks = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def _call(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    @property
+    def call_count(self):
+        return sum(self.calls.values())
+
+    def add_stack(self, name, parameters, outputs):
+        self.stacks[name] = {"StackName":name, "Template":None, "Parameters":dict(parameters), "Outputs":dict(outputs), "Resources":{},
+                             "Events":[], "Pending":None, "StackStatus":"CREATE_COMPLETE"}
+
+    def _stack(self, name, operation):
+        if name not in self.stacks:
+            raise _template_error("Stack with id {} does not exist".format(name), operation)
+        stack = self.stacks[name]
+        pending = stack["Pending"]
+        if pending and self.clock.time() >= pending["until"]:
+            stack.update(pending["state"])
+            stack["Pending"] = None
+        if stack["Events"]:
+            visible = [e for e in stack["Events"] if e["_time"] <= self.clock.time() and e["ResourceType"] == "AWS::CloudFormation::Stack"]
+            stack["StackStatus"] = visible[-1]["ResourceStatus"]
+        return stack
+
+    def _duration(self, resource_type):
+        return self.durations.get(resource_type, 10) * (1 + self.random.uniform(-self.jitter, self.jitter))
+
+    def _event(self, stack, at, logical_id, resource_type, status, reason=None, physical_id=None):
+        event = {"_time":at, "EventId":uuid.uuid4().hex, "StackName":stack["StackName"], "LogicalResourceId":logical_id,
+                 "PhysicalResourceId":physical_id or "", "ResourceType":resource_type, "ResourceStatus":status,
+                 "Timestamp":datetime.fromtimestamp(at, timezone.utc)}
+        if reason:
+            event["ResourceStatusReason"] = reason
+        stack["Events"].append(event)
+
+    def _parameters(self, template, given, previous, operation):
+        parameters = {k:p["Default"] for k, p in template.get("Parameters", {}).items() if "Default" in p}
+        for parameter in given:
+            key = parameter["ParameterKey"]
+            if key not in template.get("Parameters", {}):
+                raise _template_error("Parameters: [{}] do not exist in the template".format(key), operation)
+            parameters[key] = previous[key] if parameter.get("UsePreviousValue") else str(parameter["ParameterValue"])
+        return parameters
+
+    def _plan(self, template, parameters, operation):
+        """
+        {logical id: {"Type", "Definition", "Depends"}} for the resources the template makes with these parameters.
+        """
+        conditions = _conditions(template, parameters)
+        names = {k for k, r in template["Resources"].items() if conditions.get(r.get("Condition"), True)}
+        plan = {}
+        for name in names:
+            resource = template["Resources"][name]
+            definition = _resolve({"Properties":resource.get("Properties", {}), "Metadata":resource.get("Metadata", {})}, conditions, parameters)
+            depends = resource.get("DependsOn", [])
+            depends = set([depends] if isinstance(depends, str) else depends)
+            refs = {r for r in _references(definition) if not r.startswith("AWS::")}
+            unresolved = (depends | refs) - names
+            if unresolved:
+                raise _template_error("Template format error: Unresolved resource dependencies [{}] in the Resources block of the template".format(
+                    ", ".join(sorted(unresolved))), operation)
+            plan[name] = {"Type":resource["Type"], "Definition":json.dumps(definition, sort_keys=True), "Depends":depends | refs}
+        return plan, conditions
+
+    def _outputs(self, template, conditions, resources):
+        outputs = {}
+        for key, output in template.get("Outputs", {}).items():
+            if conditions.get(output.get("Condition"), True) and output["Value"].get("Ref") in resources:
+                outputs[key] = resources[output["Value"]["Ref"]]["PhysicalResourceId"]
+        return outputs
+
+    def _notification_error(self, plan, name, ready):
+        # What S3 says if a bucket's notifications go somewhere it hasn't been allowed to send to yet.
+        configuration = json.loads(plan[name]["Definition"])["Properties"].get("NotificationConfiguration", {})
+        for target in configuration.get("LambdaConfigurations", []):
+            function = target["Function"]["Fn::GetAtt"][0]
+            permissions = [k for k, r in plan.items() if r["Type"] == "AWS::Lambda::Permission" and
+                           function in _references(json.loads(r["Definition"])["Properties"].get("FunctionName"))]
+            if not any(ready(p) for p in permissions):
+                return "Unable to validate the following destination configurations"
+        for target in configuration.get("QueueConfigurations", []):
+            queue = target["Queue"]["Fn::GetAtt"][0]
+            policies = [k for k, r in plan.items() if r["Type"] == "AWS::SQS::QueuePolicy" and
+                        queue in _references(json.loads(r["Definition"])["Properties"].get("Queues"))]
+            if not any(ready(p) for p in policies):
+                return "Unable to validate the following destination configurations"
+        return None
+
+    def _operate(self, stack, template, parameters, creating, operation):
+        plan, conditions = self._plan(template, parameters, operation)
+        old = stack["Resources"]
+        prefix = "CREATE" if creating else "UPDATE"
+        touched = {k for k in plan if k not in old or old[k]["Definition"] != plan[k]["Definition"]}
+        removed = set(old) - set(plan)
+        if not creating and not touched and not removed and template == stack["Template"] and parameters == stack["Parameters"]:
+            raise _template_error("No updates are to be performed.", operation)
+        start = self.clock.time()
+        self._event(stack, start, stack["StackName"], "AWS::CloudFormation::Stack", prefix + "_IN_PROGRESS", "User Initiated")
+        begins, ends = {}, {}
+
+        def schedule(name):
+            if name not in ends:
+                begins[name] = max([start] + [schedule(d) for d in sorted(plan[name]["Depends"]) if d in touched])
+                ends[name] = begins[name] + self._duration(plan[name]["Type"])
+            return ends[name]
+
+        for name in sorted(touched):
+            schedule(name)
+        failure = None
+        for name in sorted(touched, key=lambda n: begins[n]):
+            if plan[name]["Type"] == "AWS::S3::Bucket":
+                error = self._notification_error(plan, name, lambda p: (p not in touched and p in old) or (p in touched and ends[p] <= begins[name]))
+                if error and (failure is None or begins[name] < failure[1]):
+                    failure = (name, begins[name] + 2, error)
+        resources = {k:v for k, v in old.items() if k not in touched}
+        for name in touched:
+            physical = old[name]["PhysicalResourceId"] if name in old else "{}-{}-{}".format(stack["StackName"], name, uuid.uuid4().hex[:12]).lower()
+            resources[name] = {"Type":plan[name]["Type"], "Definition":plan[name]["Definition"], "PhysicalResourceId":physical}
+            status = "CREATE" if name not in old else "UPDATE"
+            if failure is None or begins[name] < failure[1]:
+                self._event(stack, begins[name], name, plan[name]["Type"], status + "_IN_PROGRESS", physical_id=physical)
+            if failure is None or ends[name] < failure[1]:
+                self._event(stack, ends[name], name, plan[name]["Type"], status + "_COMPLETE", physical_id=physical)
+        if failure:
+            name, at, reason = failure
+            self._event(stack, at, name, plan[name]["Type"], ("CREATE" if name not in old else "UPDATE") + "_FAILED", reason)
+            rollback = "ROLLBACK" if creating else "UPDATE_ROLLBACK"
+            self._event(stack, at, stack["StackName"], "AWS::CloudFormation::Stack", rollback + "_IN_PROGRESS",
+                        "The following resource(s) failed to {}: [{}].".format(prefix.lower(), name))
+            self._event(stack, at + ROLLBACK_SECONDS, stack["StackName"], "AWS::CloudFormation::Stack", rollback + "_COMPLETE")
+            state = {"Resources":{}, "Outputs":{}} if creating else {}
+            stack["Pending"] = {"until":at + ROLLBACK_SECONDS, "state":state}
+        else:
+            finish = max([start + 1] + list(ends.values()))
+            if not creating:
+                self._event(stack, finish, stack["StackName"], "AWS::CloudFormation::Stack", "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS")
+                cleaned = finish
+                for name in sorted(removed):
+                    self._event(stack, finish, name, old[name]["Type"], "DELETE_IN_PROGRESS", physical_id=old[name]["PhysicalResourceId"])
+                    done = finish + self._duration(old[name]["Type"])
+                    self._event(stack, done, name, old[name]["Type"], "DELETE_COMPLETE", physical_id=old[name]["PhysicalResourceId"])
+                    cleaned = max(cleaned, done)
+                finish = cleaned
+            self._event(stack, finish, stack["StackName"], "AWS::CloudFormation::Stack", prefix + "_COMPLETE")
+            stack["Pending"] = {"until":finish, "state":{"Template":template, "Parameters":parameters, "Resources":resources,
+                                                         "Outputs":self._outputs(template, conditions, resources)}}
+        stack["Events"].sort(key=lambda e: e["_time"])
+        self._stack(stack["StackName"], operation)
+        return {"StackId":stack["StackName"]}
+
+    def create_stack(self, StackName, TemplateBody, Parameters=[], **kwargs):
+        with self.lock:
+            self._call("CreateStack")
+            if StackName in self.stacks:
+                raise ClientError({"Error":{"Code":"AlreadyExistsException", "Message":"Stack [{}] already exists".format(StackName)}}, "CreateStack")
+            template = json.loads(TemplateBody)
+            stack = {"StackName":StackName, "Template":None, "Parameters":{}, "Outputs":{}, "Resources":{}, "Events":[], "Pending":None}
+            parameters = self._parameters(template, Parameters, {}, "CreateStack")
+            self._plan(template, parameters, "CreateStack")
+            self.stacks[StackName] = stack
+            return self._operate(stack, template, parameters, True, "CreateStack")
+
+    def describe_stacks(self, StackName):
+        with self.lock:
+            self._call("DescribeStacks")
+            stack = self._stack(StackName, "DescribeStacks")
+            return {"Stacks":[{"StackName":StackName, "StackStatus":stack["StackStatus"],
+                               "Parameters":[{"ParameterKey":k, "ParameterValue":v} for k, v in sorted(stack["Parameters"].items())],
+                               "Outputs":[{"OutputKey":k, "OutputValue":v} for k, v in sorted(stack["Outputs"].items())]}]}
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        with self.lock:
+            self._call("DescribeStackEvents")
+            stack = self._stack(StackName, "DescribeStackEvents")
+            events = [e for e in stack["Events"] if e["_time"] <= self.clock.time()][::-1]
+            offset = int(NextToken or 0)
+            page = [{k:v for k, v in e.items() if k != "_time"} for e in events[offset:offset + self.page_size]]
+            response = {"StackEvents":page}
+            if offset + self.page_size < len(events):
+                response["NextToken"] = str(offset + self.page_size)
+            return response
+
+    def update_stack(self, StackName, Parameters, TemplateBody=None, UsePreviousTemplate=False, **kwargs):
+        with self.lock:
+            self._call("UpdateStack")
+            stack = self._stack(StackName, "UpdateStack")
+            if stack["StackStatus"].endswith("_IN_PROGRESS"):
+                raise _template_error("Stack:{} is in {} state and can not be updated.".format(StackName, stack["StackStatus"]), "UpdateStack")
+            if stack["Template"] is None and TemplateBody is None:
+                for parameter in Parameters:
+                    if not parameter.get("UsePreviousValue"):
+                        stack["Parameters"][parameter["ParameterKey"]] = parameter["ParameterValue"]
+                now = self.clock.time()
+                for status in ["UPDATE_IN_PROGRESS", "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS", "UPDATE_COMPLETE"]:
+                    self._event(stack, now, StackName, "AWS::CloudFormation::Stack", status)
+                stack["StackStatus"] = "UPDATE_COMPLETE"
+                return {"StackId":StackName}
+            template = stack["Template"] if UsePreviousTemplate else json.loads(TemplateBody)
+            parameters = self._parameters(template, Parameters, stack["Parameters"], "UpdateStack")
+            return self._operate(stack, template, parameters, False, "UpdateStack")
+
+class FakeDynamoDB(object):
+    """
+    One table of items keyed by Id, with just the expressions the work queue and completion tracker use:
+    conditions and filters made of attribute_not_exists, begins_with, contains and comparisons, joined by AND, OR
+    and NOT with parentheses, and updates made of SET a = :v, ADD n :v and REMOVE a actions.  Scans read
+    scan_page_size items of the whole table a page, matching or not, like DynamoDB's 1MB pages.  Queries go
+    through indexes, {name: (hash key, range key)} like the state table's global secondary indexes, which hold
+    just the items with the hash key, and read scan_page_size of those a page.  Batch writes are never throttled.
+    """
+    exceptions = FakeExceptions
+    TOKENS = re.compile(r"\s*(<>|<=|>=|[()=<>,]|[#:]?[A-Za-z_][\w.]*)")
+
+    def __init__(self, scan_page_size=4000, indexes=None):
+        self.scan_page_size = scan_page_size
+        self.indexes = indexes if indexes is not None else {"JobIndex":("Job", "Id")}
+        self.items = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def _call(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    @property
+    def call_count(self):
+        return sum(self.calls.values())
+
+    def _condition(self, expression, names, values):
+        """
+        Compiles a condition or filter into a test of an item, so that scans don't parse it once per item.
+        """
+        tokens = []
+        position = 0
+        while position < len(expression.rstrip()):
+            match = self.TOKENS.match(expression, position)
+            if not match:
+                raise NotImplementedError(expression)
+            tokens.append(match.group(1))
+            position = match.end()
+        tokens.append(None)
+        position = [0]
+
+        def peek():
+            return tokens[position[0]]
+
+        def take(expected=None):
+            token = tokens[position[0]]
+            if expected is not None and token != expected:
+                raise NotImplementedError(expression)
+            position[0] += 1
+            return token
+
+        def operand():
+            token = take()
+            if token.startswith(":"):
+                return lambda item, v=values[token]: v
+            return lambda item, a=names.get(token, token): item.get(a)
+
+        def scalar(value):
+            if value is None:
+                return None
+            return float(value["N"]) if "N" in value else value.get("S", value.get("BOOL"))
+
+        def primary():
+            if peek() == "(":
+                take("(")
+                test = disjunction()
+                take(")")
+                return test
+            if tokens[position[0] + 1] == "(":
+                function = take()
+                take("(")
+                arguments = [operand()]
+                while peek() == ",":
+                    take(",")
+                    arguments.append(operand())
+                take(")")
+                if function == "attribute_not_exists":
+                    return lambda item, a=arguments[0]: a(item) is None
+                if function == "attribute_exists":
+                    return lambda item, a=arguments[0]: a(item) is not None
+                if function == "begins_with":
+                    return lambda item, a=arguments[0], v=arguments[1]: a(item) is not None and a(item)["S"].startswith(v(item)["S"])
+                if function == "contains":
+                    return lambda item, a=arguments[0], v=arguments[1]: a(item) is not None and v(item)["S"] in a(item)["S"]
+                raise NotImplementedError(function)
+            left = operand()
+            comparison = take()
+            right = operand()
+            if comparison == "=":
+                return lambda item: left(item) is not None and scalar(left(item)) == scalar(right(item))
+            if comparison == "<>":
+                return lambda item: scalar(left(item)) != scalar(right(item))
+            compare = {"<":lambda a, b: a < b, "<=":lambda a, b: a <= b, ">":lambda a, b: a > b, ">=":lambda a, b: a >= b}[comparison]
+            return lambda item: left(item) is not None and compare(scalar(left(item)), scalar(right(item)))
+
+        def negation():
+            if peek() == "NOT":
+                take()
+                test = negation()
+                return lambda item: not test(item)
+            return primary()
+
+        def conjunction():
+            tests = [negation()]
+            while peek() == "AND":
+                take()
+                tests.append(negation())
+            return tests[0] if len(tests) == 1 else lambda item: all(test(item) for test in tests)
+
+        def disjunction():
+            tests = [conjunction()]
+            while peek() == "OR":
+                take()
+                tests.append(conjunction())
+            return tests[0] if len(tests) == 1 else lambda item: any(test(item) for test in tests)
+
+        test = disjunction()
+        take(None)
+        return test
+
+    def _evaluate(self, expression, item, names, values):
+        return self._condition(expression, names, values)(item)
+
+    def _update(self, expression, item, names, values):
+        for clause, actions in re.findall(r"(SET|ADD|REMOVE) (.*?)(?= (?:SET|ADD|REMOVE) |$)", expression):
+            for action in actions.split(","):
+                if clause == "SET":
+                    attribute, value = [part.strip() for part in action.split("=")]
+                    item[names.get(attribute, attribute)] = values[value]
+                elif clause == "REMOVE":
+                    item.pop(names.get(action.strip(), action.strip()), None)
+                else:
+                    attribute, value = action.split()
+                    attribute = names.get(attribute, attribute)
+                    item[attribute] = {"N":str(int(item.get(attribute, {"N":"0"})["N"]) + int(values[value]["N"]))}
+
+    def get_item(self, TableName, Key, **kwargs):
+        self._call("GetItem")
+        with self.lock:
+            item = self.items.get(Key["Id"]["S"])
+            return {"Item":dict(item)} if item is not None else {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+        self._call("PutItem")
+        with self.lock:
+            existing = self.items.get(Item["Id"]["S"], {})
+            if ConditionExpression and not self._evaluate(ConditionExpression, existing, ExpressionAttributeNames or {}, ExpressionAttributeValues or {}):
+                raise FakeExceptions.ConditionalCheckFailedException("PutItem")
+            self.items[Item["Id"]["S"]] = dict(Item)
+        return {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues=None, **kwargs):
+        self._call("UpdateItem")
+        names, values = ExpressionAttributeNames or {}, ExpressionAttributeValues or {}
+        with self.lock:
+            item = dict(self.items.get(Key["Id"]["S"], Key))
+            if ConditionExpression and not self._evaluate(ConditionExpression, item if Key["Id"]["S"] in self.items else {}, names, values):
+                raise FakeExceptions.ConditionalCheckFailedException("UpdateItem")
+            before = dict(item)
+            self._update(UpdateExpression, item, names, values)
+            self.items[Key["Id"]["S"]] = item
+        if ReturnValues == "ALL_NEW":
+            return {"Attributes":dict(item)}
+        if ReturnValues == "UPDATED_NEW":
+            return {"Attributes":{k:v for k, v in item.items() if before.get(k) != v}}
+        return {}
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        self._call("TransactWriteItems")
+        if len(TransactItems) > 100:
+            raise ClientError({"Error":{"Code":"ValidationException", "Message":"Too many items in the transaction"}}, "TransactWriteItems")
+        with self.lock:
+            reasons, writes = [], []
+            for request in TransactItems:
+                (kind, details), = request.items()
+                item_id = (details.get("Key") or details["Item"])["Id"]["S"]
+                existing = self.items.get(item_id, {})
+                condition = details.get("ConditionExpression")
+                names, values = details.get("ExpressionAttributeNames", {}), details.get("ExpressionAttributeValues", {})
+                if condition and not self._evaluate(condition, existing, names, values):
+                    reasons.append({"Code":"ConditionalCheckFailed", "Message":"The conditional request failed"})
+                    continue
+                reasons.append({"Code":"None"})
+                if kind == "Put":
+                    writes.append((item_id, dict(details["Item"])))
+                elif kind == "Update":
+                    item = dict(existing or details["Key"])
+                    self._update(details["UpdateExpression"], item, names, values)
+                    writes.append((item_id, item))
+                elif kind == "Delete":
+                    writes.append((item_id, None))
+            if any(reason["Code"] != "None" for reason in reasons):
+                raise FakeExceptions.TransactionCanceledException("TransactWriteItems", reasons)
+            for item_id, item in writes:
+                if item is None:
+                    self.items.pop(item_id, None)
+                else:
+                    self.items[item_id] = item
+        return {}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self._call("BatchWriteItem")
+        (table_name, requests), = RequestItems.items()
+        if len(requests) > 25:
+            raise ClientError({"Error":{"Code":"ValidationException", "Message":"Too many items requested for the BatchWriteItem call"}}, "BatchWriteItem")
+        with self.lock:
+            for request in requests:
+                if "PutRequest" in request:
+                    self.items[request["PutRequest"]["Item"]["Id"]["S"]] = dict(request["PutRequest"]["Item"])
+                else:
+                    self.items.pop(request["DeleteRequest"]["Key"]["Id"]["S"], None)
+        return {"UnprocessedItems":{}}
+
+    def scan(self, TableName, FilterExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, ExclusiveStartKey=None, **kwargs):
+        self._call("Scan")
+        with self.lock:
+            ids = sorted(self.items)
+            if ExclusiveStartKey:
+                ids = [i for i in ids if i > ExclusiveStartKey["Id"]["S"]]
+            page = ids[:self.scan_page_size]
+            items = [dict(self.items[i]) for i in page]
+        if FilterExpression:
+            test = self._condition(FilterExpression, ExpressionAttributeNames or {}, ExpressionAttributeValues or {})
+            items = [item for item in items if test(item)]
+        response = {"Items":items, "Count":len(items), "ScannedCount":len(page)}
+        if len(ids) > len(page):
+            response["LastEvaluatedKey"] = {"Id":{"S":page[-1]}}
+        return response
+
+    def query(self, TableName, KeyConditionExpression, IndexName=None, FilterExpression=None, ExpressionAttributeNames=None,
+              ExpressionAttributeValues=None, ExclusiveStartKey=None, **kwargs):
+        self._call("Query")
+        names, values = ExpressionAttributeNames or {}, ExpressionAttributeValues or {}
+        hash_key, range_key = self.indexes[IndexName] if IndexName else ("Id", None)
+        key_test = self._condition(KeyConditionExpression, names, values)
+        with self.lock:
+            items = sorted((dict(item) for item in self.items.values() if hash_key in item and key_test(item)),
+                           key=lambda item: (item[range_key]["S"] if range_key else "", item["Id"]["S"]))
+        if ExclusiveStartKey:
+            start = (ExclusiveStartKey[range_key]["S"] if range_key else "", ExclusiveStartKey["Id"]["S"])
+            items = [item for item in items if (item[range_key]["S"] if range_key else "", item["Id"]["S"]) > start]
+        page = items[:self.scan_page_size]
+        matching = page
+        if FilterExpression:
+            test = self._condition(FilterExpression, names, values)
+            matching = [item for item in page if test(item)]
+        response = {"Items":matching, "Count":len(matching), "ScannedCount":len(page)}
+        if len(items) > len(page):
+            response["LastEvaluatedKey"] = {k:page[-1][k] for k in set([hash_key, range_key or hash_key, "Id"])}
+        return response
+
+class CallRecorder(object):
+    """
+    Wraps a fake client to count its calls under one caller (the CLI, the Lambda or the nodes) in a shared
+    {(caller, service, operation): {"count", "seconds"}} dict, so that several callers can share one fake.
+    """
+
+    def __init__(self, client, caller, service, calls, lock):
+        self._client = client
+        self._caller = caller
+        self._service = service
+        self._calls = calls
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name.startswith("_") or isinstance(attribute, type):
+            return attribute
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                with self._lock:
+                    entry = self._calls.setdefault((self._caller, self._service, name), {"count":0, "seconds":0.0})
+                    entry["count"] += 1
+                    entry["seconds"] += seconds
+        return call
+
+class FakeAWS(object):
+    """
+    One of each fake, standing in for an account, with client(service, caller) handing out recording wrappers.
+    """
+
+    def __init__(self, s3=None, dynamodb=None, autoscaling=None, ec2=None, sns=None, cloudformation=None):
+        self.services = {
+            "s3":s3 if s3 is not None else FakeS3(),
+            "dynamodb":dynamodb if dynamodb is not None else FakeDynamoDB(),
+            "autoscaling":autoscaling if autoscaling is not None else FakeAutoScaling(),
+            "ec2":ec2 if ec2 is not None else FakeEC2(),
+            "sns":sns if sns is not None else FakeSNS(),
+            "cloudformation":cloudformation if cloudformation is not None else FakeCloudFormation(),
+        }
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name in self.__dict__.get("services", {}):
+            return self.services[name]
+        raise AttributeError(name)
+
+    def client(self, service, caller):
+        return CallRecorder(self.services[service], caller, service, self.calls, self.lock)
+
+    def call_counts(self):
+        """
+        {caller: {service: {operation: count}}}
+        """
+        counts = {}
+        with self.lock:
+            for (caller, service, operation), entry in self.calls.items():
+                counts.setdefault(caller, {}).setdefault(service, {})[operation] = entry["count"]
+        return counts
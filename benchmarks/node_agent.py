@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Runs the node agent locally against a FakeS3 and an in-process work queue, and prints the metrics it records
+# for each phase.  Batch commands are shell sleeps, so the overlap of uploads with the next batch shows up in
+# the total.  With --interrupt-after, the node is given a spot interruption notice partway through.
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "wiglaf", "node"))
+
+import agent
+import work_queue
+from fakes import FakeEC2, FakeS3
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches",
+                        help='Number of batches in the job.',
+                        type=int,
+                        default=20)
+    parser.add_argument("--resources",
+                        help='Number of resource files.',
+                        type=int,
+                        default=50)
+    parser.add_argument("--slots",
+                        help='ConcurrencyPerNode.',
+                        type=int,
+                        default=4)
+    parser.add_argument("--compute",
+                        help='Seconds each batch spends computing.',
+                        type=float,
+                        default=0.2)
+    parser.add_argument("--latency",
+                        help='Simulated per-request S3 latency in seconds.',
+                        type=float,
+                        default=0.02)
+    parser.add_argument("--interrupt-after",
+                        help='Seconds into the run to give notice of a spot interruption, which takes effect a second after the agent\'s margin.',
+                        type=float,
+                        default=None)
+    return parser.parse_args()
+
+def fake_metadata(interrupt_at):
+    # Only the interruption notice is answered; everything else 404s, as it would for an uninterrupted instance.
+    def metadata(path):
+        if path == "spot/instance-action" and interrupt_at is not None and time.time() >= interrupt_at:
+            reclaim_at = interrupt_at + agent.INTERRUPTION_MARGIN_SECONDS + 1
+            return json.dumps({"action":"terminate", "time":time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(reclaim_at))})
+        raise LookupError(path)
+    return metadata
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARN)
+    s3 = FakeS3(latency=args.latency, bandwidth=100 * 1024 * 1024)
+    resources = {}
+    for i in range(args.resources):
+        digest = "{:064x}".format(i)
+        s3.objects["cas/{}".format(digest)] = os.urandom(64 * 1024)
+        resources["input.{}.dat".format(i)] = digest
+    manifest = {
+        "JobName":"bench",
+        "NumberOfBatches":args.batches,
+        "ConcurrencyPerNode":args.slots,
+        "Resources":resources,
+        "InstallCommands":["true"],
+        "CommandsToRun":["sleep {} && head -c 1000000 /dev/urandom > out.dat".format(args.compute)],
+        "FilesToUpload":["out.dat"],
+        "CommandTimeoutSeconds":60,
+        # Idle slots poll until the last leases run out, so keep the tail short.
+        "LeaseSeconds":3
+    }
+    s3.objects[agent.CURRENT_MANIFEST_KEY] = json.dumps(manifest).encode("utf-8")
+    workdir = tempfile.mkdtemp()
+    agent.INTERRUPTION_POLL_SECONDS = 0.1
+    try:
+        queue = work_queue.LocalWorkQueue()
+        interrupt_at = time.time() + args.interrupt_after if args.interrupt_after is not None else None
+        node = agent.Agent("bench", "unused", instance_id="i-00000000", s3=s3, ec2=FakeEC2(), queue=queue,
+                           work_directory=os.path.join(workdir, "work"), slot_directory=os.path.join(workdir, "slots"),
+                           cache_directory=os.path.join(workdir, "cache"), log_directory=workdir, metadata=fake_metadata(interrupt_at))
+        start = time.perf_counter()
+        node.run()
+        total = time.perf_counter() - start
+        with open(os.path.join(workdir, agent.METRICS_LOG)) as f:
+            entries = [json.loads(line) for line in f]
+        phases = {}
+        for entry in entries:
+            if entry["event"] == "end":
+                phases.setdefault(entry["phase"].split(".")[0], []).append(entry)
+        for phase, ends in sorted(phases.items()):
+            wall = sum(e["wall"] for e in ends)
+            print("{:<18} n={:<4} total {:7.2f}s  mean {:6.3f}s  cpu {:6.2f}s".format(phase, len(ends), wall, wall / len(ends), sum(e.get("cpu", 0) for e in ends)))
+        results = [k for k in s3.objects if k.startswith("jobs/bench/results/")]
+        print("wall clock {:.2f}s, {} results, {} S3 calls".format(total, len(results), s3.call_count))
+        if interrupt_at is not None:
+            job = queue.jobs["bench"]
+            released = [b for b, (owner, expires) in job["leases"].items() if b not in job["done"] and expires == 0]
+            print("interrupted: {} batches done, {} handed back, {} never started".format(len(job["done"]), len(released), args.batches - job["next"]))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
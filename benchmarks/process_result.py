@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Drives simulated S3 result events through the Lambda handler to measure per-event cost of completion tracking.
+# Nothing here talks to AWS; the handler's clients and completion tracker are swapped for in-process stand-ins.
+# With --batch-size, the events go through a stand-in for the stack's event queue instead of one invocation each.
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+
+import handlers
+import tracker
+from fakes import FakeAutoScaling, FakeEventQueue, FakeS3
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events",
+                        help='Number of result events to send.',
+                        type=int,
+                        default=10000)
+    parser.add_argument("--duplicates",
+                        help='Fraction of events that are re-uploads of an already-seen result.',
+                        type=float,
+                        default=0.05)
+    parser.add_argument("--batch-size",
+                        help='Deliver events through a queue, this many per invocation.  0 invokes the handler once per event.',
+                        type=int,
+                        default=0)
+    return parser.parse_args()
+
+class CountingTracker(tracker.LocalCompletionTracker):
+    # Counts the calls that would each be a DynamoDB round trip (or several) with the real tracker.
+    calls = 0
+
+    def record_many(self, job_name, result_keys):
+        self.calls += 1
+        return super(CountingTracker, self).record_many(job_name, result_keys)
+
+    def claim_completion(self, job_name, lease_seconds):
+        self.calls += 1
+        return super(CountingTracker, self).claim_completion(job_name, lease_seconds)
+
+    def finish_completion(self, job_name):
+        self.calls += 1
+        return super(CountingTracker, self).finish_completion(job_name)
+
+def result_event(bucket, key):
+    return {"Records":[{"s3":{"bucket":{"name":bucket},"object":{"key":key}}}]}
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("STACK_NAME", "wiglaf-benchmark")
+    bucket = "wiglaf-benchmark"
+    unique = max(1, int(args.events * (1 - args.duplicates)))
+    # Sizing reads the work queue, which isn't part of this benchmark.
+    manifest = {"JobName":"bench", "NumberOfBatches":unique, "AdaptiveSizing":False}
+    s3 = FakeS3()
+    s3.put_object(Bucket=bucket, Key="jobs/bench/resources/wiglaf_manifest.json", Body=json.dumps(manifest).encode("utf-8"))
+    asg = FakeAutoScaling()
+    handlers._clients.update({"s3":s3, "autoscaling":asg})
+    handlers._tracker = CountingTracker()
+    handlers._tracker.set_target("bench", unique)
+
+    keys = ["jobs/bench/results/out.csv.{}.i-{:08x}".format(i, i // 100) for i in range(unique)]
+    # Duplicates are sprinkled in before the final upload so that the job only finishes on the last event.
+    keys = keys[:-1] + keys[:args.events - unique] + keys[-1:]
+    for key in keys:
+        s3.objects[key] = b"result"
+
+    latencies = []
+    queue = FakeEventQueue(batch_size=args.batch_size) if args.batch_size else None
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        start = time.perf_counter()
+        if queue:
+            for key in keys:
+                queue.send(bucket, key)
+            def handler(event, context):
+                before = time.perf_counter()
+                response = handlers.lambda_handler(event, context)
+                latencies.append(time.perf_counter() - before)
+                return response
+            queue.drain(handler)
+        else:
+            for key in keys:
+                before = time.perf_counter()
+                handlers.lambda_handler(result_event(bucket, key), None)
+                latencies.append(time.perf_counter() - before)
+        total = time.perf_counter() - start
+    finally:
+        sys.stdout = stdout
+    latencies.sort()
+    print("Events:           {}".format(len(keys)))
+    print("Unique results:   {}".format(unique))
+    print("Total time:       {:.3f}s".format(total))
+    print("Events/sec:       {:.0f}".format(len(keys) / total))
+    print("Invocations:      {}".format(len(latencies)))
+    print("p50 per call:     {:.1f}us".format(latencies[len(latencies)//2] * 1e6))
+    print("p99 per call:     {:.1f}us".format(latencies[int(len(latencies)*0.99)] * 1e6))
+    print("Tracker calls:    {}".format(handlers._tracker.calls))
+    print("S3 calls:         {}".format(s3.call_count))
+    print("ASG calls:        {}".format(asg.call_count))
+    print("Job finished:     {}".format("jobs/bench/results/{}".format(handlers.RESULTS_FILE) in s3.objects))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Runs a job with a reduce stage on a few local node agents (sharing a FakeS3 and an in-process work queue), checks
+# that the merged output holds every batch's result in order, and compares what fetching the results costs with and
+# without it: S3 requests and simulated time to download them with wiglaf.s3.download_files.
+
+import argparse
+import json
+import io
+import logging
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "wiglaf", "node"))
+
+import agent
+import reducer
+import wiglaf.s3
+import work_queue
+from fakes import FakeEC2, FakeS3
+
+def no_metadata(path):
+    # As on an on-demand instance with nothing to report: no interruption notice or rebalance recommendation.
+    raise LookupError(path)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches",
+                        help='Number of batches in the job.',
+                        type=int,
+                        default=200)
+    parser.add_argument("--nodes",
+                        help='Number of node agents.',
+                        type=int,
+                        default=3)
+    parser.add_argument("--slots",
+                        help='ConcurrencyPerNode.',
+                        type=int,
+                        default=4)
+    parser.add_argument("--type",
+                        help='Reduce Type.',
+                        choices=reducer.REDUCE_TYPES,
+                        default="concatenate")
+    parser.add_argument("--fan-in",
+                        help='Reduce FanIn.  By default one reducer merges everything.',
+                        type=int,
+                        default=None)
+    parser.add_argument("--latency",
+                        help='Simulated per-request S3 latency in seconds.',
+                        type=float,
+                        default=0.02)
+    return parser.parse_args()
+
+def fetch(s3, prefix, directory):
+    s3.calls.clear()
+    stats = wiglaf.s3.download_files("bench", prefix, directory, concurrency=16, s3=s3)
+    return stats["files"], s3.call_count, stats["seconds"]
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARN)
+    s3 = FakeS3(latency=args.latency, bandwidth=100 * 1024 * 1024)
+    reduce = {"Type":args.type}
+    if args.type == "command":
+        # Sorts lines, which gives the same result whether it's fed batch outputs or its own.
+        reduce["Commands"] = ["cat inputs/* | sort -n > out.txt"]
+    if args.fan_in:
+        reduce["FanIn"] = args.fan_in
+    manifest = {
+        "JobName":"bench",
+        "NumberOfBatches":args.batches,
+        "ConcurrencyPerNode":args.slots,
+        "CommandsToRun":["echo $WIGLAF_BATCH > out.txt"],
+        "FilesToUpload":["out.txt"],
+        "CommandTimeoutSeconds":60,
+        "LeaseSeconds":3,
+        "Reduce":reduce
+    }
+    reducer.check(manifest)
+    s3.objects[agent.CURRENT_MANIFEST_KEY] = json.dumps(manifest).encode("utf-8")
+    workdir = tempfile.mkdtemp()
+    try:
+        queue = work_queue.LocalWorkQueue()
+        nodes = []
+        for n in range(args.nodes):
+            directory = os.path.join(workdir, "node{}".format(n))
+            os.makedirs(directory)
+            nodes.append(agent.Agent("bench", "unused", instance_id="i-{:08x}".format(n), s3=s3, ec2=FakeEC2(), queue=queue,
+                                     work_directory=os.path.join(directory, "work"), slot_directory=os.path.join(directory, "slots"),
+                                     cache_directory=os.path.join(directory, "cache"), log_directory=directory, metadata=no_metadata))
+        start = time.perf_counter()
+        threads = [threading.Thread(target=node.run) for node in nodes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print("job with a {} reduce over {} levels ({} reducers) took {:.2f}s".format(
+            args.type, len(reducer.levels(manifest)), sum(reducer.levels(manifest)), time.perf_counter() - start))
+
+        name = reducer.output_name(manifest, "out.txt")
+        body = s3.objects["jobs/bench/results/reduced/{}".format(name)]
+        if args.type == "tar":
+            with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+                names = tar.getnames()
+            ok = names == ["out.txt.{}".format(b) for b in range(args.batches)]
+        else:
+            ok = body.decode("utf-8").split() == [str(b) for b in range(args.batches)]
+        print("merged output has every batch in order: {}".format(ok))
+
+        for label, prefix in [("every batch", "jobs/bench/results"), ("reduced", "jobs/bench/results/reduced")]:
+            directory = os.path.join(workdir, "download-{}".format(label.replace(" ", "-")))
+            files, calls, seconds = fetch(s3, prefix, directory)
+            print("fetching {:<12} {:>6} files {:>6} S3 requests {:7.2f}s".format(label, files, calls, seconds))
+        if not ok:
+            sys.exit(1)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
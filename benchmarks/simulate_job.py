@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+# Runs a whole job end to end against fakes of the AWS services (see fakes.FakeAWS), in real time:
+#   - the job is submitted with the CLI's start_job, which looks the cluster up in a FakeCloudFormation stack and
+#     uploads the resources and manifest to a FakeS3
+#   - every object written to the bucket is handed to the Lambda (lambda/handlers.py) as an S3 event, one per
+#     invocation or --event-batch-size at a time as with the stack's event queue.  Up to --lambda-concurrency
+#     invocations run at once, sharing the handler's module state as if they were all one warm container.
+#   - a stand-in for the autoscaling group launches node agents (wiglaf/node/agent.py) as threads to match the
+#     desired capacity the Lambda sets, --startup seconds after launch, and scales in nodes that aren't protected,
+#     replacing nodes that terminate themselves, as the real group would.  The nodes share the work queue and
+#     completion tracker through a FakeDynamoDB.
+#   - each batch sleeps for a made-up compute time (log-normal around --compute) and uploads a small result
+# It reports how long the job took from start_job to the finished notification, batch throughput, nodes
+# launched, Lambda invocations and their latency, and every call to each service by the CLI, the Lambda and the
+# nodes.  --save writes that as JSON, and --compare prints the differences from a report saved earlier, so runs
+# can be compared across commits.  Compute times are short and real, so 10,000 batches take a few minutes.
+# Everything runs in one process, so Lambda latencies include waiting on the nodes' threads for the interpreter;
+# compare them between runs rather than with a real Lambda.
+
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "wiglaf", "node"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+
+import agent
+import handlers
+import wiglaf.cloudformation
+import wiglaf.dispatch
+import wiglaf.s3
+import work_queue
+from fakes import FakeAWS, FakeAutoScaling, FakeS3
+
+BUCKET = "wiglaf-simulator-data"
+CLUSTER = "wiglaf-simulator"
+TABLE = "wiglaf-simulator-state"
+TOPIC = "arn:aws:sns:us-east-1:123456789012:wiglaf-simulator"
+# SQS gives up on a message after this many receives (the stack's redrive policy).
+MAX_RECEIVES = 3
+
+def no_metadata(path):
+    # As on an on-demand instance with nothing to report: no interruption notice or rebalance recommendation.
+    raise LookupError(path)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches",
+                        help='Number of batches in the job.',
+                        type=int,
+                        default=100)
+    parser.add_argument("--slots",
+                        help='ConcurrencyPerNode.',
+                        type=int,
+                        default=4)
+    parser.add_argument("--max-size",
+                        help='MaxSize of the cluster.',
+                        type=int,
+                        default=10)
+    parser.add_argument("--compute",
+                        help='Median seconds each batch computes for.',
+                        type=float,
+                        default=0.1)
+    parser.add_argument("--spread",
+                        help='Standard deviation of log compute time.',
+                        type=float,
+                        default=0.5)
+    parser.add_argument("--startup",
+                        help='Seconds from a node being launched to its agent starting.',
+                        type=float,
+                        default=1.0)
+    parser.add_argument("--lease",
+                        help='LeaseSeconds for the job.',
+                        type=int,
+                        default=5)
+    parser.add_argument("--event-batch-size",
+                        help='Hand the Lambda this many S3 events per invocation, as through the event queue.  0 invokes it once per event.',
+                        type=int,
+                        default=0)
+    parser.add_argument("--lambda-concurrency",
+                        help='How many Lambda invocations can run at once.',
+                        type=int,
+                        default=4)
+    parser.add_argument("--sizing-interval",
+                        help='Seconds between the Lambda\'s resizes of the cluster while results come in.',
+                        type=float,
+                        default=5)
+    parser.add_argument("--reduce",
+                        help='Give the job a reduce stage of this Type.',
+                        choices=["concatenate", "tar"],
+                        default=None)
+    parser.add_argument("--latency",
+                        help='Simulated per-request S3 latency in seconds.',
+                        type=float,
+                        default=0.002)
+    parser.add_argument("--timeout",
+                        help='Give up on the job after this many seconds.',
+                        type=float,
+                        default=1800)
+    parser.add_argument("--progress",
+                        help='Print progress to stderr every this many seconds.',
+                        type=float,
+                        default=None)
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0)
+    parser.add_argument("--save",
+                        help='Write the report to this JSON file.')
+    parser.add_argument("--compare",
+                        help='A report saved with --save to compare this run against.')
+    return parser.parse_args()
+
+class SimulatedLambda(object):
+    """
+    Takes the bucket's object-created notifications and feeds them to the handler from concurrency threads.
+    """
+
+    def __init__(self, batch_size, concurrency):
+        self.batch_size = batch_size
+        self.events = queue.Queue()
+        self.latencies = []
+        self.dead_letters = 0
+        self.backlog = 0
+        self.running = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(concurrency)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+
+    def notify(self, bucket, key):
+        self.events.put({"bucket":bucket, "key":key, "id":uuid.uuid4().hex, "receives":0})
+        self.backlog = max(self.backlog, self.events.qsize())
+
+    def event(self, messages):
+        records = [{"s3":{"bucket":{"name":m["bucket"]}, "object":{"key":m["key"]}}} for m in messages]
+        if not self.batch_size:
+            return {"Records":records}
+        return {"Records":[{"messageId":m["id"], "eventSource":"aws:sqs", "body":json.dumps({"Records":[r]})} for m, r in zip(messages, records)]}
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                messages = [self.events.get(timeout=0.05)]
+            except queue.Empty:
+                continue
+            while len(messages) < max(self.batch_size, 1):
+                try:
+                    messages.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+            with self.lock:
+                self.running += 1
+            start = time.perf_counter()
+            try:
+                response = handlers.lambda_handler(self.event(messages), None) or {}
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+                with self.lock:
+                    self.running -= 1
+            failed = set(f["itemIdentifier"] for f in response.get("batchItemFailures", []))
+            for message in messages:
+                if message["id"] in failed:
+                    message["receives"] += 1
+                    if message["receives"] < MAX_RECEIVES:
+                        self.events.put(message)
+                    else:
+                        self.dead_letters += 1
+
+    def idle(self):
+        return self.events.empty() and not self.running
+
+class Node(object):
+    def __init__(self, instance_id):
+        self.instance_id = instance_id
+        self.agent = None
+        self.cancelled = threading.Event()
+        self.thread = None
+
+class SimulatedGroup(object):
+    """
+    Does what the autoscaling service does with the group: keeps as many nodes running as its desired capacity,
+    launching new ones (which boot after startup seconds) and scaling in ones that aren't protected.
+    """
+
+    def __init__(self, aws, workdir, startup):
+        self.aws = aws
+        self.workdir = workdir
+        self.startup = startup
+        self.nodes = []
+        self.threads = []
+        self.launched = 0
+        self.scaled_in = 0
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def boot(self, node):
+        if node.cancelled.wait(self.startup):
+            return
+        directory = os.path.join(self.workdir, node.instance_id)
+        os.makedirs(directory)
+        node.agent = agent.Agent(BUCKET, TABLE, instance_id=node.instance_id, s3=self.aws.client("s3", "nodes"), ec2=self.aws.client("ec2", "nodes"),
+                                 queue=work_queue.DynamoWorkQueue(TABLE, client=self.aws.client("dynamodb", "nodes")),
+                                 work_directory=os.path.join(directory, "work"), slot_directory=os.path.join(directory, "slots"),
+                                 cache_directory=os.path.join(directory, "cache"), log_directory=directory, metadata=no_metadata,
+                                 baked_file=os.path.join(directory, "baked.json"))
+        if node.cancelled.is_set():
+            return
+        try:
+            node.agent.run()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def launch(self):
+        node = Node("i-{}".format(uuid.uuid4().hex[:17]))
+        self.aws.ec2.instances[node.instance_id] = {"InstanceId":node.instance_id, "State":{"Name":"running"}}
+        self.aws.autoscaling.instances.append(node.instance_id)
+        node.thread = threading.Thread(target=self.boot, args=(node,), daemon=True)
+        node.thread.start()
+        self.nodes.append(node)
+        self.threads.append(node.thread)
+        self.launched += 1
+
+    def remove(self, node):
+        self.nodes.remove(node)
+        self.aws.autoscaling.instances.remove(node.instance_id)
+        self.aws.autoscaling.protected.discard(node.instance_id)
+        self.aws.ec2.instances[node.instance_id]["State"] = {"Name":"terminated"}
+
+    def reconcile(self):
+        for node in list(self.nodes):
+            if not node.thread.is_alive() or self.aws.ec2.instances[node.instance_id]["State"]["Name"] == "terminated":
+                self.remove(node)
+        desired = self.aws.autoscaling.desired_capacity
+        while len(self.nodes) < desired:
+            self.launch()
+        # Scale-in leaves protected nodes alone, and takes ones that haven't started yet first, then the newest.
+        candidates = [n for n in reversed(self.nodes) if n.instance_id not in self.aws.autoscaling.protected]
+        candidates.sort(key=lambda n: n.agent is not None)
+        for node in candidates[:max(0, len(self.nodes) - desired)]:
+            node.cancelled.set()
+            if node.agent:
+                # Stands in for the instance going away: it takes no more batches, though it still flushes its
+                # uploads and logs and terminates itself.
+                node.agent.draining.set()
+            self.remove(node)
+            self.scaled_in += 1
+        self.peak = max(self.peak, len(self.nodes))
+
+    def run(self):
+        while not self.stopped.wait(0.05):
+            self.reconcile()
+
+    def busy(self):
+        # Including nodes that have left the group but are still winding down.
+        return any(thread.is_alive() for thread in self.threads)
+
+def compute_times(args):
+    rng = random.Random(args.seed)
+    return [rng.lognormvariate(math.log(args.compute), args.spread) for _ in range(args.batches)]
+
+def write_job(args, directory):
+    with open(os.path.join(directory, "durations.txt"), "w") as f:
+        f.write("".join("{:.3f}\n".format(t) for t in compute_times(args)))
+    manifest = {
+        "JobName":"simulated",
+        "NumberOfBatches":args.batches,
+        "ConcurrencyPerNode":args.slots,
+        "LocalDirectory":directory,
+        "FilesToDownload":["durations.txt"],
+        "CommandsToRun":['sleep "$(sed -n "$((WIGLAF_BATCH + 1))p" durations.txt)" && echo $WIGLAF_BATCH > out.txt'],
+        "FilesToUpload":["out.txt"],
+        "CommandTimeoutSeconds":600,
+        "LeaseSeconds":args.lease,
+        "NodeStartupSeconds":args.startup
+    }
+    if args.reduce:
+        manifest["Reduce"] = {"Type":args.reduce}
+    path = os.path.join(directory, "manifest.json")
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=4)
+    return path
+
+def make_aws(args, lambda_):
+    aws = FakeAWS(s3=FakeS3(latency=args.latency, bandwidth=100 * 1024 * 1024, on_put=lambda bucket, key: lambda_.notify(bucket, key)),
+                  autoscaling=FakeAutoScaling(asg_name="{}-asg".format(CLUSTER), max_size=args.max_size))
+    aws.cloudformation.add_stack(CLUSTER, {"ImageId":"ami-simulated", "InstanceType":"c5.large", "MaxInstanceCount":str(args.max_size)},
+                                 {"DataBucket":BUCKET, "LambdaBucket":"wiglaf-simulator-lambda", "StateTable":TABLE,
+                                  "AutoScalingGroup":aws.autoscaling.asg_name})
+    return aws
+
+def setup_lambda(aws, args):
+    os.environ.update({"STACK_NAME":CLUSTER, "STATE_TABLE":TABLE, "SNS_TOPIC":TOPIC})
+    handlers._clients.clear()
+    handlers._clients.update({service:aws.client(service, "lambda") for service in aws.services})
+    handlers._tracker = None
+    handlers._asg_name = None
+    for state in [handlers._finished_jobs, handlers._manifests, handlers._sized_jobs]:
+        state.clear()
+    handlers.SIZING_INTERVAL_SECONDS = args.sizing_interval
+
+def progress(aws, group, lambda_, seconds):
+    finished = int(aws.dynamodb.items.get("jobs/simulated", {}).get("Finished", {"N":"0"})["N"])
+    return "{:7.1f}s: {} batches finished, {} nodes ({} desired), {} events waiting for the Lambda".format(
+        seconds, finished, len(group.nodes), aws.autoscaling.desired_capacity, lambda_.events.qsize())
+
+def simulate(args):
+    workdir = tempfile.mkdtemp()
+    lambda_ = SimulatedLambda(args.event_batch_size, args.lambda_concurrency)
+    aws = make_aws(args, lambda_)
+    setup_lambda(aws, args)
+    group = SimulatedGroup(aws, os.path.join(workdir, "nodes"), args.startup)
+    wiglaf.cloudformation.STACK_CACHE_DIRECTORY = os.path.join(workdir, "stacks")
+    job_directory = os.path.join(workdir, "job")
+    os.makedirs(job_directory)
+    manifest_path = write_job(args, job_directory)
+    lambda_.start()
+    group.thread.start()
+    finished = None
+    try:
+        # The CLI's clients are whatever boto3.client returns, and the session is never set up for real.
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+             mock.patch("boto3.client", lambda service, *a, **kw: aws.client(service, "cli")), mock.patch("boto3.setup_default_session"):
+            start = time.perf_counter()
+            wiglaf.dispatch.Wiglaf(profile="wiglaf-simulator", region="us-east-1", cluster_name=CLUSTER, manifest=manifest_path).start_job()
+            submitted = time.perf_counter() - start
+            # The CLI turns logging up, but the nodes' per-batch logging would drown the report.
+            logging.getLogger().setLevel(logging.ERROR)
+            last_progress = 0
+            while time.perf_counter() - start < args.timeout:
+                if aws.sns.messages and finished is None:
+                    finished = time.perf_counter() - start
+                if args.progress and time.perf_counter() - last_progress >= args.progress:
+                    last_progress = time.perf_counter()
+                    print(progress(aws, group, lambda_, last_progress - start), file=sys.stderr)
+                if finished is not None and not group.busy() and lambda_.idle():
+                    break
+                time.sleep(0.05)
+            settled = time.perf_counter() - start
+    finally:
+        group.stopped.set()
+        for node in group.nodes:
+            node.cancelled.set()
+            if node.agent:
+                node.agent.draining.set()
+        lambda_.stop()
+        wiglaf.s3._clients.clear()
+        shutil.rmtree(workdir, ignore_errors=True)
+    results = [k for k in aws.s3.objects if k.startswith("jobs/simulated/results/") and "/reduced/" not in k and not k.endswith(handlers.RESULTS_FILE)]
+    batches = set(int(k.rsplit(".", 2)[1]) for k in results)
+    latencies = sorted(lambda_.latencies) or [0]
+    return {
+        "parameters":{k:v for k, v in vars(args).items() if k not in ("save", "compare", "progress")},
+        "finished":finished is not None and len(batches) == args.batches,
+        "seconds_to_submit":round(submitted, 3),
+        "seconds_to_finish":round(finished, 3) if finished is not None else None,
+        "seconds_to_settle":round(settled, 3),
+        "batches_per_second":round(args.batches / finished, 3) if finished else None,
+        "compute_seconds":round(sum(compute_times(args)), 3),
+        "nodes":{"launched":group.launched, "scaled_in":group.scaled_in, "peak":group.peak},
+        "lambda":{"invocations":len(lambda_.latencies), "dead_letters":lambda_.dead_letters, "peak_backlog":lambda_.backlog,
+                  "p50_ms":round(latencies[len(latencies) // 2] * 1000, 3), "p99_ms":round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+                  "total_seconds":round(sum(lambda_.latencies), 3)},
+        "calls":aws.call_counts(),
+    }
+
+def flatten(report, prefix=""):
+    flat = {}
+    for key, value in report.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+def print_report(report):
+    print("finished: {}  start_job {:.2f}s, job {}s, settled {:.2f}s, {} batches/s ({:.1f}s of compute)".format(
+        report["finished"], report["seconds_to_submit"], report["seconds_to_finish"], report["seconds_to_settle"],
+        report["batches_per_second"], report["compute_seconds"]))
+    print("nodes: {launched} launched, {scaled_in} scaled in, {peak} at most".format(**report["nodes"]))
+    print("lambda: {invocations} invocations, p50 {p50_ms:.2f}ms, p99 {p99_ms:.2f}ms, {total_seconds:.2f}s in all, at most {peak_backlog} events waiting, {dead_letters} dead letters".format(**report["lambda"]))
+    print("{:<8} {:<16} {:<32} {:>8}".format("caller", "service", "operation", "calls"))
+    for caller, services in sorted(report["calls"].items()):
+        for service, operations in sorted(services.items()):
+            for operation, count in sorted(operations.items()):
+                print("{:<8} {:<16} {:<32} {:>8}".format(caller, service, operation, count))
+    for caller, services in sorted(report["calls"].items()):
+        print("{:<8} total {:>8} calls, {:.1f} per batch".format(caller, sum(sum(o.values()) for o in services.values()),
+                                                               sum(sum(o.values()) for o in services.values()) / float(report["parameters"]["batches"])))
+
+def print_comparison(report, baseline):
+    before, after = flatten(baseline), flatten(report)
+    print("{:<56} {:>12} {:>12} {:>9}".format("compared with " + os.path.basename(baseline.get("_path", "baseline")), "before", "after", "change"))
+    for key in sorted(set(before) | set(after)):
+        if key.startswith("parameters."):
+            continue
+        old, new = before.get(key, 0), after.get(key, 0)
+        if old == new:
+            continue
+        change = "{:+.0f}%".format(100.0 * (new - old) / old) if old else "new"
+        print("{:<56} {:>12} {:>12} {:>9}".format(key, old, new, change))
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    report = simulate(args)
+    print_report(report)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        baseline["_path"] = args.compare
+        if baseline["parameters"] != report["parameters"]:
+            print("Warning: {} was run with different parameters.".format(args.compare))
+        print_comparison(report, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if not report["finished"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
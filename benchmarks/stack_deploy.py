@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Creates and then updates a cluster's stack with launch_cluster_stack against a FakeCloudFormation on a virtual
+# clock, so that minutes of CloudFormation take no time, and compares it with how it used to deploy: a stack without
+# the Lambda, then an update adding it, then another adding the data bucket's notifications, each followed by
+# describing the stack every 5 seconds.  Reports how long each took in (simulated) CloudFormation time, the time
+# from a stack finishing to wiglaf noticing, and CloudFormation calls.  Also checks that creating the function and the
+# notifications together really does need the bucket to wait for the function's permission.
+
+import argparse
+import copy
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from unittest import mock
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import wiglaf.cloudformation
+import wiglaf.s3
+from fakes import FakeCloudFormation, FakeS3, VirtualClock
+
+CLUSTER = "wiglaf-benchmark"
+LEGACY_POLL_SECONDS = 5
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs",
+                        help='Deploys of each kind, with resources taking different times.',
+                        type=int,
+                        default=20)
+    parser.add_argument("--jitter",
+                        help='How much each resource\'s time varies, as a fraction of it.',
+                        type=float,
+                        default=0.3)
+    parser.add_argument("--event-batch-size",
+                        help='Cluster EventBatchSize: 0 for notifications straight to the Lambda, more for a queue.',
+                        type=int,
+                        default=0)
+    return parser.parse_args()
+
+class Account(object):
+    """
+    A FakeCloudFormation and FakeS3 behind boto3.client, with wiglaf.cloudformation on the virtual clock.
+    """
+
+    def __init__(self, workdir, jitter=0, seed=None):
+        self.clock = VirtualClock()
+        self.cf = FakeCloudFormation(clock=self.clock, jitter=jitter, seed=seed)
+        self.s3 = FakeS3()
+        self.patches = [
+            mock.patch("boto3.client", lambda service, *args, **kwargs: {"cloudformation":self.cf, "s3":self.s3}[service]),
+            mock.patch.object(wiglaf.cloudformation, "time", self.clock),
+            mock.patch.object(wiglaf.cloudformation, "STACK_CACHE_DIRECTORY", os.path.join(workdir, "stacks")),
+        ]
+
+    def __enter__(self):
+        wiglaf.s3._clients.clear()
+        for patch in self.patches:
+            patch.start()
+        return self
+
+    def __exit__(self, *args):
+        for patch in self.patches:
+            patch.stop()
+        wiglaf.s3._clients.clear()
+
+    def stack_seconds(self, since):
+        """
+        How long each stack operation since then took, by the stack's events.
+        """
+        operations, started = [], None
+        for event in sorted(self.cf.stacks[CLUSTER]["Events"], key=lambda e: e["_time"]):
+            if event["ResourceType"] != "AWS::CloudFormation::Stack" or event["_time"] < since:
+                continue
+            if event["ResourceStatus"] in wiglaf.cloudformation.OPERATION_STARTS:
+                started = event["_time"]
+            elif not event["ResourceStatus"].endswith("_IN_PROGRESS"):
+                operations.append(event["_time"] - started)
+        return operations
+
+def legacy_wait(cf, clock):
+    while True:
+        status = cf.describe_stacks(StackName=CLUSTER)["Stacks"][0]["StackStatus"]
+        if not status.endswith("_IN_PROGRESS"):
+            return status
+        clock.sleep(LEGACY_POLL_SECONDS)
+
+def legacy_template(template):
+    # The template as it was: no function (so no permission or notifications) until there's a LambdaS3Key.
+    legacy = copy.deepcopy(template)
+    resources = legacy["Resources"]
+    legacy["Conditions"]["EventQueueFunction"] = {"Fn::And":[{"Condition":"LambdaS3KeyProvided"},{"Condition":"EventQueueEnabled"}]}
+    properties = resources["Function"]["Properties"]
+    properties["Code"] = properties["Code"]["Fn::If"][1]
+    properties["Handler"] = properties["Handler"]["Fn::If"][1]
+    resources["Function"]["Condition"] = "LambdaS3KeyProvided"
+    resources["Permission"]["Condition"] = "LambdaS3KeyProvided"
+    resources["EventSourceMapping"]["Condition"] = "EventQueueFunction"
+    del resources["DataBucket"]["Metadata"]
+    notifications = resources["DataBucket"]["Properties"]["NotificationConfiguration"]
+    resources["DataBucket"]["Properties"]["NotificationConfiguration"] = {"Fn::If":["LambdaS3KeyProvided", notifications, {"Ref":"AWS::NoValue"}]}
+    return legacy
+
+def legacy_launch(account, template, params, lambda_key, skip_create):
+    # What launch_cluster_stack did before: three stack operations (two when updating), waited on by polling.
+    cf, clock = account.cf, account.clock
+    params = dict(params)
+    template = legacy_template(template)
+    transitional = copy.deepcopy(template)
+    del transitional["Resources"]["DataBucket"]["Properties"]["NotificationConfiguration"]
+
+    def parameters():
+        return [{"ParameterKey":k, "ParameterValue":v} for k, v in params.items() if v]
+
+    if skip_create:
+        legacy_wait(cf, clock)
+    else:
+        cf.create_stack(StackName=CLUSTER, TemplateBody=json.dumps(transitional), Parameters=parameters())
+        legacy_wait(cf, clock)
+    params["LambdaS3Key"] = lambda_key
+    for body in [transitional, template]:
+        try:
+            cf.update_stack(StackName=CLUSTER, TemplateBody=json.dumps(body), Parameters=parameters())
+        except cf.exceptions.ClientError as e:
+            if "No updates are to be performed" not in str(e):
+                raise
+        status = legacy_wait(cf, clock)
+        if status != "UPDATE_COMPLETE":
+            raise RuntimeError("Legacy deploy ended in {}".format(status))
+
+def run(name, workdir, launch, jitter, seed):
+    """
+    Creates the cluster, then updates it with new Lambda code.  Returns a row for each.
+    """
+    with Account(os.path.join(workdir, "{}.{}".format(name, seed)), jitter=jitter, seed=seed) as account:
+        rows = []
+        for label, code in [("create", b"lambda code"), ("update", b"new lambda code")]:
+            account.cf.calls.clear()
+            start = account.clock.time()
+            with mock.patch("calvin.aws.lambda_deployment.create_zipfile", lambda directory: code):
+                timings = launch(account, code, label == "update")
+            seconds = account.clock.time() - start
+            operations = account.stack_seconds(start)
+            rows.append((label, seconds, len(operations), sum(operations), dict(account.cf.calls), timings))
+            account.clock.sleep(3600)
+        return rows
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARN)
+    os.chdir(ROOT)
+    template = wiglaf.cloudformation.cluster_template()
+    params = {"ClusterName":CLUSTER, "ImageId":"ami-benchmark", "InstanceType":"c5.large", "MaxInstanceCount":"10",
+              "EventBatchSize":str(args.event_batch_size)}
+    workdir = tempfile.mkdtemp()
+    try:
+        def current(account, code, skip_create):
+            return wiglaf.cloudformation.launch_cluster_stack(CLUSTER, image_id="ami-benchmark", instance_type="c5.large", max_size="10",
+                                                              event_batch_size=args.event_batch_size, skip_create=skip_create,
+                                                              profile="benchmark", region="us-east-1")
+
+        def legacy(account, code, skip_create):
+            legacy_launch(account, template, params, "lambda.{}.zip".format(hashlib.md5(code).hexdigest()), skip_create)
+
+        results = {name:[run(name, workdir, launch, args.jitter, seed) for seed in range(args.runs)]
+                   for name, launch in [("before", legacy), ("after", current)]}
+        # Anything that isn't a stack operation takes no simulated time, so the rest is time spent noticing they'd finished.
+        print("means of {} runs".format(args.runs))
+        print("{:<7} {:<7} {:>10} {:>12} {:>11} {:>11} {:>9}".format("", "", "seconds", "operations", "in stacks", "noticing", "CF calls"))
+        for name in ["before", "after"]:
+            for i, label in enumerate(["create", "update"]):
+                rows = [runs[i] for runs in results[name]]
+                seconds = sum(r[1] for r in rows) / len(rows)
+                stack_seconds = sum(r[3] for r in rows) / len(rows)
+                print("{:<7} {:<7} {:>9.0f}s {:>12} {:>10.0f}s {:>10.1f}s {:>9.0f}".format(
+                    name, label, seconds, rows[0][2], stack_seconds, seconds - stack_seconds, sum(sum(r[4].values()) for r in rows) / len(rows)))
+        for label, _, _, _, calls, timings in results["after"][0]:
+            print()
+            print(wiglaf.cloudformation.format_timings(CLUSTER, timings))
+            print("  calls: " + ", ".join("{} {}".format(k, v) for k, v in sorted(calls.items())))
+
+        # Without the bucket waiting for the permission, S3 may be asked to send to the function before it's allowed.
+        with Account(os.path.join(workdir, "undepended")) as account:
+            undepended = copy.deepcopy(template)
+            del undepended["Resources"]["DataBucket"]["Metadata"]
+            account.cf.create_stack(StackName=CLUSTER, TemplateBody=json.dumps(undepended),
+                                    Parameters=[{"ParameterKey":k, "ParameterValue":v} for k, v in params.items()])
+            status = legacy_wait(account.cf, account.clock)
+        print()
+        print("creating the stack without the bucket depending on the permission: {}".format(status))
+        if status == "CREATE_COMPLETE":
+            sys.exit(1)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
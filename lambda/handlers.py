@@ -4,195 +4,468 @@ print("Function loading.")
 
 import boto3
 from datetime import datetime, timedelta, timezone
+import gzip
 import json
 import os
+import time
 import traceback
+import sizing
+import tracker
+import wiglaf.node.reducer
+import wiglaf.profiling
+import wiglaf.result_keys
+
+RESULTS_FILE = "wiglaf_results.json"
+# The results index is written in shards of this many entries, to jobs/<job>/results-index/ (outside results/, so
+# that writing it doesn't set off more result events).  Matches wiglaf/results.py, which reads it.
+RESULTS_INDEX_FORMAT = 1
+INDEX_SHARD_SIZE = 10000
+# Matches CURRENT_MANIFEST_KEY in wiglaf/node/agent.py.
+CURRENT_MANIFEST_KEY = "wiglaf/current_manifest.json"
+NODE_LAUNCHER = """#!/bin/bash
+AZ=$(curl -s http://169.254.169.254/latest/meta-data/placement/availability-zone)
+export AWS_DEFAULT_REGION=${AZ::-1}
+mkdir -p /opt/wiglaf
+aws s3 cp --recursive s3://$Bucket/wiglaf/node/ /opt/wiglaf/
+python3 /opt/wiglaf/agent.py --bucket $Bucket --table $StateTable 2>&1 | tee -a /var/log/wiglaf-agent.log
+"""
+
+ASG_NAME_TTL = 60 * 60
+# Once a job has finished, results that straggle in within this long don't stop the cluster again.
+FINISHED_DEBOUNCE_SECONDS = 5 * 60
+# How long an invocation has to finish a job before a retry can take over.  Longer than the function's Timeout (see
+# wiglaf/cloudformation/templates.py), so that a claim only runs out once whoever held it is gone.
+COMPLETION_LEASE_SECONDS = 150
+TERMINATE_BATCH_SIZE = 1000
+# While results are coming in, a warm container re-sizes the cluster at most this often per job.
+SIZING_INTERVAL_SECONDS = 60
+# The most instances set_instance_protection takes at once.
+PROTECTION_BATCH_SIZE = 50
+MANIFEST_TTL = 10 * 60
+DELETE_BATCH_SIZE = 1000
+# Matches JOB_INDEX in wiglaf/node/work_queue.py: the state table's index of each job's batches and reducers.
+JOB_INDEX = "JobIndex"
+
+_clients = {}
+_tracker = None
+_asg_name = None
+# {job name: when this container saw it finish}
+_finished_jobs = {}
+# {job name: (manifest, when it was read)} and {job name: when this container last re-sized the cluster for it}
+_manifests = {}
+_sized_jobs = {}
+# Set WIGLAF_PROFILE in the function's environment to log the API calls each invocation makes.
+_profile = wiglaf.profiling.CallProfile() if os.getenv("WIGLAF_PROFILE") else None
 
 def cluster_name():
     return os.getenv("CLUSTER_NAME", os.getenv("STACK_NAME"))
 
-def lambda_handler(event, context):
-    for record in event["Records"]:
+def client(name):
+    # Clients are kept around so that warm containers don't pay for setting them up on every event.
+    if name not in _clients:
+        _clients[name] = boto3.client(name)
+        if _profile is not None:
+            _profile.attach(_clients[name].meta.events)
+    return _clients[name]
+
+def completion_tracker():
+    global _tracker
+    if _tracker is None:
+        _tracker = tracker.DynamoCompletionTracker(os.environ["STATE_TABLE"], client=client("dynamodb"))
+    return _tracker
+
+def iter_records(event):
+    """
+    Yields (message id, S3 record) for every S3 record in an event.  Events come straight from S3, or (when the
+    stack has an event queue) from SQS, with S3 notifications as the message bodies.  Message ids are None for
+    records that didn't come through the queue.
+    """
+    for record in event.get("Records", []):
+        if record.get("eventSource") == "aws:sqs":
+            body = json.loads(record["body"])
+            # S3 sends a test event (with no records) when the queue is first hooked up.
+            for s3_record in body.get("Records", []):
+                yield record["messageId"], s3_record
+        else:
+            yield None, record
+
+def group_records(event):
+    """
+    Sorts an event's records into the work they need, so that a burst of uploads costs a constant amount of work
+    per job rather than per file.  Returns (manifests, results, terminations), each mapping what needs doing to the
+    ids of the messages it came from:
+      manifests: {bucket: ids}, as only the current manifest.json needs reading, however many times it was written
+      results: {(bucket, job name): {result key: ids}}
+      terminations: {bucket: {terminate key: ids}}
+    """
+    manifests, results, terminations = {}, {}, {}
+    for message_id, record in iter_records(event):
         try:
             obj_key = record["s3"]["object"]["key"]
             bucket_name = record["s3"]["bucket"]["name"]
-            print("Handling {}/{}".format(bucket_name, obj_key))
-            if obj_key == "manifest.json":
-                print("Processing manifest.json file")
-                return process_manifest(bucket_name, obj_key)
-            elif obj_key.startswith("jobs/"):
-                if "/results/" in obj_key and not obj_key.endswith("/wiglaf_manifest.json"):
-                    # Example: jobs/foo/results/file.Rdata
-                    job_name = obj_key.split("/")[1] # foo
-                    print("Processing result for job {}".format(job_name))
-                    return process_result(bucket_name, job_name)
-                elif "/terminate/" in obj_key:
-                    # Example: jobs/foo/terminate/i-12345678
-                    instance_id = obj_key.split("/")[-1]
-                    print("Terminating instance {}".format(instance_id))
-                    boto3.client('ec2').terminate_instances(InstanceIds=[instance_id])
-                    boto3.client('s3').delete_object(Bucket=bucket_name, Key=obj_key)
-                    pass
-                else:
-                    print("We don't care about this object.")
-                    pass
+        except KeyError:
+            print("Not an S3 record: {}".format(json.dumps(record)))
+            continue
+        print("Handling {}/{}".format(bucket_name, obj_key))
+        if obj_key == "manifest.json":
+            manifests.setdefault(bucket_name, set()).add(message_id)
+        elif obj_key.startswith("jobs/"):
+            if obj_key.endswith("/results/" + RESULTS_FILE):
+                print("We don't care about this object.")
+            elif "/results/" in obj_key and not obj_key.endswith("/wiglaf_manifest.json"):
+                # Example: jobs/foo/results/file.Rdata.0.i-12345678
+                job_name = obj_key.split("/")[1] # foo
+                results.setdefault((bucket_name, job_name), {}).setdefault(obj_key, set()).add(message_id)
+            elif "/terminate/" in obj_key:
+                # Example: jobs/foo/terminate/i-12345678
+                terminations.setdefault(bucket_name, {}).setdefault(obj_key, set()).add(message_id)
             else:
                 print("We don't care about this object.")
-                pass
+        else:
+            print("We don't care about this object.")
+    return manifests, results, terminations
+
+def lambda_handler(event, context):
+    if _profile is None:
+        return handle_event(event)
+    _profile.reset()
+    try:
+        return handle_event(event)
+    finally:
+        print("API calls: {}".format(json.dumps(_profile.as_dict(request_id=getattr(context, "aws_request_id", None)), sort_keys=True)))
+
+def handle_event(event):
+    manifests, results, terminations = group_records(event)
+    work = [(process_manifest, (bucket_name, "manifest.json"), ids) for bucket_name, ids in manifests.items()]
+    for (bucket_name, job_name), keys in results.items():
+        print("Processing {} results for job {}".format(len(keys), job_name))
+        work.append((process_results, (bucket_name, job_name, sorted(keys)), set.union(*keys.values())))
+    for bucket_name, keys in terminations.items():
+        work.append((terminate_instances, (bucket_name, sorted(keys)), set.union(*keys.values())))
+    failed = set()
+    for function, args, ids in work:
+        try:
+            function(*args)
         except Exception as e:
             print("ERROR CAUGHT")
             traceback.print_exc()
+            failed |= ids
+    # With an event queue, just the messages that failed are retried (the tracker ignores results it has already
+    # counted).  S3 invokes the function asynchronously, so without one, failing the invocation has Lambda retry
+    # the whole event.
+    if None in failed:
+        raise RuntimeError("Couldn't handle every record in the event.")
+    return {"batchItemFailures":[{"itemIdentifier":message_id} for message_id in sorted(failed)]}
+
+def terminate_instances(bucket_name, obj_keys):
+    instance_ids = [obj_key.split("/")[-1] for obj_key in obj_keys]
+    print("Terminating instances {}".format(", ".join(instance_ids)))
+    ec2 = client('ec2')
+    for i in range(0, len(instance_ids), TERMINATE_BATCH_SIZE):
+        chunk = instance_ids[i:i+TERMINATE_BATCH_SIZE]
+        try:
+            ec2.terminate_instances(InstanceIds=chunk)
+        except ec2.exceptions.ClientError:
+            # One bad id fails the whole call, so don't let it keep the others running.
+            for instance_id in chunk:
+                try:
+                    ec2.terminate_instances(InstanceIds=[instance_id])
+                except ec2.exceptions.ClientError:
+                    traceback.print_exc()
+    s3 = client('s3')
+    for i in range(0, len(obj_keys), DELETE_BATCH_SIZE):
+        s3.delete_objects(Bucket=bucket_name, Delete={"Objects":[{"Key":k} for k in obj_keys[i:i+DELETE_BATCH_SIZE]], "Quiet":True})
 
 def process_manifest(bucket_name, obj_key):
-    s3 = boto3.client('s3')
+    s3 = client('s3')
     manifest_body = s3.get_object(Bucket=bucket_name, Key=obj_key)["Body"].read()
     manifest = json.loads(manifest_body.decode("utf-8"))
     job_name = manifest["JobName"]
-    script_lines = [
-        "#!/bin/bash",
-        "",
-        "InstanceId=$(curl -s http://169.254.169.254/latest/meta-data/instance-id)",
-        "mkdir -p /tmp/wiglaf",
-        "cd /tmp/wiglaf",
-        "echo \"$InstanceId\" > /tmp/$InstanceId",
-        ""]
-    checkpoints = {"__NEXT__":0}
-    def checkpoint(name,step=""):
-        if name not in checkpoints:
-            checkpoints[name] = checkpoints["__NEXT__"]
-            checkpoints["__NEXT__"] += 1
-        index = checkpoints[name]
-        key = "jobs/$JobName/checkpoints/$InstanceId.{index}-{name}-{step}".format(index=index, step=step, name=name)
-        return "date > /tmp/checkpoint && aws s3 cp /tmp/checkpoint s3://$Bucket/{key}".format(key=key)
-    script_lines.append(checkpoint("DownloadingFiles","begin"))
-    for filename in manifest["FilesToDownload"]:
-        script_lines.append("aws s3 cp s3://$Bucket/jobs/$JobName/resources/{filename} /tmp/wiglaf/{filename}".format(filename=filename))
-    script_lines.append(checkpoint("DownloadingFiles","end"))
-    if "InstallCommands" in manifest:
-        script_lines.append("echo \"Starting installation of dependencies at $(date)\"")
-        script_lines.append(checkpoint("InstallCommands","begin"))
-        for command in manifest["InstallCommands"]:
-            script_lines.append("echo Executing command \'{}\'".format(json.dumps(command)))
-            script_lines.append(command)
-        script_lines.append(checkpoint("InstallCommands","end"))
-        script_lines.append("echo \"Finished installation of dependencies at $(date)\"")
-    for iteration in range(manifest.get("RunsPerNode",1)):
-        script_lines.append("echo \"Starting execution #{} of commands at $(date)\"".format(iteration+1))
-        script_lines.append(checkpoint("CommandsToRun.{}".format(iteration),"begin"))
-        for command in manifest["CommandsToRun"]:
-            script_lines.append("echo Executing command \'{}\'".format(json.dumps(command)))
-            script_lines.append(command)
-        script_lines.append(checkpoint("CommandsToRun.{}".format(iteration),"end"))
-        script_lines.append("echo \"Finished execution #{} of commands at $(date)\"".format(iteration+1))
-        for filename in manifest["FilesToUpload"]:
-            script_lines.append("aws s3 cp /tmp/wiglaf/{filename} s3://$Bucket/jobs/$JobName/results/{filename}.{iteration}.$InstanceId".format(filename=filename, iteration=iteration))
-        for logfile in ["cloud-init.log","cloud-init-output.log","syslog"]:
-            script_lines.append("aws s3 cp /var/log/{logfile} s3://$Bucket/jobs/$JobName/logs/$InstanceId.{logfile}".format(logfile=logfile))
-    script_lines.append("AZ=$(curl -s http://169.254.169.254/latest/meta-data/placement/availability-zone)")
-    script_lines.append("REGION=v${AZ::-1}")
-    script_lines.append("aws s3 cp /tmp/$InstanceId s3://$Bucket/jobs/$JobName/terminate/$InstanceId")
-    script_lines.append("aws --region $REGION ec2 terminate-instances --instance-ids $InstanceId")
-    startup_script = "\n".join(script_lines)
-    startup_script = startup_script.replace("$Bucket",bucket_name).replace("$JobName",job_name)
-    s3.put_object(Bucket=bucket_name, Key="do_stuff.sh", Body=startup_script.encode("utf-8"))
+    # The nodes run the job with wiglaf/node/agent.py, which reads the manifest itself.  do_stuff.sh (which the
+    # instances' UserData runs) is the same for every job and just starts it.
+    startup_script = NODE_LAUNCHER.replace("$Bucket",bucket_name).replace("$StateTable",os.environ["STATE_TABLE"])
     s3.put_object(Bucket=bucket_name, Key="jobs/{job_name}/resources/wiglaf_manifest.json".format(job_name=job_name), Body=manifest_body)
+    s3.put_object(Bucket=bucket_name, Key=CURRENT_MANIFEST_KEY, Body=manifest_body)
+    s3.put_object(Bucket=bucket_name, Key="do_stuff.sh", Body=startup_script.encode("utf-8"))
+    completion_tracker().set_target(job_name, result_target(manifest))
+    _finished_jobs.pop(job_name, None)
+    _manifests[job_name] = (manifest, time.time())
+    _sized_jobs.pop(job_name, None)
     stop_cluster()
-    start_cluster()
+    start_cluster(manifest)
+
+def describe_group():
+    asg = client('autoscaling')
+    response = asg.describe_auto_scaling_groups(AutoScalingGroupNames=[get_asg_name()])
+    if not response["AutoScalingGroups"]:
+        # The cached name is out of date (the group was replaced), so look it up again.
+        response = asg.describe_auto_scaling_groups(AutoScalingGroupNames=[get_asg_name(refresh=True)])
+    return response["AutoScalingGroups"][0]
 
-def start_cluster(*args, **kwargs):
-    asg_name = get_asg_name()
-    asg = boto3.client('autoscaling')
-    response = asg.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
-    max_size = response["AutoScalingGroups"][0]["MaxSize"]
-    boto3.client('autoscaling').update_auto_scaling_group(AutoScalingGroupName=asg_name, DesiredCapacity=max_size)
+def start_cluster(manifest=None, *args, **kwargs):
+    group = describe_group()
+    desired = group["MaxSize"]
+    if manifest and manifest.get("AdaptiveSizing", True):
+        # No batch has run yet, so this is just enough nodes for every batch to get a slot.
+        desired = sizing.desired_capacity(manifest["NumberOfBatches"], slots_per_node(manifest), group["MaxSize"])
+    client('autoscaling').update_auto_scaling_group(AutoScalingGroupName=group["AutoScalingGroupName"], DesiredCapacity=desired)
 
 def stop_cluster(*args, **kwargs):
-    asg_name = get_asg_name()
-    asg = boto3.client('autoscaling')
-    boto3.client('autoscaling').update_auto_scaling_group(AutoScalingGroupName=asg_name, DesiredCapacity=0)
-
-def get_asg_name():
-    return boto3.client('autoscaling').describe_tags(Filters=[
-        {
-            "Name":"key",
-            "Values":["aws:cloudformation:stack-name"]
-        },
-        {
-            "Name":"value",
-            "Values":[os.environ['STACK_NAME']]
-        }
-    ])["Tags"][0]['ResourceId']
-
-def process_result(bucket_name, job_name, *args, **kwargs):
-    asg_name = get_asg_name()
-    sns_topic = os.getenv('SNS_TOPIC',None)
-    s3 = boto3.client('s3')
+    asg = client('autoscaling')
+    try:
+        asg.update_auto_scaling_group(AutoScalingGroupName=get_asg_name(), DesiredCapacity=0)
+    except asg.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ValidationError":
+            raise
+        asg.update_auto_scaling_group(AutoScalingGroupName=get_asg_name(refresh=True), DesiredCapacity=0)
+    # Nodes that resize_cluster protected would otherwise be left running.
+    group = describe_group()
+    protect_instances(group, [i["InstanceId"] for i in group["Instances"] if i.get("ProtectedFromScaleIn")], False)
 
-    manifest_key = "jobs/{job_name}/resources/wiglaf_manifest.json".format(job_name=job_name)
-    manifest_object = s3.get_object(Bucket=bucket_name, Key=manifest_key)
-    manifest = json.loads(manifest_object["Body"].read().decode("utf-8"))
+def protect_instances(group, instance_ids, protected):
+    for i in range(0, len(instance_ids), PROTECTION_BATCH_SIZE):
+        client('autoscaling').set_instance_protection(AutoScalingGroupName=group["AutoScalingGroupName"],
+                                                      InstanceIds=instance_ids[i:i+PROTECTION_BATCH_SIZE], ProtectedFromScaleIn=protected)
 
-    batch_count = manifest["NumberOfBatches"]
+def slots_per_node(manifest, running=None):
+    # With "auto", the Lambda can't know the nodes' size, so go by the most batches one node has been seen running.
+    concurrency = manifest.get("ConcurrencyPerNode", 1)
+    if concurrency != "auto":
+        return max(1, int(concurrency))
+    return max(list(running.values()) + [1]) if running else 1
 
-    result_aggregate_key = 'jobs/{job_name}/results/wiglaf_results.json'.format(job_name=job_name)
-    try:
-        obj = s3.get_object(
-            Bucket=bucket_name,
-            Key=result_aggregate_key
-        )
-        json.loads(obj['Body'].read().decode('utf-8'))
-        # If we get to this point, it means that the results.json file already exists, which means we're done.
-        stop_cluster()
+def result_target(manifest):
+    # Every batch uploads each of FilesToUpload once, and the last reducer (if there's a reduce stage) one of each
+    # of its Files, so that's how many distinct results finish the job.
+    target = manifest["NumberOfBatches"] * len(manifest["FilesToUpload"])
+    if manifest.get("Reduce"):
+        target += len(manifest["Reduce"].get("Files", manifest["FilesToUpload"]))
+    return target
+
+def job_manifest(bucket_name, job_name):
+    # Kept for MANIFEST_TTL, in case the job is submitted again under the same name through another container.
+    if job_name not in _manifests or time.time() - _manifests[job_name][1] > MANIFEST_TTL:
+        manifest_key = "jobs/{job_name}/resources/wiglaf_manifest.json".format(job_name=job_name)
+        manifest = json.loads(client('s3').get_object(Bucket=bucket_name, Key=manifest_key)["Body"].read().decode("utf-8"))
+        _manifests[job_name] = (manifest, time.time())
+    return _manifests[job_name][0]
+
+def work_queue_state(job_name):
+    """
+    Reads a job's batches and reducers from the nodes' work queue (see wiglaf/node/work_queue.py).  Returns the
+    number finished, {owner: batches and reducers it's running}, and how long each finished batch took.  Only the
+    job's own items are read, through the index, so this costs the same however much else is in the table.
+    """
+    kwargs = {
+        "TableName":os.environ["STATE_TABLE"],
+        "IndexName":JOB_INDEX,
+        "KeyConditionExpression":"#job = :job AND begins_with(Id, :prefix)",
+        "ExpressionAttributeNames":{"#job":"Job"},
+        "ExpressionAttributeValues":{":job":{"S":job_name}, ":prefix":{"S":"jobs/{}/".format(job_name)}}
+    }
+    now = time.time()
+    finished, running, durations = 0, {}, []
+    while True:
+        response = client('dynamodb').query(**kwargs)
+        for item in response.get("Items", []):
+            if "Done" in item:
+                finished += 1
+                if "ClaimedAt" in item and "DoneAt" in item and "/reduce/" not in item["Id"]["S"]:
+                    durations.append(int(item["DoneAt"]["N"]) - int(item["ClaimedAt"]["N"]))
+            elif "Owner" in item and int(item.get("LeaseExpires", {}).get("N", "0")) >= now:
+                running[item["Owner"]["S"]] = running.get(item["Owner"]["S"], 0) + 1
+        if not response.get("LastEvaluatedKey"):
+            return finished, running, durations
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+def resize_cluster(bucket_name, job_name):
+    """
+    Sets the group's desired capacity from the work the job has left (see sizing.py), and protects the nodes
+    running batches from scale-in, so that only idle ones are let go as the job drains.
+    """
+    manifest = job_manifest(bucket_name, job_name)
+    if not manifest.get("AdaptiveSizing", True):
         return
-    except:
-        pass
-
-    results_prefix = 'jobs/{job_name}/results/'.format(job_name=job_name)
-    response = s3.list_objects_v2(
-        Bucket=bucket_name,
-        MaxKeys=1000,
-        Prefix=results_prefix,
+    finished, running, durations = work_queue_state(job_name)
+    group = describe_group()
+    in_service = [i for i in group["Instances"] if i["LifecycleState"] == "InService"]
+    busy = set(i["InstanceId"] for i in group["Instances"] if i["InstanceId"] in running)
+    desired = sizing.desired_capacity(
+        remaining=manifest["NumberOfBatches"] + sum(wiglaf.node.reducer.levels(manifest)) - finished,
+        slots=slots_per_node(manifest, running),
+        max_size=group["MaxSize"],
+        batch_seconds=sorted(durations)[len(durations) // 2] if durations else None,
+        current=group["DesiredCapacity"],
+        busy=len(busy),
+        startup_seconds=manifest.get("NodeStartupSeconds", sizing.DEFAULT_STARTUP_SECONDS)
     )
-    objects = response['Contents']
-    token = response.get('NextContinuationToken', None)
-    while token:
-        response = s3.list_objects_v2(
-            Bucket=bucket_name,
-            MaxKeys=1000,
-            Prefix=results_prefix,
-            ContinuationToken=token
-        )
-        objects.extend(response['Contents'])
-        token = response.get('NextContinuationToken', None)
-    print("{} batches retrieved towards a goal of {}".format(len(objects), batch_count))
-    if len(objects) < batch_count:
+    protect_instances(group, sorted(i["InstanceId"] for i in in_service if i["InstanceId"] in busy and not i.get("ProtectedFromScaleIn")), True)
+    protect_instances(group, sorted(i["InstanceId"] for i in in_service if i["InstanceId"] not in busy and i.get("ProtectedFromScaleIn")), False)
+    print("{} of {} batches and reducers finished, {} nodes busy.  Desired capacity {} -> {}.".format(
+        finished, manifest["NumberOfBatches"] + sum(wiglaf.node.reducer.levels(manifest)), len(busy), group["DesiredCapacity"], desired))
+    if desired != group["DesiredCapacity"]:
+        client('autoscaling').update_auto_scaling_group(AutoScalingGroupName=group["AutoScalingGroupName"], DesiredCapacity=desired)
+
+def get_asg_name(refresh=False):
+    # The group only changes if the stack replaces it, so warm containers look it up once, and again after
+    # ASG_NAME_TTL in case it has been replaced.
+    global _asg_name
+    if refresh or _asg_name is None or time.time() - _asg_name[1] > ASG_NAME_TTL:
+        name = client('autoscaling').describe_tags(Filters=[
+            {
+                "Name":"key",
+                "Values":["aws:cloudformation:stack-name"]
+            },
+            {
+                "Name":"value",
+                "Values":[os.environ['STACK_NAME']]
+            }
+        ])["Tags"][0]['ResourceId']
+        _asg_name = (name, time.time())
+    return _asg_name[0]
+
+def process_results(bucket_name, job_name, obj_keys, *args, **kwargs):
+    result_keys = []
+    for obj_key in obj_keys:
+        result_key = obj_key.split("/results/", 1)[1]
+        if result_key.rsplit(".", 1)[-1].startswith("i-"):
+            # Results are named <file>.<batch>.<instance>.  If a batch gets re-run elsewhere after its lease expired,
+            # both copies are the same result, so the instance is left out when counting.
+            result_key = result_key.rsplit(".", 1)[0]
+        result_keys.append(result_key)
+
+    completions = completion_tracker()
+    batch_count_done, batch_count = completions.record_many(job_name, result_keys)
+    if batch_count is None:
+        # Job was submitted before completion tracking existed, so fall back to the manifest once.
+        manifest = job_manifest(bucket_name, job_name)
+        batch_count = result_target(manifest)
+        completions.set_target(job_name, batch_count)
+
+    print("{} batches retrieved towards a goal of {}".format(batch_count_done, batch_count))
+    if batch_count_done < batch_count:
         print("Not finished.  Keep cluster alive.")
-        pass
-    else:
-        print("Goal met.  Tearing down cluster.")
+        if time.time() - _sized_jobs.get(job_name, 0) >= SIZING_INTERVAL_SECONDS:
+            _sized_jobs[job_name] = time.time()
+            try:
+                resize_cluster(bucket_name, job_name)
+            except Exception:
+                # The results are recorded either way, so just try again next time.
+                traceback.print_exc()
+        return
+    if job_name in _finished_jobs and time.time() - _finished_jobs[job_name] < FINISHED_DEBOUNCE_SECONDS:
+        # This container has only just stopped the cluster for this job, so a straggler upload needn't do it again.
+        print("Job already finished.")
+        return
+    claim = completions.claim_completion(job_name, COMPLETION_LEASE_SECONDS)
+    if claim == tracker.FINISHED:
+        # Someone else already handled completion (or this is a straggler upload), so just make sure we're stopped.
+        stop_cluster()
+        _finished_jobs[job_name] = time.time()
+        return
+    if claim == tracker.IN_PROGRESS:
+        # Failing means this is tried again, by which time the other invocation has finished the job, or its claim
+        # has run out and this can take over.
+        raise RuntimeError("Job {} is being finished by another invocation.".format(job_name))
+    print("Goal met.  Tearing down cluster.")
+    try:
         stop_cluster()
-        links = [s3.generate_presigned_url(ClientMethod='get_object',Params={'Bucket':bucket_name,'Key':obj['Key']},ExpiresIn=60*60*24*7) for obj in objects]
-        body = json.dumps(links, indent=2, sort_keys=True).encode('utf-8')
-        s3.put_object(Body=body, Bucket=bucket_name, Key=result_aggregate_key)
-        if sns_topic:
-            start_dt = manifest_object["LastModified"]
-            end_dt = datetime.now(timezone.utc)
-            message_lines = [
-                "Job '{}' finished".format(job_name),
-                "",
-                "Cluster: {}".format(cluster_name()),
-                "",
-                "Started: {}".format(start_dt.strftime("%a %d %H:%M:%S UTC")),
-                "Ended: {}".format(end_dt.strftime("%a %d %H:%M:%S UTC")),
-                "Duration: {}".format(pretty_delta(end_dt - start_dt)),
-                "",
-                "Links to output files:",
-                ""
-            ] + [l+"\n" for l in links] + ["The above links are valid for ~7 days after when the job finished."]
-            message = '\n'.join(message_lines)
-            subject = "Job '{}' done".format(job_name)
-            boto3.client("sns").publish(TopicArn=sns_topic, Message=message, Subject=subject)
-    pass
+        finish_job(bucket_name, job_name)
+    except Exception:
+        completions.release_completion(job_name)
+        raise
+    # Only now, so that if anything above fails, a retry does all of it again.
+    completions.finish_completion(job_name)
+    _finished_jobs[job_name] = time.time()
+
+def finish_job(bucket_name, job_name):
+    sns_topic = os.getenv('SNS_TOPIC',None)
+    s3 = client('s3')
+    manifest_key = "jobs/{job_name}/resources/wiglaf_manifest.json".format(job_name=job_name)
+    manifest_object = s3.get_object(Bucket=bucket_name, Key=manifest_key)
+    manifest = json.loads(manifest_object["Body"].read().decode("utf-8"))
+    result_aggregate_key = 'jobs/{job_name}/results/{results_file}'.format(job_name=job_name, results_file=RESULTS_FILE)
+
+    summary = write_results_index(bucket_name, job_name)
+    summary.update({"Job":job_name, "Reduced":bool(manifest.get("Reduce"))})
+    s3.put_object(Body=json.dumps(summary, indent=2, sort_keys=True).encode('utf-8'), Bucket=bucket_name, Key=result_aggregate_key)
+    if sns_topic:
+        start_dt = manifest_object["LastModified"]
+        end_dt = datetime.now(timezone.utc)
+        # Just a summary, however big the job: links are made on demand by the CLI, from the index.
+        message_lines = [
+            "Job '{}' finished".format(job_name),
+            "",
+            "Cluster: {}".format(cluster_name()),
+            "",
+            "Started: {}".format(start_dt.strftime("%a %d %H:%M:%S UTC")),
+            "Ended: {}".format(end_dt.strftime("%a %d %H:%M:%S UTC")),
+            "Duration: {}".format(pretty_delta(end_dt - start_dt)),
+            "",
+            "Results: {} files, {}".format(summary["Files"], pretty_size(summary["Bytes"])),
+        ]
+        if summary["Reduced"]:
+            message_lines.append("Merged by the reduce stage: {}".format(", ".join(summary["ReducedFiles"])))
+        message_lines += [
+            "",
+            "To list them with download links:",
+            "  wiglaf --list-results --presign --cluster-name {} --job-name {}".format(cluster_name(), job_name),
+            "To download them:",
+            "  wiglaf --download-results --cluster-name {} --job-name {}".format(cluster_name(), job_name),
+        ]
+        message = '\n'.join(message_lines)
+        subject = "Job '{}' done".format(job_name)
+        client("sns").publish(TopicArn=sns_topic, Message=message, Subject=subject)
+
+def write_results_index(bucket_name, job_name):
+    """
+    Lists a job's results into gzipped JSON-lines shards of {key, size, etag, batch, instance}, with keys relative
+    to the results prefix.  Returns a summary with the shard keys, which goes in wiglaf_results.json.  Only one
+    shard is held in memory at a time.
+    """
+    results_prefix = "jobs/{}/results/".format(job_name)
+    summary = {"Format":RESULTS_INDEX_FORMAT, "Files":0, "Bytes":0, "Shards":[], "ReducedFiles":[]}
+    lines = []
+
+    def flush():
+        key = "jobs/{}/results-index/{:05d}.jsonl.gz".format(job_name, len(summary["Shards"]))
+        client('s3').put_object(Bucket=bucket_name, Key=key, Body=gzip.compress(("\n".join(lines) + "\n").encode("utf-8")),
+                                ContentType="application/x-ndjson", ContentEncoding="gzip")
+        summary["Shards"].append(key)
+        del lines[:]
+
+    for obj in iter_objects(bucket_name, results_prefix):
+        result_key = obj["Key"][len(results_prefix):]
+        if result_key == RESULTS_FILE:
+            continue
+        batch, instance = wiglaf.result_keys.parse_result_key(result_key)
+        lines.append(json.dumps({"key":result_key, "size":obj["Size"], "etag":obj["ETag"].strip('"'), "batch":batch, "instance":instance}, sort_keys=True))
+        summary["Files"] += 1
+        summary["Bytes"] += obj["Size"]
+        if result_key.startswith("reduced/"):
+            summary["ReducedFiles"].append(result_key[len("reduced/"):])
+        if len(lines) >= INDEX_SHARD_SIZE:
+            flush()
+    if lines:
+        flush()
+    return summary
+
+def iter_objects(bucket_name, prefix):
+    # Lazily pages through a listing.  (Same idea as wiglaf.s3.iter_files, which isn't available in the Lambda.)
+    kwargs = {"Bucket":bucket_name, "Prefix":prefix, "MaxKeys":1000}
+    while True:
+        response = client('s3').list_objects_v2(**kwargs)
+        for obj in response.get('Contents', []):
+            yield obj
+        if not response.get('NextContinuationToken'):
+            return
+        kwargs["ContinuationToken"] = response['NextContinuationToken']
+
+def pretty_size(size):
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if size < 1000 or unit == "TB":
+            return "{:.1f} {}".format(size, unit) if unit != "B" else "{} B".format(size)
+        size /= 1000.0
 
 def pretty_delta(td):
     MINUTE = 60
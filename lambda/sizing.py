@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+# Works out how many nodes a job needs from the work it has left, instead of running MaxSize nodes until the
+# last batch is done.
+#
+# This only does arithmetic, so that the same controller the Lambda uses can be replayed offline against recorded
+# job timelines (see benchmarks/cluster_sizing.py).
+
+# How long a new node takes to start on its first batch (boot, download, install) if the manifest doesn't say.
+DEFAULT_STARTUP_SECONDS = 5 * 60
+
+def _ceil_div(a, b):
+    return -(-a // b)
+
+def desired_capacity(remaining, slots, max_size, batch_seconds=None, current=0, busy=0, startup_seconds=DEFAULT_STARTUP_SECONDS):
+    """
+    Returns how many nodes to run for a job with remaining unfinished batches (running ones included), where each
+    node runs slots batches at a time.  batch_seconds is the typical batch time seen so far (None before any have
+    finished), current is how many nodes are running now, and busy how many of those are running batches.
+
+    Enough nodes to give every remaining batch a slot, but:
+      - new nodes are only added if they'd get through work sooner than the current ones could (a node that's
+        still booting when the last batch finishes is just cost)
+      - nodes that are running batches are never scaled in, so that capacity drains one idle node at a time
+    """
+    if remaining <= 0:
+        return 0
+    slots = max(1, slots)
+    needed = min(max_size, _ceil_div(remaining, slots))
+    if needed <= current:
+        return max(needed, min(busy, current))
+    if current == 0 or batch_seconds is None:
+        return needed
+    # The current nodes would be done after this many rounds of batches; a new one finishes its first batch after
+    # starting up.
+    drain_seconds = _ceil_div(remaining, current * slots) * batch_seconds
+    if drain_seconds <= startup_seconds + batch_seconds:
+        return current
+    return needed
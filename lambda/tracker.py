@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+import boto3
+import random
+import threading
+import time
+
+# Per-job completion state, so that handling a result upload doesn't require relisting the results prefix.
+#
+# Each job gets one counter record (jobs/<job>/completion) holding the number of distinct result keys seen so far,
+# the number needed for the job to be finished, and who is handling completion.  Each result key also gets a
+# marker record so that re-uploads of the same key (or S3 delivering the same event twice) don't get counted
+# twice.  A marker and the count it adds go in one transaction, so a result is either counted or not seen at all,
+# and can be recorded again after a failure.  Recording a result is a constant number of calls no matter how big
+# the job is.  (The counter is kept apart from jobs/<job>, which the nodes' work queue updates on every claim,
+# since a plain write to an item a transaction is changing is refused rather than retried.)
+
+# A transaction takes at most 100 items, one of which is the counter.
+TRANSACTION_SIZE = 100
+# Transactions that clash with another one on the counter are retried this many times, backing off like botocore.
+CONFLICT_RETRIES = 8
+CONFLICT_BACKOFF_SECONDS = 0.05
+CONFLICT_BACKOFF_MAX_SECONDS = 2
+
+# What claim_completion found.
+CLAIMED = "claimed"
+FINISHED = "finished"
+IN_PROGRESS = "in progress"
+
+class CompletionTracker(object):
+
+    def set_target(self, job_name, batch_count):
+        raise NotImplementedError()
+
+    def record(self, job_name, result_key):
+        """
+        Record that result_key has been uploaded for the job.
+        Returns (completed, target), where target is None if it hasn't been set for this job.
+        """
+        return self.record_many(job_name, [result_key])
+
+    def record_many(self, job_name, result_keys):
+        """
+        Record several result keys for the job at once.  Returns (completed, target) as of the last of them.
+        """
+        raise NotImplementedError()
+
+    def claim_completion(self, job_name, lease_seconds):
+        """
+        Claims handling a finished job, for lease_seconds or until finish_completion or release_completion.
+        Returns CLAIMED to exactly one caller at a time, FINISHED once finish_completion has been called, and
+        IN_PROGRESS while someone else's claim is live.  A claim that runs out (its holder was killed) can be
+        taken over, so teardown and notifications happen once, but do happen.
+        """
+        raise NotImplementedError()
+
+    def finish_completion(self, job_name):
+        raise NotImplementedError()
+
+    def release_completion(self, job_name):
+        """
+        Gives up a claim, so that a retry can take it over straight away.
+        """
+        raise NotImplementedError()
+
+class DynamoCompletionTracker(CompletionTracker):
+
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        self.dynamodb = client if client else boto3.client("dynamodb")
+
+    def _completion_id(self, job_name):
+        return "jobs/{}/completion".format(job_name)
+
+    def _result_id(self, job_name, result_key):
+        return "jobs/{}/results/{}".format(job_name, result_key)
+
+    def _retry_conflicts(self, call):
+        # A plain write is refused outright while a transaction has the item, and transactions cancel each other.
+        for attempt in range(CONFLICT_RETRIES + 1):
+            try:
+                return call()
+            except (self.dynamodb.exceptions.TransactionConflictException, self.dynamodb.exceptions.TransactionCanceledException) as e:
+                reasons = [r.get("Code") for r in e.response.get("CancellationReasons", [])]
+                if attempt == CONFLICT_RETRIES or (reasons and "TransactionConflict" not in reasons):
+                    raise
+            delay = min(CONFLICT_BACKOFF_MAX_SECONDS, CONFLICT_BACKOFF_SECONDS * 2 ** attempt)
+            time.sleep(random.uniform(0, delay))
+
+    def set_target(self, job_name, batch_count):
+        self._retry_conflicts(lambda: self.dynamodb.update_item(
+            TableName=self.table_name,
+            Key={"Id":{"S":self._completion_id(job_name)}},
+            UpdateExpression="SET #target = :target",
+            ExpressionAttributeNames={"#target":"Target"},
+            ExpressionAttributeValues={":target":{"N":str(batch_count)}}
+        ))
+
+    def _counts(self, job_name):
+        item = self.dynamodb.get_item(
+            TableName=self.table_name,
+            Key={"Id":{"S":self._completion_id(job_name)}},
+            ConsistentRead=True
+        ).get("Item", {})
+        completed = int(item.get("Completed",{}).get("N","0"))
+        target = int(item["Target"]["N"]) if "Target" in item else None
+        return completed, target
+
+    def _record_chunk(self, job_name, result_keys):
+        """
+        Writes the markers for result_keys and adds them to the count, in one transaction.  Keys that already have
+        a marker are dropped and the rest tried again.
+        """
+        while result_keys:
+            items = [{
+                "Put":{
+                    "TableName":self.table_name,
+                    "Item":{"Id":{"S":self._result_id(job_name, result_key)}},
+                    "ConditionExpression":"attribute_not_exists(Id)"
+                }
+            } for result_key in result_keys]
+            items.append({
+                "Update":{
+                    "TableName":self.table_name,
+                    "Key":{"Id":{"S":self._completion_id(job_name)}},
+                    "UpdateExpression":"ADD Completed :added",
+                    "ExpressionAttributeValues":{":added":{"N":str(len(result_keys))}}
+                }
+            })
+            try:
+                self._retry_conflicts(lambda: self.dynamodb.transact_write_items(TransactItems=items))
+                return
+            except self.dynamodb.exceptions.TransactionCanceledException as e:
+                reasons = [r.get("Code") for r in e.response.get("CancellationReasons", [])]
+                if "ConditionalCheckFailed" not in reasons:
+                    raise
+                # We've already counted these keys.
+                result_keys = [k for k, reason in zip(result_keys, reasons) if reason != "ConditionalCheckFailed"]
+
+    def record_many(self, job_name, result_keys):
+        result_keys = sorted(set(result_keys))
+        for i in range(0, len(result_keys), TRANSACTION_SIZE - 1):
+            self._record_chunk(job_name, result_keys[i:i + TRANSACTION_SIZE - 1])
+        return self._counts(job_name)
+
+    def claim_completion(self, job_name, lease_seconds):
+        now = int(time.time())
+        try:
+            self._retry_conflicts(lambda: self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={"Id":{"S":self._completion_id(job_name)}},
+                UpdateExpression="SET ClaimExpires = :expires",
+                ConditionExpression="attribute_not_exists(Done) AND (attribute_not_exists(ClaimExpires) OR ClaimExpires < :now)",
+                ExpressionAttributeValues={":expires":{"N":str(now + lease_seconds)}, ":now":{"N":str(now)}}
+            ))
+            return CLAIMED
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            item = self.dynamodb.get_item(
+                TableName=self.table_name,
+                Key={"Id":{"S":self._completion_id(job_name)}},
+                ConsistentRead=True
+            ).get("Item", {})
+            return FINISHED if "Done" in item else IN_PROGRESS
+
+    def finish_completion(self, job_name):
+        self._retry_conflicts(lambda: self.dynamodb.update_item(
+            TableName=self.table_name,
+            Key={"Id":{"S":self._completion_id(job_name)}},
+            UpdateExpression="SET Done = :true REMOVE ClaimExpires",
+            ExpressionAttributeValues={":true":{"BOOL":True}}
+        ))
+
+    def release_completion(self, job_name):
+        self._retry_conflicts(lambda: self.dynamodb.update_item(
+            TableName=self.table_name,
+            Key={"Id":{"S":self._completion_id(job_name)}},
+            UpdateExpression="REMOVE ClaimExpires",
+            ConditionExpression="attribute_not_exists(Done)"
+        ))
+
+class LocalCompletionTracker(CompletionTracker):
+    """
+    In-process stand-in for the DynamoDB tracker, for benchmarks and local runs.
+    Result keys are kept in one set per job.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def _job(self, job_name):
+        if job_name not in self.jobs:
+            self.jobs[job_name] = {"seen":set(), "target":None, "done":False, "claim_expires":None}
+        return self.jobs[job_name]
+
+    def set_target(self, job_name, batch_count):
+        with self.lock:
+            self._job(job_name)["target"] = batch_count
+
+    def record_many(self, job_name, result_keys):
+        with self.lock:
+            job = self._job(job_name)
+            job["seen"].update(result_keys)
+            return len(job["seen"]), job["target"]
+
+    def claim_completion(self, job_name, lease_seconds):
+        with self.lock:
+            job = self._job(job_name)
+            if job["done"]:
+                return FINISHED
+            if job["claim_expires"] is not None and job["claim_expires"] >= self.clock():
+                return IN_PROGRESS
+            job["claim_expires"] = self.clock() + lease_seconds
+            return CLAIMED
+
+    def finish_completion(self, job_name):
+        with self.lock:
+            job = self._job(job_name)
+            job["done"] = True
+            job["claim_expires"] = None
+
+    def release_completion(self, job_name):
+        with self.lock:
+            self._job(job_name)["claim_expires"] = None
+
+    def clear(self, job_name):
+        """
+        Forgets the job's results and target, as wiglaf.state.clear_job does for the DynamoDB tracker.
+        """
+        with self.lock:
+            self.jobs.pop(job_name, None)
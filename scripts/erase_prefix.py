@@ -5,6 +5,8 @@ import boto3
 import copy
 import time
 import traceback
+import wiglaf.cloudformation
+import wiglaf.s3
 
 from calvin import json
 
@@ -25,37 +27,11 @@ def parse_args():
     return parser.parse_args()
 
 def erase_prefix(stack_name, prefix):
-    cf = boto3.client("cloudformation")
-    s3 = boto3.client("s3")
-    stack = cf.describe_stacks(StackName=stack_name)["Stacks"][0]
-    outputs = {op["OutputKey"]:op["OutputValue"] for op in stack["Outputs"]}
+    outputs = wiglaf.cloudformation.stack_outputs(stack_name)
     # Should update this to look through the stack resources and grab all buckets, but this'll work for now.
     bucket = outputs["DataBucket"]
-    response = s3.list_objects_v2(
-        Bucket=bucket,
-        Prefix=prefix,
-        MaxKeys=1000,
-    )
-    batches = [[obj["Key"] for obj in response['Contents']]]
-    token = response.get('NextContinuationToken', None)
-    while token:
-        response = s3.list_objects_v2(
-            Bucket=bucket,
-            Prefix=prefix,
-            MaxKeys=1000,
-            ContinuationToken=token
-        )
-        batches.append([obj["Key"] for obj in response['Contents']])
-        token = response.get('NextContinuationToken', None)
-    for batch in batches:
-        if batch:
-            s3.delete_objects(
-                Bucket=bucket,
-                Delete={
-                    "Objects": [{"Key":k} for k in batch],
-                    "Quiet":True
-                }
-            )
+    stats = wiglaf.s3.delete_prefix(bucket, prefix)
+    print("Deleted {} objects in {:.1f}s ({:.0f} keys/s).".format(stats["deleted"], stats["seconds"], stats["keys_per_second"]))
 
 def main():
     args = parse_args()
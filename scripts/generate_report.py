@@ -6,6 +6,9 @@ import copy
 from datetime import datetime, timedelta, timezone
 import time
 import traceback
+import wiglaf.cloudformation
+import wiglaf.report
+import wiglaf.s3
 
 from calvin import json
 
@@ -30,23 +33,7 @@ def generate(bucket_name, job_name):
     manifest_key = "jobs/{job_name}/resources/wiglaf_manifest.json".format(job_name=job_name)
     manifest_object = s3.get_object(Bucket=bucket_name, Key=manifest_key)
     results_prefix = 'jobs/{job_name}/results/'.format(job_name=job_name)
-    response = s3.list_objects_v2(
-        Bucket=bucket_name,
-        MaxKeys=1000,
-        Prefix=results_prefix,
-    )
-    objects = response['Contents']
-    token = response.get('NextContinuationToken', None)
-    while token:
-        response = s3.list_objects_v2(
-            Bucket=bucket_name,
-            MaxKeys=1000,
-            Prefix=results_prefix,
-            ContinuationToken=token
-        )
-        objects.extend(response['Contents'])
-        token = response.get('NextContinuationToken', None)
-    links = [s3.generate_presigned_url(ClientMethod='get_object',Params={'Bucket':bucket_name,'Key':obj['Key']},ExpiresIn=60*60*24) for obj in objects]
+    links = [s3.generate_presigned_url(ClientMethod='get_object',Params={'Bucket':bucket_name,'Key':obj['Key']},ExpiresIn=60*60*24) for obj in wiglaf.s3.iter_files(bucket_name, results_prefix, s3=s3)]
 
     start_dt = manifest_object["LastModified"]
     end_dt = datetime.now(timezone.utc)
@@ -61,6 +48,7 @@ def generate(bucket_name, job_name):
         ""
     ]
     message_lines.extend(links)
+    message_lines.extend(["", wiglaf.report.format_text(wiglaf.report.job_report(bucket_name, job_name, s3=s3))])
     print("\n".join(message_lines))
 
 def pretty_delta(td):
@@ -83,9 +71,7 @@ def pretty_delta(td):
     return "{1} ({0})".format(str(td), pretty)
     
 def get_bucket_name(stack_name):
-    cf = boto3.client("cloudformation")
-    stack = cf.describe_stacks(StackName=stack_name)["Stacks"][0]
-    outputs = {op["OutputKey"]:op["OutputValue"] for op in stack["Outputs"]}
+    outputs = wiglaf.cloudformation.stack_outputs(stack_name)
     bucket = outputs["DataBucket"]
     return bucket
 
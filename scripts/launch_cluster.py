@@ -7,8 +7,8 @@ import hashlib
 import time
 import traceback
 
-from calvin.aws.lambda_deployment import create_zipfile
 from calvin import json
+from wiglaf.cloudformation import lambda_zipfile
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -91,7 +91,7 @@ def launch_cluster_stack(name, email, keyname, imageid, instancetype):
     print("Creating initial stack.")
     outputs = create_stack(name, transitional_template, params)
     print("Uploading lambda function code to lambda bucket.")
-    body = create_zipfile("lambda/")
+    body = lambda_zipfile()
     lambda_key = "lambda.{}.zip".format(hashlib.md5(body).hexdigest())
     boto3.client("s3").put_object(Bucket=outputs["LambdaBucket"], Key=lambda_key, Body=body)
     params["LambdaS3Key"] = lambda_key
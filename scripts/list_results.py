@@ -5,6 +5,8 @@ import boto3
 import copy
 import time
 import traceback
+import wiglaf.cloudformation
+import wiglaf.s3
 
 from calvin import json
 
@@ -24,25 +26,6 @@ def parse_args():
                         required=True)
     return parser.parse_args()
 
-def list_all(s3, bucket, prefix):
-    response = s3.list_objects_v2(
-        Bucket=bucket,
-        Prefix=prefix,
-        MaxKeys=1000,
-    )
-    objects = response.get('Contents', [])
-    token = response.get('NextContinuationToken', None)
-    while token:
-        response = s3.list_objects_v2(
-            Bucket=bucket,
-            Prefix=prefix,
-            MaxKeys=1000,
-            ContinuationToken=token
-        )
-        objects.extend(response['Contents'])
-        token = response.get('NextContinuationToken', None)
-    return objects
-
 BYTE_LEVELS="BKMGTPE"
 
 def format_object(obj):
@@ -65,15 +48,12 @@ def format_object(obj):
     return pretty
 
 def list_results(stack_name, job_name):
-    cf = boto3.client("cloudformation")
     s3 = boto3.client("s3")
-    stack = cf.describe_stacks(StackName=stack_name)["Stacks"][0]
-    outputs = {op["OutputKey"]:op["OutputValue"] for op in stack["Outputs"]}
+    outputs = wiglaf.cloudformation.stack_outputs(stack_name)
     bucket = outputs["DataBucket"]
     prefix = "jobs/{}/".format(job_name)
-    files = list_all(s3, bucket, prefix)
-    fstrings = [format_object(f) for f in files]
-    print("\n".join(fstrings))
+    for f in wiglaf.s3.iter_files(bucket, prefix, s3=s3):
+        print(format_object(f))
 
 def main():
     args = parse_args()
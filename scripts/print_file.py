@@ -6,6 +6,7 @@ import copy
 from datetime import datetime, timedelta, timezone
 import time
 import traceback
+import wiglaf.cloudformation
 
 from calvin import json
 
@@ -31,9 +32,7 @@ def print_file(bucket_name, key):
     print(manifest_object["Body"].read().decode("utf-8"))
     
 def get_bucket_name(stack_name):
-    cf = boto3.client("cloudformation")
-    stack = cf.describe_stacks(StackName=stack_name)["Stacks"][0]
-    outputs = {op["OutputKey"]:op["OutputValue"] for op in stack["Outputs"]}
+    outputs = wiglaf.cloudformation.stack_outputs(stack_name)
     bucket = outputs["DataBucket"]
     return bucket
 
@@ -3,6 +3,10 @@
 import argparse
 import boto3
 import os
+import tempfile
+import wiglaf.bundle
+import wiglaf.cloudformation
+import wiglaf.s3
 
 from calvin import json
 
@@ -23,6 +27,14 @@ def parse_args():
     parser.add_argument("--filepath",
                         help='Path of the manifest file on disk.',
                         required=True)
+    parser.add_argument("--force",
+                        help='Upload resources even if an identical copy is already in S3.',
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--bundle",
+                        help='Upload the resources as a single bundle, which nodes fetch in one request.',
+                        action="store_true",
+                        default=False)
     parser.add_argument("--upload_resources",
                         help='If this flag is provided, the FilesToDownload specified in the manifest will also be uploaded.',
                         action="store_true",
@@ -31,9 +43,7 @@ def parse_args():
     return parser.parse_args()
 
 def get_data_bucket(stack_name):
-    cf = boto3.client("cloudformation")
-    stack = cf.describe_stacks(StackName=stack_name)["Stacks"][0]
-    outputs = {op["OutputKey"]:op["OutputValue"] for op in stack["Outputs"]}
+    outputs = wiglaf.cloudformation.stack_outputs(stack_name)
     bucket = outputs["DataBucket"]
     return bucket
 
@@ -47,13 +57,21 @@ def main():
     args = parse_args()
     boto3.setup_default_session(region_name=args.region, profile_name=args.profile)
     bucket = get_data_bucket(args.name)
+    if args.upload_resources and args.bundle:
+        manifest = json.loadf(args.filepath)
+        with tempfile.TemporaryDirectory() as workdir:
+            manifest["Bundle"] = wiglaf.bundle.upload_bundle(manifest["LocalDirectory"], manifest["FilesToDownload"], bucket, workdir)
+            print("Uploaded {} resource files as {}.".format(len(manifest["FilesToDownload"]), manifest["Bundle"]))
+            manifest_path = os.path.join(workdir, "manifest.json")
+            json.dumpf(manifest, manifest_path, indent=4, sort_keys=True)
+            upload_file(manifest_path, bucket, "manifest.json")
+        return
     if args.upload_resources:
         manifest = json.loadf(args.filepath)
-        for filename in manifest["FilesToDownload"]:
-            key = "jobs/{job_name}/resources/{filename}".format(job_name=manifest["JobName"], filename=filename)
-            upload_file(os.path.join(manifest["LocalDirectory"], filename), bucket, key)
+        uploads = [(os.path.join(manifest["LocalDirectory"], filename), "jobs/{job_name}/resources/{filename}".format(job_name=manifest["JobName"], filename=filename)) for filename in manifest["FilesToDownload"]]
+        stats = wiglaf.s3.upload_files(uploads, bucket, force=args.force)
+        print("Uploaded {} resource files ({:.1f} MB), {} unchanged.".format(stats["files"], stats["bytes"] / 1e6, stats["skipped"]))
     upload_file(args.filepath, bucket, "manifest.json")
-    pass
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,180 @@
+import botocore.exceptions
+import hashlib
+import logging
+import time
+import wiglaf.s3
+
+from calvin import json
+from wiglaf.cloudformation.templates import BOOTSTRAP_COMMANDS
+
+# Bakes a job's download and install phases into an AMI, so that nodes launched from it only have to run batches.
+# A builder instance is launched like a cluster node, runs the node agent with --bake (which downloads the
+# resources and runs the InstallCommands, then leaves a record of what it did in /etc/wiglaf/baked.json) and shuts
+# itself down; the stopped instance is then imaged.  Images are keyed by a hash of everything that goes into them:
+#   images/<hash>.json            which image was baked from what
+#   images/by-id/<image id>.json  the same record, to find it from the image a cluster is running
+#   images/<hash>/manifest.json   the manifest the builder installs
+#   images/<hash>/status.json     whether the install worked, written by the builder
+#   images/<hash>/bake.log        the builder's log
+# start_job compares the hash of a job's install section with these records, and launches the cluster from the
+# matching image if there is one.
+
+# Bump this when the way images are baked changes, so that old images aren't reused.
+BAKE_VERSION = 1
+INSTALL_KEYS = ["InstallCommands", "Resources", "Bundle", "FilesToDownload"]
+HASH_TAG = "wiglaf:install-hash"
+POLL_SECONDS = 15
+# Builders that haven't stopped after this long are assumed to be stuck.
+BUILD_TIMEOUT_SECONDS = 2 * 60 * 60
+IMAGE_TIMEOUT_SECONDS = 60 * 60
+
+def install_hash(manifest, base_image_id):
+    """
+    A hash of everything an image baked for this manifest would depend on.  Expects the manifest's resources to
+    have been uploaded, so that Resources and Bundle hold their digests.
+    """
+    install = {key:manifest[key] for key in INSTALL_KEYS if key in manifest}
+    install.update({"BaseImageId":base_image_id, "BakeVersion":BAKE_VERSION})
+    return hashlib.sha256(json.dumps(install, sort_keys=True).encode("utf-8")).hexdigest()
+
+def record_key(digest):
+    return "images/{}.json".format(digest)
+
+def id_record_key(image_id):
+    return "images/by-id/{}.json".format(image_id)
+
+def _get_record(bucket, key, s3=None):
+    s3 = s3 if s3 else wiglaf.s3.client("s3")
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8"))
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+def find_image(bucket, digest, s3=None):
+    """
+    The record of the image baked for an install hash, or None if there isn't one.
+    """
+    return _get_record(bucket, record_key(digest), s3=s3)
+
+def find_image_by_id(bucket, image_id, s3=None):
+    """
+    The record of a baked image by its id, or None if it wasn't baked here.
+    """
+    return _get_record(bucket, id_record_key(image_id), s3=s3)
+
+def launch_settings(group_name, autoscaling, ec2):
+    """
+    How the cluster launches its nodes (ImageId, InstanceType, KeyName, IamInstanceProfile and SubnetId), from its
+    launch configuration or, for fleets, its launch template.
+    """
+    group = autoscaling.describe_auto_scaling_groups(AutoScalingGroupNames=[group_name])["AutoScalingGroups"][0]
+    if group.get("LaunchConfigurationName"):
+        config = autoscaling.describe_launch_configurations(LaunchConfigurationNames=[group["LaunchConfigurationName"]])["LaunchConfigurations"][0]
+        profile = config.get("IamInstanceProfile")
+        settings = {
+            "ImageId":config["ImageId"],
+            "InstanceType":config["InstanceType"],
+            "KeyName":config.get("KeyName"),
+            "IamInstanceProfile":({"Arn":profile} if profile.startswith("arn:") else {"Name":profile}) if profile else None
+        }
+    else:
+        specification = group["MixedInstancesPolicy"]["LaunchTemplate"]["LaunchTemplateSpecification"]
+        version = ec2.describe_launch_template_versions(LaunchTemplateId=specification["LaunchTemplateId"],
+                                                        Versions=[str(specification.get("Version", "$Latest"))])["LaunchTemplateVersions"][0]
+        data = version["LaunchTemplateData"]
+        settings = {
+            "ImageId":data["ImageId"],
+            "InstanceType":data["InstanceType"],
+            "KeyName":data.get("KeyName"),
+            "IamInstanceProfile":data.get("IamInstanceProfile")
+        }
+    settings["SubnetId"] = group["VPCZoneIdentifier"].split(",")[0]
+    return settings
+
+def builder_user_data(bucket, digest):
+    prefix = "images/{}".format(digest)
+    return "\n".join(["#!/bin/bash"] + BOOTSTRAP_COMMANDS + [
+        "AZ=$(curl -s http://169.254.169.254/latest/meta-data/placement/availability-zone)",
+        "export AWS_DEFAULT_REGION=${AZ::-1}",
+        "mkdir -p /opt/wiglaf",
+        "aws s3 cp --recursive s3://{}/wiglaf/node/ /opt/wiglaf/".format(bucket),
+        "python3 /opt/wiglaf/agent.py --bucket {} --bake {}/manifest.json > /var/log/wiglaf-bake.log 2>&1".format(bucket, prefix),
+        "aws s3 cp /var/log/wiglaf-bake.log s3://{}/{}/bake.log".format(bucket, prefix),
+        # The agent leaves nothing running, so a plain shutdown gets a consistent disk to image.
+        "shutdown -h now",
+        ""
+    ])
+
+def _wait(description, check, timeout, poll_seconds, sleep):
+    deadline = time.time() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        if time.time() > deadline:
+            raise RuntimeError("Timed out waiting for {}.".format(description))
+        sleep(poll_seconds)
+
+def bake(bucket, manifest, base_image_id, settings, digest=None, s3=None, ec2=None, poll_seconds=POLL_SECONDS, sleep=time.sleep,
+         build_timeout=BUILD_TIMEOUT_SECONDS, image_timeout=IMAGE_TIMEOUT_SECONDS):
+    """
+    Bakes an image from base_image_id with manifest's resources and install commands, launching the builder with
+    settings (see launch_settings), and returns its record.  The builder is terminated whether or not it worked.
+    """
+    s3 = s3 if s3 else wiglaf.s3.client("s3")
+    ec2 = ec2 if ec2 else wiglaf.s3.client("ec2")
+    digest = digest or install_hash(manifest, base_image_id)
+    prefix = "images/{}".format(digest)
+    manifest = dict(manifest, InstallHash=digest)
+    s3.put_object(Bucket=bucket, Key=prefix + "/manifest.json", Body=json.dumps(manifest, indent=4, sort_keys=True).encode("utf-8"))
+    s3.delete_object(Bucket=bucket, Key=prefix + "/status.json")
+    request = {
+        "ImageId":base_image_id,
+        "InstanceType":settings["InstanceType"],
+        "MinCount":1,
+        "MaxCount":1,
+        "UserData":builder_user_data(bucket, digest),
+        "InstanceInitiatedShutdownBehavior":"stop",
+        "TagSpecifications":[{"ResourceType":"instance", "Tags":[{"Key":"Name", "Value":"wiglaf-bake-{}".format(manifest["JobName"])}, {"Key":HASH_TAG, "Value":digest}]}]
+    }
+    if settings.get("SubnetId"):
+        request["SubnetId"] = settings["SubnetId"]
+    if settings.get("KeyName"):
+        request["KeyName"] = settings["KeyName"]
+    if settings.get("IamInstanceProfile"):
+        request["IamInstanceProfile"] = settings["IamInstanceProfile"]
+    instance_id = ec2.run_instances(**request)["Instances"][0]["InstanceId"]
+    logging.info("Baking on {} from {}.".format(instance_id, base_image_id))
+    try:
+        def stopped():
+            state = ec2.describe_instances(InstanceIds=[instance_id])["Reservations"][0]["Instances"][0]["State"]["Name"]
+            if state in ("terminated", "shutting-down"):
+                raise RuntimeError("Builder {} was terminated.".format(instance_id))
+            return state == "stopped"
+        _wait("builder {} to finish".format(instance_id), stopped, build_timeout, poll_seconds, sleep)
+        try:
+            status = json.loads(s3.get_object(Bucket=bucket, Key=prefix + "/status.json")["Body"].read().decode("utf-8"))
+        except botocore.exceptions.ClientError:
+            status = {"ok":False, "error":"The builder didn't report how the install went."}
+        if not status["ok"]:
+            raise RuntimeError("Baking failed: {}  See s3://{}/{}/bake.log.".format(status.get("error"), bucket, prefix))
+        image_id = ec2.create_image(InstanceId=instance_id, Name="wiglaf-{}-{}".format(manifest["JobName"], digest[:12]),
+                                    Description="wiglaf image for {} baked from {}".format(manifest["JobName"], base_image_id))["ImageId"]
+        ec2.create_tags(Resources=[image_id], Tags=[{"Key":HASH_TAG, "Value":digest}])
+        logging.info("Waiting for image {}.".format(image_id))
+        def available():
+            state = ec2.describe_images(ImageIds=[image_id])["Images"][0]["State"]
+            if state in ("failed", "invalid", "error", "deregistered"):
+                raise RuntimeError("Image {} is {}.".format(image_id, state))
+            return state == "available"
+        _wait("image {}".format(image_id), available, image_timeout, poll_seconds, sleep)
+    finally:
+        ec2.terminate_instances(InstanceIds=[instance_id])
+    record = {"ImageId":image_id, "InstallHash":digest, "BaseImageId":base_image_id, "Created":time.time(), "JobName":manifest["JobName"]}
+    body = json.dumps(record, indent=4, sort_keys=True).encode("utf-8")
+    # The id's record first: once the hash's record is there, start_job can switch clusters to the image.
+    s3.put_object(Bucket=bucket, Key=id_record_key(image_id), Body=body)
+    s3.put_object(Bucket=bucket, Key=record_key(digest), Body=body)
+    return record
@@ -0,0 +1,97 @@
+import io
+import os
+import zipfile
+import wiglaf.cas
+import wiglaf.s3
+
+# Packs a job's resource files into a single zip so nodes make one request for them instead of one per file.
+# Zip keeps its index (the central directory) at the end of the file and compresses each member separately,
+# so individual files can be read straight out of S3 with a couple of ranged GETs.
+# Bundles are stored in the content-addressed store (see wiglaf.cas) like any other resource.
+
+# Fixed timestamp so the same inputs always produce the same bytes (and therefore the same digest).
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+def create_bundle(directory, filenames, path, compression=zipfile.ZIP_DEFLATED):
+    """
+    Writes the files (relative to directory) into a zip at path.  Returns the sha256 of the bundle.
+    """
+    with zipfile.ZipFile(path, "w", compression=compression) as bundle:
+        for filename in sorted(set(filenames)):
+            info = zipfile.ZipInfo(filename, date_time=FIXED_DATE_TIME)
+            info.compress_type = compression
+            info.external_attr = (os.stat(os.path.join(directory, filename)).st_mode & 0o777) << 16
+            with open(os.path.join(directory, filename), "rb") as src, bundle.open(info, "w") as dest:
+                for chunk in iter(lambda: src.read(wiglaf.s3.CHUNK_SIZE), b""):
+                    dest.write(chunk)
+    return wiglaf.s3.file_sha256(path)
+
+def extract_bundle(path, directory):
+    """
+    Extracts a bundle, keeping file permissions (which zipfile.extractall drops).
+    """
+    with zipfile.ZipFile(path) as bundle:
+        for info in bundle.infolist():
+            target = bundle.extract(info, directory)
+            mode = (info.external_attr >> 16) & 0o777
+            if mode:
+                os.chmod(target, mode)
+
+class RangedReader(io.RawIOBase):
+    """
+    Read-only, seekable file object over an S3 object, fetching only the byte ranges that are read.
+    Wrap it in zipfile.ZipFile to pull single files out of a bundle without downloading all of it.
+    """
+
+    def __init__(self, bucket, key, s3=None):
+        self.bucket = bucket
+        self.key = key
+        self.s3 = s3 if s3 else wiglaf.s3.client("s3")
+        self.size = self.s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or not len(buffer):
+            return 0
+        end = min(self.position + len(buffer), self.size) - 1
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range="bytes={}-{}".format(self.position, end))
+        data = response["Body"].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+def read_member(bucket, key, name, s3=None):
+    """
+    Returns the contents of one file in a bundle stored in S3.
+    """
+    reader = io.BufferedReader(RangedReader(bucket, key, s3=s3), buffer_size=wiglaf.s3.CHUNK_SIZE)
+    with zipfile.ZipFile(reader) as bundle:
+        return bundle.read(name)
+
+def upload_bundle(directory, filenames, bucket, workdir, s3=None):
+    """
+    Bundles the files and stores the bundle in the CAS.  Returns the bundle's digest.
+    """
+    path = os.path.join(workdir, "wiglaf_bundle.zip")
+    digest = create_bundle(directory, filenames, path)
+    wiglaf.cas.put_file(path, bucket, digest=digest, s3=s3)
+    os.remove(path)
+    return digest
@@ -0,0 +1,135 @@
+import botocore.exceptions
+import concurrent.futures
+import logging
+import time
+import wiglaf.s3
+from calvin import json
+from datetime import datetime, timezone
+
+# Content-addressed store for job resources, shared by every job on the cluster.
+#
+# Files are stored once in the data bucket at cas/<sha256>, and manifests refer to them by digest:
+#   "Resources": {"<filename>": "<sha256>", ...}  files stored individually
+#   "Bundle": "<sha256>"                          a wiglaf.bundle zip of the remaining (small) files
+# Nodes keep their own copy of everything they fetch in NODE_CACHE_DIRECTORY, so a baked image doesn't
+# re-download unchanged resources for the next job.
+#
+# Nothing is reference counted.  collect_garbage does a mark and sweep over the manifests of the jobs
+# still in the bucket, so erasing a job is what makes its resources collectable.  Objects that haven't been
+# written (or reused, see put_file) for GC_GRACE_SECONDS are the only ones it will delete.
+
+CAS_PREFIX = "cas/"
+NODE_CACHE_DIRECTORY = "/var/cache/wiglaf/cas"
+# Resource files at least this big are stored individually instead of going into the job's bundle.
+UNBUNDLED_SIZE = 32 * 1024 * 1024
+# Objects newer than this are never collected, since they may belong to a job that hasn't been submitted yet.
+GC_GRACE_SECONDS = 24 * 60 * 60
+# Objects put_file finds already stored are re-written in place once they're this old, so that the grace period
+# covers the job about to refer to them as well as the one that first stored them.
+REFRESH_SECONDS = GC_GRACE_SECONDS // 2
+# The biggest object copy_object copies in one go.
+COPY_OBJECT_MAX_SIZE = 5 * 1024 ** 3
+
+def key(digest):
+    return CAS_PREFIX + digest
+
+def put_file(filename, bucket, digest=None, s3=None):
+    """
+    Stores the file in the CAS unless it's already there.  Returns its digest.
+    """
+    s3 = s3 if s3 else wiglaf.s3.client("s3")
+    digest = digest if digest else wiglaf.s3.file_sha256(filename)
+    # The key is the content, so the object existing at all means it's identical.
+    head = wiglaf.s3.head(s3, bucket, key(digest))
+    if head and (datetime.now(timezone.utc) - head["LastModified"]).total_seconds() < REFRESH_SECONDS:
+        logging.debug("{} already stored as {}.".format(filename, key(digest)))
+    elif head and refresh(bucket, digest, head, s3=s3):
+        logging.debug("{} already stored as {}, refreshed.".format(filename, key(digest)))
+    else:
+        wiglaf.s3.upload_file(filename, bucket, key(digest), force=True, s3=s3)
+    return digest
+
+def refresh(bucket, digest, head, s3=None):
+    """
+    Copies a CAS object onto itself, which makes it new as far as collect_garbage is concerned.  Returns False
+    if it has gone (collected since it was looked at).
+    """
+    s3 = s3 if s3 else wiglaf.s3.client("s3")
+    source = {"Bucket":bucket, "Key":key(digest)}
+    # Copying an object onto itself is only allowed if something changes, so its metadata is "replaced".
+    extra = {"MetadataDirective":"REPLACE", "Metadata":head.get("Metadata", {})}
+    if head.get("ContentType"):
+        extra["ContentType"] = head["ContentType"]
+    try:
+        if head["ContentLength"] <= COPY_OBJECT_MAX_SIZE:
+            s3.copy_object(Bucket=bucket, Key=key(digest), CopySource=source, **extra)
+        else:
+            s3.copy(source, bucket, key(digest), ExtraArgs=extra)
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ["404", "NoSuchKey"]:
+            return False
+        raise
+    return True
+
+def put_files(filenames, bucket, concurrency=wiglaf.s3.DEFAULT_CONCURRENCY, s3=None):
+    """
+    Stores many files in the CAS at once.  Returns a dict of filename to digest.
+    """
+    s3 = s3 if s3 else wiglaf.s3.client("s3", max_pool_connections=concurrency * 2)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {filename:executor.submit(put_file, filename, bucket, s3=s3) for filename in filenames}
+        return {filename:future.result() for filename, future in futures.items()}
+
+def manifest_digests(manifest):
+    digests = set(manifest.get("Resources", {}).values())
+    if manifest.get("Bundle"):
+        digests.add(manifest["Bundle"])
+    return digests
+
+def referenced_digests(bucket, s3=None):
+    """
+    Every digest referenced by a job manifest still in the bucket.
+    """
+    s3 = s3 if s3 else wiglaf.s3.client("s3")
+    manifest_keys = ["manifest.json"]
+    job_prefixes, _ = wiglaf.s3.list_prefixes(bucket, "jobs/", s3=s3)
+    manifest_keys.extend("{}resources/wiglaf_manifest.json".format(prefix) for prefix in job_prefixes)
+    digests = set()
+    for manifest_key in manifest_keys:
+        if not wiglaf.s3.head(s3, bucket, manifest_key):
+            continue
+        manifest = json.loads(s3.get_object(Bucket=bucket, Key=manifest_key)["Body"].read().decode("utf-8"))
+        digests |= manifest_digests(manifest)
+    return digests
+
+def collect_garbage(bucket, grace_seconds=GC_GRACE_SECONDS, dry_run=False, s3=None):
+    """
+    Deletes CAS objects that no remaining job refers to.  Returns a dict of stats.
+    """
+    s3 = s3 if s3 else wiglaf.s3.client("s3")
+    start = time.time()
+    live = referenced_digests(bucket, s3=s3)
+    now = datetime.now(timezone.utc)
+    stats = {"kept":0, "deleted":0, "bytes_freed":0}
+    garbage = []
+
+    def flush():
+        if garbage and not dry_run:
+            failed = wiglaf.s3.delete_keys(s3, bucket, garbage)
+            stats["deleted"] -= len(failed)
+        del garbage[:]
+
+    for obj in wiglaf.s3.iter_files(bucket, CAS_PREFIX, s3=s3):
+        digest = obj["Key"][len(CAS_PREFIX):]
+        if digest in live or (now - obj["LastModified"]).total_seconds() < grace_seconds:
+            stats["kept"] += 1
+            continue
+        garbage.append(obj["Key"])
+        stats["deleted"] += 1
+        stats["bytes_freed"] += obj["Size"]
+        if len(garbage) == 1000:
+            flush()
+    flush()
+    stats["seconds"] = time.time() - start
+    logging.info("CAS garbage collection: {deleted} objects ({bytes_freed} bytes) {verb}, {kept} kept.".format(verb="would be deleted" if dry_run else "deleted", **stats))
+    return stats
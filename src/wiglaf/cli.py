@@ -12,14 +12,29 @@ class WiglafDispatcher(CLIDispatcher):
         Argument('--cluster-name', default=None, help='The name of the cluster.  May be specified in the config file instead.'),
         Argument('--image-id', default=None, help='The base EC2 AMI to use for the nodes.  May be specified in the config file instead.'),
         Argument('--instance-type', default=None, help='The EC2 instance type for each node.  May be specified in the config file instead.'),
+        Argument('--instance-types', default=None, help='Comma-separated instance types to run the nodes on as a fleet, most preferred first.  May be specified in the config file instead (as a list).'),
+        Argument('--spot', action='store_true', default=False, help='Run the nodes as spot instances (a fleet of --instance-types, or just --instance-type).  May be specified in the config file instead.'),
+        Argument('--on-demand-base-capacity', default=None, help='With a fleet, how many nodes to always run on demand.  May be specified in the config file instead.'),
+        Argument('--on-demand-percentage', default=None, help='With a fleet, the percentage of nodes above the base capacity to run on demand.  Defaults to 0 with --spot, otherwise 100.  May be specified in the config file instead.'),
+        Argument('--spot-allocation-strategy', default=None, choices=['price-capacity-optimized', 'capacity-optimized', 'capacity-optimized-prioritized', 'lowest-price'], help='How to pick spot capacity pools.  May be specified in the config file instead.'),
+        Argument('--availability-zones', default=None, help='With a fleet, how many availability zones to spread the nodes over (default 2).  May be specified in the config file instead.'),
         Argument('--max-size', default=None, help='The maximum number of nodes at one time.  May be specified in the config file instead.'),
         Argument('--email-address', default=None, help='An email address to notify when jobs finish.  May be specified in the config file instead.'),
+        Argument('--event-batch-size', default=None, help='Queue the data bucket\'s notifications and hand them to the Lambda this many at a time, so bursts of results cost less.  0 (the default) invokes it once per upload.  May be specified in the config file instead.'),
         Argument('--key-name', default=None, help='The name of an EC2 SSH keypair.  May be specified in the config file instead.'),
         Argument('--profile', default=None, help='The AWS credential profile to use.  May be specified in the config file instead.'),
         Argument('--region', default=None, help='The AWS region.  May be specified in the config file instead.'),
         Argument('--results-directory', default=None, help='Directory to which to download the results for the job.'),
+        Argument('--all-results', action='store_true', default=False, help='For a job with a reduce stage, download every batch\'s results rather than just the merged ones.'),
+        Argument('--presign', action='store_true', default=False, help='With list-results, print a download link (valid for 7 days) next to each result.'),
+        Argument('--switch-image', action='store_true', default=False, help='With start-job or bake-image, switch the cluster to the image baked for the job even though nodes are running.  Running nodes keep their image; only ones launched afterwards get the new one.'),
         Argument('--job-name', default=None, help='Override the job name given in the manifest.'),
-        Argument("-v", "--verbosity", dest="verbosity", action="count", default=0, help='How verbose this CLI should be.  More -v\'s, more verbose.')
+        Argument('--concurrency', default=None, help='How many transfers to S3 to run at once.'),
+        Argument('--instance-id', default=None, help='Only print the logs from this node.'),
+        Argument('--log-file', default=None, help='Only print this log (e.g. syslog, wiglaf-slot-0.log).'),
+        Argument('--follow', action='store_true', default=False, help='Keep printing new log output as nodes ship it.'),
+        Argument('--output-format', default=None, choices=['text', 'json'], help='Format for describe-job, generate-report, aggregate-metrics and list-results.  generate-report defaults to JSON, the others to text.'),
+        Argument("-v", "--verbosity", dest="verbosity", action="count", default=0, help='How verbose this CLI should be.  More -v\'s, more verbose.  Any -v also prints a profile of the AWS calls the command made (count, latency, retries and errors per operation) as JSON to stderr, or to the file named by WIGLAF_PROFILE.')
     ]
 
     operation_info={
@@ -48,7 +63,10 @@ class WiglafDispatcher(CLIDispatcher):
             'help':'Erase all files for a job from S3.'
         },
         'generate-report':{
-            'help':'Generate a report with general information about a job.'
+            'help':'Generate a report of where a job\'s time has gone: phase durations, per-node utilization, stragglers, throughput and estimated time to completion.'
+        },
+        'aggregate-metrics':{
+            'help':'Merge the metrics nodes have recorded for a job into cluster-wide histograms of time, CPU, memory and data transferred per phase.'
         },
         'clear-results':{
             'help':'Erase the results of a job from S3.'
@@ -57,22 +75,25 @@ class WiglafDispatcher(CLIDispatcher):
             'help':'Erase all data currently stored in the cloud.  This must be done before deleting a cluster.'
         },
         'list-results':{
-            'help':'List the results from a job.'
+            'help':'List the results from a job, from the index written when it finished: size, batch and node of each.  With --presign, with download links too.'
+        },
+        'print-logs':{
+            'help':'Print the logs nodes have shipped for a job.'
         },
         'download-results':{
             'help':'Download the results from a job.'
         },
         'start-job':{
-            'help':'Start a new job.'
+            'help':'Start a new job.  If an image has been baked for the job\'s install section, and the cluster has no nodes running (or with --switch-image), the nodes are launched from it.'
         },
         'describe-job':{
-            'help':'Print information about a run, such as current status.'
+            'help':'Print information about a run, such as current status, progress and estimated time to completion.'
         },
         'abort-job':{
             'help':'End an in-progress job and erase the contents from S3.'
         },
         'bake-image':{
-            'help':'Create a new base node image from a job manifest.  This will download all of the data and will then run the install steps, but not any of the compute or upload steps.'
+            'help':'Create a new base node image from a job manifest.  This will download all of the data and will then run the install steps, but not any of the compute or upload steps.  Jobs started with the same install steps and files skip them.'
         },
     }
 
@@ -80,6 +101,9 @@ class WiglafDispatcher(CLIDispatcher):
     def execute(cls, action, **kwargs):
         wig = Wiglaf(**kwargs)
         method = getattr(wig, action)
-        response = method(**kwargs)
+        try:
+            response = method(**kwargs)
+        finally:
+            wig.write_profile(action)
         if response:
             print(response)
@@ -1,14 +1,18 @@
 import boto3
-import copy
+import glob
 import hashlib
+import io
 import logging
+import os
 import time
 import traceback
+import wiglaf
+import wiglaf.node
 import wiglaf.s3
+import zipfile
 
 from calvin import json
-from calvin.aws.lambda_deployment import create_zipfile
-from .templates import WIGLAF_TEMPLATE
+from .templates import WIGLAF_TEMPLATE, cluster_template
 
 def describe_stack(cluster_name, **kwargs):
     cf = boto3.client("cloudformation")
@@ -17,26 +21,146 @@ def describe_stack(cluster_name, **kwargs):
     except:
         return None
     stack["_Parameters"] = stack["Parameters"]
-    stack["_Outputs"] = stack["_Outputs"]
+    stack["_Outputs"] = stack.get("Outputs", [])
     stack["Outputs"] = {op["OutputKey"]:op["OutputValue"] for op in stack["_Outputs"]}
     stack["Parameters"] = {p["ParameterKey"]:p["ParameterValue"] for p in stack["_Parameters"]}
     return stack
 
-def wait_for_stack(cluster_name, target_states=["CREATE_COMPLETE","UPDATE_COMPLETE"], **kwargs):
+# Stack outputs (bucket names and so on) only change when the stack is updated, so they're cached in memory and
+# on disk (keyed by profile, region and cluster) instead of being looked up on every command.  Updating or creating
+# a cluster through wiglaf clears its entry; the TTL covers changes made anywhere else.
+STACK_CACHE_TTL = int(os.getenv("WIGLAF_STACK_CACHE_TTL", 6 * 60 * 60))
+STACK_CACHE_DIRECTORY = os.path.join(os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "wiglaf", "stacks")
+_stack_cache = {}
+
+def _stack_cache_path(cluster_name, profile, region):
+    return os.path.join(STACK_CACHE_DIRECTORY, profile or "default", region or "default", "{}.json".format(cluster_name))
+
+def stack_outputs(cluster_name, profile=None, region=None, ttl=None, **kwargs):
+    """
+    describe_stack(cluster_name)["Outputs"], cached for ttl seconds (STACK_CACHE_TTL by default, 0 to always look
+    them up).
+    """
+    ttl = STACK_CACHE_TTL if ttl is None else ttl
+    if not (profile and region):
+        session = boto3.DEFAULT_SESSION or boto3.Session()
+        profile = profile or session.profile_name
+        region = region or session.region_name
+    cache_key = (profile, region, cluster_name)
+    path = _stack_cache_path(cluster_name, profile, region)
+    now = time.time()
+    if ttl:
+        cached = _stack_cache.get(cache_key)
+        if cached is None and os.path.exists(path):
+            try:
+                cached = json.loadf(path)
+            except Exception:
+                logging.debug("Ignoring unreadable stack cache {}.".format(path))
+        if cached and now - cached["fetched"] < ttl:
+            _stack_cache[cache_key] = cached
+            return cached["outputs"]
+    stack = describe_stack(cluster_name)
+    if stack is None:
+        raise RuntimeError("Cluster '{}' doesn't exist.".format(cluster_name))
+    cached = {"fetched":now, "outputs":stack["Outputs"]}
+    _stack_cache[cache_key] = cached
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(json.dumps(cached))
+    except OSError:
+        logging.debug("Couldn't write stack cache {}.".format(path))
+    return cached["outputs"]
+
+def invalidate_stack_outputs(cluster_name, profile=None, region=None, **kwargs):
+    if not (profile and region):
+        session = boto3.DEFAULT_SESSION or boto3.Session()
+        profile = profile or session.profile_name
+        region = region or session.region_name
+    _stack_cache.pop((profile, region, cluster_name), None)
+    try:
+        os.remove(_stack_cache_path(cluster_name, profile, region))
+    except OSError:
+        pass
+
+# Stack operations are followed through their events, read as they come, rather than by describing the whole stack
+# every few seconds.  Polls start POLL_MIN_SECONDS apart and back off towards POLL_MAX_SECONDS while nothing happens.
+POLL_MIN_SECONDS = 1
+POLL_MAX_SECONDS = 5
+POLL_BACKOFF = 1.5
+# Stack events that start an operation, as opposed to ones partway through (cleanup, rollback).
+OPERATION_STARTS = ["CREATE_IN_PROGRESS", "UPDATE_IN_PROGRESS", "DELETE_IN_PROGRESS", "IMPORT_IN_PROGRESS"]
+
+def _is_stack_event(event):
+    return event["ResourceType"] == "AWS::CloudFormation::Stack" and event["LogicalResourceId"] == event["StackName"]
+
+def _new_events(cf, cluster_name, after):
+    """
+    A stack's events since the one with EventId after, oldest first.  Without after, just the latest page's, from
+    the start of the operation under way if it's on the page.
+    """
+    events = []
+    kwargs = {}
+    while True:
+        page = cf.describe_stack_events(StackName=cluster_name, **kwargs)
+        for event in page["StackEvents"]:
+            if event["EventId"] == after:
+                return events[::-1]
+            events.append(event)
+        if after is None or not page.get("NextToken"):
+            break
+        kwargs["NextToken"] = page["NextToken"]
+    if after is None:
+        starts = [i for i, e in enumerate(events) if _is_stack_event(e) and e["ResourceStatus"] in OPERATION_STARTS]
+        events = events[:starts[0] + 1] if starts else events
+    return events[::-1]
+
+def wait_for_stack(cluster_name, target_states=["CREATE_COMPLETE","UPDATE_COMPLETE"], resources=None, **kwargs):
+    """
+    Waits for the operation under way on a stack (if any) to finish, and returns the stack.  Raises if it didn't
+    end up in one of target_states, with the reasons resources failed.  If resources is a dict, it's filled in
+    with how many seconds each resource the operation touched took, by logical id.
+    """
     stack = describe_stack(cluster_name)
+    if stack is None:
+        raise RuntimeError("Cluster '{}' doesn't exist.".format(cluster_name))
+    cf = boto3.client("cloudformation")
+    after = None
+    interval = POLL_MIN_SECONDS
+    started = {}
+    failures = []
+    finished = False
+    while stack["StackStatus"].endswith("_IN_PROGRESS"):
+        events = _new_events(cf, cluster_name, after)
+        for event in events:
+            status = event["ResourceStatus"]
+            reason = event.get("ResourceStatusReason")
+            logging.debug("{} {}{}".format(event["LogicalResourceId"], status, ": " + reason if reason else ""))
+            if _is_stack_event(event):
+                finished = finished or not status.endswith("_IN_PROGRESS")
+            elif status.endswith("_IN_PROGRESS"):
+                started.setdefault(event["LogicalResourceId"], event["Timestamp"])
+            elif event["LogicalResourceId"] in started and resources is not None:
+                resources[event["LogicalResourceId"]] = (event["Timestamp"] - started[event["LogicalResourceId"]]).total_seconds()
+            if status.endswith("_FAILED") and reason and not _is_stack_event(event):
+                failures.append("{}: {}".format(event["LogicalResourceId"], reason))
+        if events:
+            after = events[-1]["EventId"]
+        if finished:
+            # The stack's own event says it's done, so its status should be too.
+            stack = describe_stack(cluster_name)
+            if not stack["StackStatus"].endswith("_IN_PROGRESS"):
+                break
+        interval = POLL_MIN_SECONDS if events else min(interval * POLL_BACKOFF, POLL_MAX_SECONDS)
+        time.sleep(interval)
     status = stack["StackStatus"]
-    while status.endswith("_IN_PROGRESS"):
-        logging.debug("Stack '{}' in transitional state '{}'.  Sleeping for 5 seconds...".format(cluster_name, status))
-        time.sleep(5)
-        stack = describe_stack(cluster_name)
-        status = stack["StackStatus"]
     logging.debug("Stack '{}' in stable state '{}'.".format(cluster_name, status))
-    if status in ["CREATE_COMPLETE","UPDATE_COMPLETE"]:
+    if status in target_states:
         return stack
     else:
-        raise RuntimeError("Stack {} is in unexpected state {}!".format(cluster_name, status))
+        raise RuntimeError("Stack {} is in unexpected state {}!{}".format(cluster_name, status, "".join("\n  " + f for f in failures)))
 
-def create_stack(cluster_name, template, params, **kwargs):
+def create_stack(cluster_name, template, params, resources=None, **kwargs):
     cf = boto3.client("cloudformation")
     try:
         logging.debug("Creating stack '{}'".format(cluster_name))
@@ -50,9 +174,9 @@ def create_stack(cluster_name, template, params, **kwargs):
     except Exception as e:
         logging.warn(traceback.format_exc())
         pass
-    return wait_for_stack(cluster_name)
+    return wait_for_stack(cluster_name, resources=resources)
 
-def update_stack(cluster_name, template, params, **kwargs):
+def update_stack(cluster_name, template, params, resources=None, **kwargs):
     cf = boto3.client("cloudformation")
     try:
         logging.debug("Updating stack '{}'".format(cluster_name))
@@ -68,7 +192,21 @@ def update_stack(cluster_name, template, params, **kwargs):
             pass
         else:
             raise e
-    return wait_for_stack(cluster_name)
+    return wait_for_stack(cluster_name, resources=resources)
+
+def set_stack_parameters(cluster_name, **params):
+    """
+    Changes some of a stack's parameters, keeping its template and the rest of its parameters as they are.
+    """
+    cf = boto3.client("cloudformation")
+    stack = wait_for_stack(cluster_name)
+    parameters = [{"ParameterKey":k, "ParameterValue":params[k]} for k in params]
+    parameters.extend({"ParameterKey":k, "UsePreviousValue":True} for k in stack["Parameters"] if k not in params)
+    logging.debug("Updating parameters {} of stack '{}'".format(", ".join(sorted(params)), cluster_name))
+    cf.update_stack(StackName=cluster_name, UsePreviousTemplate=True, Parameters=parameters, Capabilities=['CAPABILITY_IAM'])
+    stack = wait_for_stack(cluster_name)
+    invalidate_stack_outputs(cluster_name)
+    return stack
 
 def launch_cluster_stack(cluster_name,
                          image_id=None,
@@ -76,9 +214,23 @@ def launch_cluster_stack(cluster_name,
                          max_size=None,
                          email_address=None,
                          key_name=None,
+                         event_batch_size=None,
+                         instance_types=None,
+                         availability_zones=None,
+                         spot=False,
+                         on_demand_base_capacity=None,
+                         on_demand_percentage=None,
+                         spot_allocation_strategy=None,
                          skip_create=False,
                          **kwargs):
-    template = copy.deepcopy(WIGLAF_TEMPLATE)
+    invalidate_stack_outputs(cluster_name, **kwargs)
+    instance_types = _instance_types(instance_types)
+    if spot and not instance_types:
+        # Spot on its own means a fleet of just the one type.
+        instance_types = [instance_type or WIGLAF_TEMPLATE["Parameters"]["InstanceType"]["Default"]]
+    if instance_types and not instance_type:
+        instance_type = instance_types[0]
+    template = cluster_template(instance_types=instance_types, availability_zones=availability_zones)
     params = {
         "ClusterName":cluster_name,
         "EmailAddress":email_address,
@@ -86,24 +238,86 @@ def launch_cluster_stack(cluster_name,
         "ImageId":image_id,
         "InstanceType":instance_type,
         "MaxInstanceCount":max_size,
+        "EventBatchSize":str(event_batch_size) if event_batch_size is not None else None,
     }
-    transitional_template = copy.deepcopy(template)
-    del transitional_template["Resources"]["DataBucket"]["Properties"]["NotificationConfiguration"]
+    if instance_types:
+        if on_demand_percentage is None:
+            on_demand_percentage = 0 if spot else 100
+        params.update({
+            "OnDemandBaseCapacity":str(on_demand_base_capacity) if on_demand_base_capacity is not None else None,
+            "OnDemandPercentage":str(on_demand_percentage),
+            "SpotAllocationStrategy":spot_allocation_strategy,
+        })
+    # The Lambda's code goes in a bucket the stack makes, so the stack starts with a placeholder function (see
+    # LAMBDA_PLACEHOLDER in templates.py) and a second pass, once the code's uploaded, sets the function's code.
+    # Everything else, the function's permission and the data bucket's notifications included, is in place after
+    # the first.
+    timings = []
+    launched = time.time()
+    body = lambda_zipfile()
+    lambda_key = "lambda.{}.zip".format(hashlib.md5(body).hexdigest())
+    resources = {}
+    start = time.time()
     if skip_create:
-        stack = wait_for_stack(cluster_name)
+        stack = wait_for_stack(cluster_name, resources=resources)
+        timings.append(("Waiting for the stack", time.time() - start, resources))
     else:
-        logging.info("Creating initial stack.")
-        stack = create_stack(cluster_name, transitional_template, params)
-    logging.info("Uploading lambda function code to lambda bucket.")
-    body = create_zipfile("lambda/")
-    lambda_key = "lambda.{}.zip".format(hashlib.md5(body).hexdigest())
+        logging.info("Creating stack.")
+        stack = create_stack(cluster_name, template, params, resources=resources)
+        timings.append(("Creating the stack", time.time() - start, resources))
+    logging.info("Uploading lambda function code to lambda bucket and node scripts to data bucket.")
+    start = time.time()
     boto3.client("s3").put_object(Bucket=stack["Outputs"]["LambdaBucket"], Key=lambda_key, Body=body)
+    upload_node_scripts(stack["Outputs"]["DataBucket"])
+    timings.append(("Uploading the Lambda code and node scripts", time.time() - start, {}))
     params["LambdaS3Key"] = lambda_key
-    logging.info("Updating stack to include Lambda function and permissions.")
-    outputs = update_stack(cluster_name, transitional_template, params)
-    logging.info("Updating stack to include S3 data bucket notifications.")
-    outputs = update_stack(cluster_name, template, params)
+    logging.info("Updating stack with the Lambda function code.")
+    resources = {}
+    start = time.time()
+    update_stack(cluster_name, template, params, resources=resources)
+    timings.append(("Updating the stack", time.time() - start, resources))
     logging.info("Data bucket: {}".format(stack["Outputs"]["DataBucket"]))
+    invalidate_stack_outputs(cluster_name, **kwargs)
+    return {"seconds":time.time() - launched, "phases":timings}
+
+def format_timings(cluster_name, timings, slowest=3):
+    """
+    The breakdown of where launch_cluster_stack's time went, with the slowest resources in each stack operation.
+    """
+    lines = ["Cluster '{}' is ready after {:.1f}s:".format(cluster_name, timings["seconds"])]
+    for phase, seconds, resources in timings["phases"]:
+        line = "  {:<44} {:>7.1f}s".format(phase, seconds)
+        if resources:
+            ranked = sorted(resources.items(), key=lambda r: -r[1])[:slowest]
+            line += "  slowest: " + ", ".join("{} {:.0f}s".format(r, s) for r, s in ranked)
+        lines.append(line)
+    return "\n".join(lines)
+
+def _instance_types(instance_types):
+    # A list in the config file, or comma-separated on the command line.
+    if isinstance(instance_types, str):
+        instance_types = instance_types.split(",")
+    return [t.strip() for t in instance_types or [] if t.strip()]
+
+# The parts of wiglaf the Lambda imports, relative to the package.  They're added to its zip under wiglaf/, so they
+# have to get by with the standard library (and boto3).
+LAMBDA_MODULES = ["__init__.py", "stats.py", "profiling.py", "result_keys.py", "node/__init__.py", "node/reducer.py"]
+
+def lambda_zipfile(directory="lambda/"):
+    from calvin.aws.lambda_deployment import create_zipfile
+    package_directory = os.path.dirname(os.path.abspath(wiglaf.__file__))
+    buffer = io.BytesIO(create_zipfile(directory))
+    with zipfile.ZipFile(buffer, "a", zipfile.ZIP_DEFLATED) as zipf:
+        for module in LAMBDA_MODULES:
+            zipf.write(os.path.join(package_directory, module), "wiglaf/" + module)
+    return buffer.getvalue()
+
+def upload_node_scripts(bucket):
+    # Nodes fetch these at startup (see process_manifest in lambda/handlers.py).
+    node_directory = os.path.dirname(os.path.abspath(wiglaf.node.__file__))
+    uploads = [(filename, "wiglaf/node/{}".format(os.path.basename(filename))) for filename in glob.glob(os.path.join(node_directory, "*.py"))
+               if os.path.basename(filename) != "__init__.py"]
+    wiglaf.s3.upload_files(uploads, bucket)
 
 def get_stack_info(cluster_name, profile, region, **kwargs):
     asg = boto3.client("autoscaling")
@@ -121,10 +335,20 @@ def get_stack_info(cluster_name, profile, region, **kwargs):
         "instance_type": params.get("InstanceType"),
         "image_id": params.get("ImageId"),
         "max_size": int(params.get("MaxInstanceCount")),
+        "event_batch_size": int(params.get("EventBatchSize", "0")),
         "cluster_name": cluster_name,
         "profile": profile,
         "region": region,
     }
+    if "MixedInstancesPolicy" in as_group:
+        policy = as_group["MixedInstancesPolicy"]
+        cluster_config.update({
+            "instance_types": [o["InstanceType"] for o in policy["LaunchTemplate"].get("Overrides", [])],
+            "availability_zones": len(as_group["AvailabilityZones"]),
+            "on_demand_base_capacity": int(params.get("OnDemandBaseCapacity", "0")),
+            "on_demand_percentage": int(params.get("OnDemandPercentage", "100")),
+            "spot_allocation_strategy": params.get("SpotAllocationStrategy"),
+        })
     cluster_state = {
         "current_size": current_size,
     }
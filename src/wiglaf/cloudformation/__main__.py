@@ -0,0 +1,7 @@
+# Prints the cluster template.  cluster.cf.json, for scripts/launch_cluster.py, is made with:
+#   python -m wiglaf.cloudformation > cluster.cf.json
+
+from calvin import json
+from .templates import cluster_template
+
+print(json.dumps(cluster_template(), indent=4))
@@ -1,5 +1,26 @@
+import copy
+
 from calvin import json
 
+# Images baked by wiglaf.bake have this file, and already have what BOOTSTRAP_COMMANDS install for the node scripts.
+BAKED_FILE = "/etc/wiglaf/baked.json"
+BOOTSTRAP_COMMANDS = [
+    "sudo apt-get install -y python3",
+    "wget -O /tmp/get-pip.py 'https://bootstrap.pypa.io/get-pip.py'",
+    "sudo python3 /tmp/get-pip.py",
+    "sudo pip install awscli boto3 --upgrade"
+]
+
+# The function's code until the stack has a LambdaS3Key, which it can't until the Lambda bucket exists.  Having the
+# function from the start means its permission and the data bucket's notifications are set up with everything else,
+# leaving just the code to change once it's uploaded.  It fails whatever it's sent, so that S3 and the event queue
+# send it again.
+LAMBDA_PLACEHOLDER = "\n".join([
+    "def lambda_handler(event, context):",
+    "    raise RuntimeError('The Wiglaf Lambda code has not been uploaded yet.')",
+    ""
+])
+
 WIGLAF_TEMPLATE = {
     "Parameters":{
         "ClusterName":{
@@ -29,6 +50,16 @@ WIGLAF_TEMPLATE = {
         "LambdaS3Key":{
             "Type":"String",
             "Default":""
+        },
+        "EventBatchSize":{
+            "Type":"Number",
+            "Default":"0",
+            "Description":"If more than 0, data bucket notifications go through a queue, and the Lambda gets up to this many at once."
+        },
+        "EventBatchWindow":{
+            "Type":"Number",
+            "Default":"10",
+            "Description":"With an event queue, how many seconds the Lambda waits to fill a batch."
         }
     },
     "Conditions":{
@@ -40,6 +71,9 @@ WIGLAF_TEMPLATE = {
         },
         "LambdaS3KeyProvided":{
             "Fn::Not":[{"Fn::Equals":["",{"Ref":"LambdaS3Key"}]}]
+        },
+        "EventQueueEnabled":{
+            "Fn::Not":[{"Fn::Equals":["0",{"Ref":"EventBatchSize"}]}]
         }
     },
     "Resources":{
@@ -51,17 +85,76 @@ WIGLAF_TEMPLATE = {
         },
         "DataBucket":{
             "Type":"AWS::S3::Bucket",
+            # S3 checks that it may send to a notification's destination when the notification is set up, so the
+            # bucket waits for the function's permission or the queue's policy.  DependsOn can't name the policy,
+            # which has a condition, but a Ref in the metadata can.
+            "Metadata":{
+                "NotificationDependencies":[
+                    {"Ref":"Permission"},
+                    {"Fn::If":["EventQueueEnabled",{"Ref":"EventQueuePolicy"},""]}
+                ]
+            },
             "Properties":{
                 "AccessControl": "BucketOwnerFullControl",
                 "NotificationConfiguration": {
-                    "Fn::If":["LambdaS3KeyProvided",{
+                    "Fn::If":["EventQueueEnabled",{
+                        "QueueConfigurations":[
+                            {
+                                "Event":"s3:ObjectCreated:*",
+                                "Queue":{ "Fn::GetAtt": ["EventQueue", "Arn"] }
+                            }
+                        ]
+                    },{
                         "LambdaConfigurations":[
                             {
                                 "Event":"s3:ObjectCreated:*",
                                 "Function":{ "Fn::GetAtt": ["Function", "Arn"] }
                             }
                         ]
-                    },{"Ref":"AWS::NoValue"}]}
+                    }]}
+            }
+        },
+        "StateTable":{
+            "Type":"AWS::DynamoDB::Table",
+            "Properties":{
+                "AttributeDefinitions":[
+                    {
+                        "AttributeName":"Id",
+                        "AttributeType":"S"
+                    },
+                    {
+                        "AttributeName":"Job",
+                        "AttributeType":"S"
+                    }
+                ],
+                "KeySchema":[
+                    {
+                        "AttributeName":"Id",
+                        "KeyType":"HASH"
+                    }
+                ],
+                # The work queue's batches and reducers by job (see wiglaf/node/work_queue.py).  Only they have a
+                # Job, so that's all the index holds.
+                "GlobalSecondaryIndexes":[
+                    {
+                        "IndexName":"JobIndex",
+                        "KeySchema":[
+                            {
+                                "AttributeName":"Job",
+                                "KeyType":"HASH"
+                            },
+                            {
+                                "AttributeName":"Id",
+                                "KeyType":"RANGE"
+                            }
+                        ],
+                        "Projection":{
+                            "ProjectionType":"INCLUDE",
+                            "NonKeyAttributes":["Owner", "LeaseExpires", "Done", "ClaimedAt", "DoneAt"]
+                        }
+                    }
+                ],
+                "BillingMode":"PAY_PER_REQUEST"
             }
         },
         "VPC":{
@@ -178,10 +271,9 @@ WIGLAF_TEMPLATE = {
                         "Fn::Join":[
                             "\n",[
                                 "#!/bin/bash",
-                                "sudo apt-get install -y python3",
-                                "wget -O /tmp/get-pip.py 'https://bootstrap.pypa.io/get-pip.py'",
-                                "sudo python3 /tmp/get-pip.py",
-                                "sudo pip install awscli --upgrade",
+                                "if [ ! -f {} ]; then".format(BAKED_FILE)
+                            ] + BOOTSTRAP_COMMANDS + [
+                                "fi",
                                 {"Fn::Sub":"aws s3 cp s3://${DataBucket}/do_stuff.sh /tmp/do_stuff.sh"},
                                 "chmod +x /tmp/do_stuff.sh",
                                 "/tmp/do_stuff.sh",
@@ -217,35 +309,94 @@ WIGLAF_TEMPLATE = {
         },
         "Function":{
             "Type":"AWS::Lambda::Function",
-            "Condition":"LambdaS3KeyProvided",
             "Properties":{
-                "Code":{
+                "Code":{"Fn::If":["LambdaS3KeyProvided",{
                     "S3Bucket":{"Ref":"LambdaBucket"},
                     "S3Key":{"Ref":"LambdaS3Key"}
-                },
+                },{
+                    "ZipFile":LAMBDA_PLACEHOLDER
+                }]},
                 "Environment":{
                     "Variables":{
                         "SNS_TOPIC":{"Fn::If":["EmailAddressProvided",{"Ref":"Topic"},{"Ref":"AWS::NoValue"}]},
                         "STACK_NAME":{"Ref":"AWS::StackName"},
+                        "STATE_TABLE":{"Ref":"StateTable"},
                         "CLUSTER_NAME":{"Ref":"ClusterName"}
                     }
                 },
-                "Handler":"handlers.lambda_handler",
+                "Handler":{"Fn::If":["LambdaS3KeyProvided","handlers.lambda_handler","index.lambda_handler"]},
                 "MemorySize":"128",
                 "Role":{"Fn::GetAtt":["LambdaRole","Arn"]},
                 "Runtime":"python3.6",
-                "Timeout":"10"
+                # Finishing a job lists all of its results and writes their index in one invocation.  Keep
+                # COMPLETION_LEASE_SECONDS in lambda/handlers.py longer than this.
+                "Timeout":"120"
             }
         },
         "Permission":{
             "Type":"AWS::Lambda::Permission",
-            "Condition":"LambdaS3KeyProvided",
             "Properties":{
                 "FunctionName": { "Ref": "Function" },
                 "Action": "lambda:InvokeFunction",
                 "Principal": "s3.amazonaws.com",
                 "SourceArn": {"Fn::Sub":"arn:${AWS::Partition}:s3:::*"}
             }
+        },
+        "EventQueue":{
+            "Type":"AWS::SQS::Queue",
+            "Condition":"EventQueueEnabled",
+            "Properties":{
+                # At least the function's Timeout, or the event source mapping can't be made.
+                "VisibilityTimeout":"180",
+                # A notification that keeps failing (say, for a result the Lambda can't parse) is set aside after
+                # this many tries rather than retried until it expires, holding up the rest of its batch each time.
+                "RedrivePolicy":{
+                    "deadLetterTargetArn":{"Fn::GetAtt":["EventDeadLetterQueue","Arn"]},
+                    "maxReceiveCount":10
+                }
+            }
+        },
+        "EventDeadLetterQueue":{
+            "Type":"AWS::SQS::Queue",
+            "Condition":"EventQueueEnabled",
+            "Properties":{
+                # As long as SQS allows, to leave time to look into them.
+                "MessageRetentionPeriod":"1209600"
+            }
+        },
+        "EventQueuePolicy":{
+            "Type":"AWS::SQS::QueuePolicy",
+            "Condition":"EventQueueEnabled",
+            "Properties":{
+                "Queues":[{"Ref":"EventQueue"}],
+                "PolicyDocument":{
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Principal": {
+                                "Service": "s3.amazonaws.com"
+                            },
+                            "Action": "sqs:SendMessage",
+                            "Resource": {"Fn::GetAtt":["EventQueue","Arn"]},
+                            "Condition": {
+                                "ArnLike": {"aws:SourceArn": {"Fn::Sub":"arn:${AWS::Partition}:s3:::*"}}
+                            }
+                        }
+                    ]
+                }
+            }
+        },
+        "EventSourceMapping":{
+            "Type":"AWS::Lambda::EventSourceMapping",
+            "Condition":"EventQueueEnabled",
+            "Properties":{
+                "EventSourceArn":{"Fn::GetAtt":["EventQueue","Arn"]},
+                "FunctionName":{"Ref":"Function"},
+                "BatchSize":{"Ref":"EventBatchSize"},
+                "MaximumBatchingWindowInSeconds":{"Ref":"EventBatchWindow"},
+                "FunctionResponseTypes":["ReportBatchItemFailures"]
+            }
         }
     },
     "Outputs":{
@@ -257,9 +408,108 @@ WIGLAF_TEMPLATE = {
         },
         "AutoScalingGroup":{
             "Value":{"Ref":"AutoScalingGroup"}
+        },
+        "StateTable":{
+            "Value":{"Ref":"StateTable"}
+        },
+        "EventDeadLetterQueue":{
+            "Condition":"EventQueueEnabled",
+            "Value":{"Ref":"EventDeadLetterQueue"}
         }
     }
 }
 
-WIGLAF_TEMPLATE_BODY = json.dumps(WIGLAF_TEMPLATE, separators=(',',':'))
+SPOT_ALLOCATION_STRATEGIES = ["price-capacity-optimized", "capacity-optimized", "capacity-optimized-prioritized", "lowest-price"]
+DEFAULT_FLEET_AVAILABILITY_ZONES = 2
+
+FLEET_PARAMETERS = {
+    "OnDemandBaseCapacity":{
+        "Type":"Number",
+        "Default":"0",
+        "Description":"How many nodes to always run on demand."
+    },
+    "OnDemandPercentage":{
+        "Type":"Number",
+        "Default":"100",
+        "Description":"Percentage of the nodes above the base capacity to run on demand.  The rest are spot instances."
+    },
+    "SpotAllocationStrategy":{
+        "Type":"String",
+        "Default":SPOT_ALLOCATION_STRATEGIES[0],
+        "AllowedValues":SPOT_ALLOCATION_STRATEGIES
+    }
+}
 
+def cluster_template(instance_types=None, availability_zones=None):
+    """
+    Returns the cluster template.  Without instance_types it's WIGLAF_TEMPLATE: nodes of one InstanceType, on
+    demand, in one subnet.  With them it runs the nodes as a fleet instead: a launch template and a
+    MixedInstancesPolicy across instance_types (in order of preference, for capacity-optimized-prioritized),
+    spread over availability_zones subnets, with capacity rebalancing.  The mix of spot and on demand instances
+    comes from the OnDemandBaseCapacity, OnDemandPercentage and SpotAllocationStrategy parameters.
+    """
+    template = copy.deepcopy(WIGLAF_TEMPLATE)
+    if not instance_types:
+        return template
+    availability_zones = int(availability_zones or DEFAULT_FLEET_AVAILABILITY_ZONES)
+    template["Parameters"].update(copy.deepcopy(FLEET_PARAMETERS))
+    resources = template["Resources"]
+    del resources["Subnet"]
+    del resources["SubnetRouteTableAssociation"]
+    subnets = []
+    for i in range(availability_zones):
+        # New names and address ranges, so that switching an existing cluster over doesn't clash with the old subnet.
+        subnet = "FleetSubnet{}".format(i)
+        resources[subnet] = {
+            "Type":"AWS::EC2::Subnet",
+            "Properties":{
+                "VpcId":{"Ref":"VPC"},
+                "MapPublicIpOnLaunch":"true",
+                "CidrBlock":"10.0.{}.0/24".format(i + 1),
+                "AvailabilityZone":{"Fn::Select":[str(i), {"Fn::GetAZs":""}]}
+            }
+        }
+        resources["{}RouteTableAssociation".format(subnet)] = {
+            "Type":"AWS::EC2::SubnetRouteTableAssociation",
+            "Properties":{
+                "SubnetId":{"Ref":subnet},
+                "RouteTableId":{"Ref":"RouteTable"}
+            }
+        }
+        subnets.append({"Ref":subnet})
+    launch_configuration = resources.pop("LaunchConfiguration")["Properties"]
+    resources["LaunchTemplate"] = {
+        "Type":"AWS::EC2::LaunchTemplate",
+        "DependsOn":"Route",
+        "Properties":{
+            "LaunchTemplateData":{
+                "IamInstanceProfile":{"Arn":{"Fn::GetAtt":["InstanceProfile","Arn"]}},
+                "ImageId":launch_configuration["ImageId"],
+                "InstanceType":launch_configuration["InstanceType"],
+                "KeyName":launch_configuration["KeyName"],
+                "UserData":launch_configuration["UserData"]
+            }
+        }
+    }
+    group = resources["AutoScalingGroup"]["Properties"]
+    del group["LaunchConfigurationName"]
+    group["MixedInstancesPolicy"] = {
+        "LaunchTemplate":{
+            "LaunchTemplateSpecification":{
+                "LaunchTemplateId":{"Ref":"LaunchTemplate"},
+                "Version":{"Fn::GetAtt":["LaunchTemplate","LatestVersionNumber"]}
+            },
+            "Overrides":[{"InstanceType":instance_type} for instance_type in instance_types]
+        },
+        "InstancesDistribution":{
+            "OnDemandBaseCapacity":{"Ref":"OnDemandBaseCapacity"},
+            "OnDemandPercentageAboveBaseCapacity":{"Ref":"OnDemandPercentage"},
+            "SpotAllocationStrategy":{"Ref":"SpotAllocationStrategy"}
+        }
+    }
+    # Launches a replacement when EC2 says a spot instance is at risk, rather than waiting for it to be reclaimed.
+    group["CapacityRebalance"] = True
+    group["VPCZoneIdentifier"] = subnets
+    return template
+
+WIGLAF_TEMPLATE_BODY = json.dumps(WIGLAF_TEMPLATE, separators=(',',':'))
@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 
-import boto3
 import copy
+import functools
 import logging
+import os
 import sys
-import wiglaf.cloudformation
+import tempfile
 
 from calvin import json
 
+# boto3 (and so most of wiglaf) takes a good fraction of a second to import, and wrapper scripts run the CLI in
+# loops, so operations import what they use themselves, and the AWS session is only set up by the ones that talk
+# to AWS (see uses_aws).  benchmarks/cli_startup.py checks that this stays that way.
+
 defaults = {
     "region":"us-east-1"
 }
@@ -16,6 +21,10 @@ required = [
     "region","profile","cluster_name"
 ]
 
+# A file to write a profile of the AWS calls each command makes to (see wiglaf/profiling.py).  With -v and no file,
+# the profile goes to stderr.
+PROFILE_VARIABLE = "WIGLAF_PROFILE"
+
 def load_config(**kwargs):
     conf = copy.deepcopy(defaults)
     if kwargs.get("config"):
@@ -28,23 +37,78 @@ def load_config(**kwargs):
         raise RuntimeError("Required argument(s) missing: {}".format(", ".join(missing)))
     return conf
 
+def uses_aws(method):
+    """
+    Marks an operation that talks to AWS, so that the session is set up before it runs.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._connect()
+        return method(self, *args, **kwargs)
+    return wrapper
+
 class Wiglaf(object):
 
     def __init__(self, **kwargs):
         self.config = load_config(**kwargs)
+        self._connected = False
+        self._profile = None
         root_logger = logging.getLogger()
         if self.config.get("verbosity"):
             root_logger.setLevel(logging.DEBUG)
         else:
             root_logger.setLevel(logging.INFO)
-        boto3.setup_default_session(region_name=self.config["region"], profile_name=self.config["profile"])
         for noisy in ('botocore', 'boto3', 'requests'):
             logging.getLogger(noisy).level = logging.WARN
             pass
 
+    def _connect(self):
+        if not self._connected:
+            import boto3
+            boto3.setup_default_session(region_name=self.config["region"], profile_name=self.config["profile"])
+            if self.config.get("verbosity") or os.getenv(PROFILE_VARIABLE):
+                # Before anything makes a client, so that they all get the hooks.
+                import wiglaf.profiling
+                self._profile = wiglaf.profiling.CallProfile()
+                self._profile.attach(boto3.DEFAULT_SESSION.events)
+            self._connected = True
+
+    def write_profile(self, command):
+        """
+        Writes out the profile of the AWS calls made so far, if there is one.
+        """
+        if self._profile is None:
+            return
+        import wiglaf.profiling
+        profile = wiglaf.profiling.format_json(self._profile.as_dict(command=command))
+        if os.getenv(PROFILE_VARIABLE):
+            with open(os.getenv(PROFILE_VARIABLE), "w") as f:
+                f.write(profile + "\n")
+        else:
+            sys.stderr.write(profile + "\n")
+
+    @property
+    def _outputs(self):
+        import wiglaf.cloudformation
+        self._connect()
+        return wiglaf.cloudformation.stack_outputs(**self.config)
+
     @property
     def _data_bucket(self):
-        return wiglaf.cloudformation.describe_stack(**self.config)["Outputs"]["DataBucket"]
+        return self._outputs["DataBucket"]
+
+    @property
+    def _concurrency(self):
+        import wiglaf.s3
+        return int(self.config.get("concurrency") or wiglaf.s3.DEFAULT_CONCURRENCY)
+
+    def _erase_prefix(self, bucket, prefix):
+        import wiglaf.s3
+        stats = wiglaf.s3.delete_prefix(bucket=bucket, prefix=prefix, concurrency=self._concurrency)
+        print("Deleted {} objects from s3://{}/{} in {:.1f}s ({:.0f} keys/s).".format(
+            stats["deleted"], bucket, prefix, stats["seconds"], stats["keys_per_second"]))
+        if stats["failed"]:
+            raise RuntimeError("{} objects could not be deleted.".format(stats["failed"]))
 
     @property
     def _cluster_name(self):
@@ -52,15 +116,27 @@ class Wiglaf(object):
 
     @property
     def _job_name(self):
-        return self.config.get("job_name")
+        if self.config.get("job_name"):
+            return self.config["job_name"]
+        if self.config.get("manifest"):
+            return json.loadf(self.config["manifest"])["JobName"]
+        raise RuntimeError("Must specify either a job name or a manifest!")
 
+    @uses_aws
     def create_cluster(self, *args, **kwargs):
-        return wiglaf.cloudformation.launch_cluster_stack(skip_create=False, **self.config)
+        import wiglaf.cloudformation
+        timings = wiglaf.cloudformation.launch_cluster_stack(skip_create=False, **self.config)
+        return wiglaf.cloudformation.format_timings(self._cluster_name, timings)
 
+    @uses_aws
     def update_cluster(self, *args, **kwargs):
-        return wiglaf.cloudformation.launch_cluster_stack(skip_create=True, **self.config)
+        import wiglaf.cloudformation
+        timings = wiglaf.cloudformation.launch_cluster_stack(skip_create=True, **self.config)
+        return wiglaf.cloudformation.format_timings(self._cluster_name, timings)
 
+    @uses_aws
     def describe_cluster(self, *args, **kwargs):
+        import wiglaf.cloudformation
         print(json.dumps(wiglaf.cloudformation.get_stack_info(**self.config), indent=4, sort_keys=True))
 
     def delete_cluster(self, *args, **kwargs):
@@ -79,43 +155,207 @@ class Wiglaf(object):
         print("generate_manifest not yet implemented")
         pass
 
+    @uses_aws
     def erase_job(self, *args, **kwargs):
-        print("erase_job not yet implemented")
-        pass
+        import wiglaf.cas
+        import wiglaf.state
+        outputs = self._outputs
+        self._erase_prefix(outputs["DataBucket"], "jobs/{}/".format(self._job_name))
+        if outputs.get("StateTable"):
+            wiglaf.state.clear_job(outputs["StateTable"], self._job_name)
+        stats = wiglaf.cas.collect_garbage(outputs["DataBucket"])
+        print("Removed {} resources ({:.1f} MB) no other job uses from the content store.".format(stats["deleted"], stats["bytes_freed"] / 1e6))
 
+    @uses_aws
     def erase_data(self, *args, **kwargs):
-        print("erase_data not yet implemented")
-        pass
+        outputs = self._outputs
+        for bucket in [outputs["DataBucket"], outputs["LambdaBucket"]]:
+            self._erase_prefix(bucket, "")
+
+    @uses_aws
+    def _report(self, default_format):
+        import wiglaf.report
+        report = wiglaf.report.job_report(self._data_bucket, self._job_name)
+        if (self.config.get("output_format") or default_format) == "json":
+            return wiglaf.report.format_json(report)
+        return wiglaf.report.format_text(report)
 
     def generate_report(self, *args, **kwargs):
-        print("generate_report not yet implemented")
-        pass
+        return self._report("json")
 
+    @uses_aws
+    def aggregate_metrics(self, *args, **kwargs):
+        import wiglaf.metrics
+        aggregated = wiglaf.metrics.aggregate(wiglaf.metrics.read_metrics(self._data_bucket, self._job_name, concurrency=self._concurrency))
+        if self.config.get("output_format") == "json":
+            return wiglaf.metrics.format_json(aggregated)
+        return wiglaf.metrics.format_text(aggregated)
+
+    @uses_aws
     def clear_results(self, *args, **kwargs):
-        print("clear_results not yet implemented")
-        pass
+        import wiglaf.state
+        outputs = self._outputs
+        for kind in ["results", "results-index", "reduce"]:
+            self._erase_prefix(outputs["DataBucket"], "jobs/{}/{}/".format(self._job_name, kind))
+        if outputs.get("StateTable"):
+            wiglaf.state.clear_results(outputs["StateTable"], self._job_name)
 
+    @uses_aws
     def list_results(self, *args, **kwargs):
-        print("list_results not yet implemented")
-        pass
+        import wiglaf.results
+        import wiglaf.s3
+        bucket = self._data_bucket
+        s3 = wiglaf.s3.client("s3")
+        summary = wiglaf.results.load_summary(bucket, self._job_name, s3=s3)
+        if summary is None:
+            print("Job '{}' has no results index yet, so listing its results.".format(self._job_name))
+        # Links are made as entries stream past, so only the ones asked for are ever signed.
+        for entry in wiglaf.results.iter_results(bucket, self._job_name, summary=summary, s3=s3):
+            link = wiglaf.results.presign(bucket, self._job_name, entry, s3=s3) if self.config.get("presign") else None
+            if self.config.get("output_format") == "json":
+                print(json.dumps(dict(entry, url=link) if link else entry, sort_keys=True))
+            else:
+                print(wiglaf.results.format_text(entry, link))
+        if summary is not None and self.config.get("output_format") != "json":
+            print("{} files, {:.1f} MB.".format(summary["Files"], summary["Bytes"] / 1e6))
+
+    @uses_aws
+    def print_logs(self, *args, **kwargs):
+        import wiglaf.logs
+        wiglaf.logs.tail_logs(self._data_bucket, self._job_name, instance=self.config.get("instance_id"),
+                              logfile=self.config.get("log_file"), follow=self.config.get("follow"))
 
+    @uses_aws
     def download_results(self, *args, **kwargs):
-        print("download_results not yet implemented")
-        prefix = "/".join(["jobs", self._job_name, "results"])
-        return wiglaf.s3.download_files(bucket=self._data_bucket, prefix=prefix, directory=self.config.get("results_directory"))
+        import wiglaf.results
+        import wiglaf.s3
+        bucket = self._data_bucket
+        prefix = wiglaf.results.results_prefix(self._job_name)
+        s3 = wiglaf.s3.client("s3", max_pool_connections=self._concurrency)
+        summary = wiglaf.results.load_summary(bucket, self._job_name, s3=s3)
+        if summary is not None:
+            reduced = summary["Reduced"] and not self.config.get("all_results")
+        else:
+            reduced = not self.config.get("all_results") and wiglaf.s3.load(bucket, "jobs/{}/resources/wiglaf_manifest.json".format(self._job_name)).get("Reduce")
+        # With a reduce stage, just its merged outputs rather than every batch's.
+        entries = wiglaf.results.select(wiglaf.results.iter_results(bucket, self._job_name, summary=summary, s3=s3), reduced=reduced)
+        if reduced:
+            prefix += "reduced/"
+        objects = (wiglaf.results.as_listing(self._job_name, e) for e in entries)
+        directory = self.config.get("results_directory") or os.path.join(".", self._job_name)
+        stats = wiglaf.s3.download_files(bucket=bucket, prefix=prefix, directory=directory, concurrency=self._concurrency, s3=s3, objects=objects)
+        print("Downloaded {} files ({:.1f} MB) to {} at {:.1f} MB/s.  Skipped {} unchanged files.".format(
+            stats["files"], stats["bytes"] / 1e6, directory, stats["bytes_per_second"] / 1e6, stats["skipped"]))
+        if stats["errors"]:
+            raise RuntimeError("{} files failed to download.".format(stats["errors"]))
+
+    def _load_manifest(self):
+        if not self.config.get("manifest"):
+            raise RuntimeError("Must specify a manifest!")
+        import wiglaf.node.reducer
+        manifest = json.loadf(self.config["manifest"])
+        manifest["JobName"] = self._job_name
+        wiglaf.node.reducer.check(manifest)
+        return manifest
+
+    def _upload_resources(self, manifest, bucket):
+        import wiglaf.bundle
+        import wiglaf.cas
+        directory = manifest.get("LocalDirectory", ".")
+        filenames = manifest.get("FilesToDownload", [])
+        if not filenames:
+            return
+        # Big files are stored on their own so they're shared between jobs even when the small files change.
+        if manifest.get("BundleResources", True):
+            large = [f for f in filenames if os.path.getsize(os.path.join(directory, f)) >= wiglaf.cas.UNBUNDLED_SIZE]
+        else:
+            large = list(filenames)
+        small = [f for f in filenames if f not in large]
+        digests = wiglaf.cas.put_files([os.path.join(directory, f) for f in large], bucket, concurrency=self._concurrency)
+        manifest["Resources"] = {f:digests[os.path.join(directory, f)] for f in large}
+        if small:
+            with tempfile.TemporaryDirectory() as workdir:
+                manifest["Bundle"] = wiglaf.bundle.upload_bundle(directory, small, bucket, workdir)
+        print("Stored {} resource files ({} bundled) in the content store.".format(len(filenames), len(small)))
+
+    def _base_image_id(self, stack):
+        # The image the cluster was created with, even if it's currently running one baked from it.
+        import wiglaf.bake
+        if self.config.get("image_id"):
+            return self.config["image_id"]
+        image_id = stack["Parameters"]["ImageId"]
+        record = wiglaf.bake.find_image_by_id(stack["Outputs"]["DataBucket"], image_id)
+        return record["BaseImageId"] if record else image_id
 
+    def _use_baked_image(self, manifest, bucket, switch=False):
+        """
+        Points the cluster at the image baked for the job's install section if there is one, and back at the base
+        image if it's on one baked for something else.  Changing the image updates the stack, which takes minutes
+        and changes the image nodes are launched from under whatever job is running, so it's only done while the
+        cluster has no nodes, or with switch.  Sets the manifest's InstallHash, which tells nodes whether their image
+        already has the job installed, so jobs run either way.
+        """
+        import wiglaf.bake
+        import wiglaf.cloudformation
+        import wiglaf.s3
+        stack = wiglaf.cloudformation.describe_stack(self._cluster_name)
+        base_image_id = self._base_image_id(stack)
+        manifest["InstallHash"] = wiglaf.bake.install_hash(manifest, base_image_id)
+        record = wiglaf.bake.find_image(bucket, manifest["InstallHash"])
+        image_id = record["ImageId"] if record else base_image_id
+        if stack["Parameters"]["ImageId"] == image_id:
+            if record:
+                print("Using image {}, baked for this job.".format(image_id))
+            return
+        group = wiglaf.s3.client("autoscaling").describe_auto_scaling_groups(AutoScalingGroupNames=[stack["Outputs"]["AutoScalingGroup"]])["AutoScalingGroups"][0]
+        if group["Instances"] and not switch:
+            print("The cluster has {} nodes running, so it stays on image {}{}.  Use --switch-image to switch it to {} anyway.".format(
+                len(group["Instances"]), stack["Parameters"]["ImageId"], " rather than the one baked for this job" if record else "", image_id))
+            return
+        print("Switching the cluster to image {}{}.".format(image_id, " (baked for this job)" if record else ""))
+        wiglaf.cloudformation.set_stack_parameters(self._cluster_name, ImageId=image_id)
+
+    @uses_aws
     def start_job(self, *args, **kwargs):
-        print("start_job not yet implemented")
-        pass
+        import wiglaf.s3
+        import wiglaf.state
+        manifest = self._load_manifest()
+        outputs = self._outputs
+        bucket = outputs["DataBucket"]
+        self._upload_resources(manifest, bucket)
+        self._use_baked_image(manifest, bucket, switch=self.config.get("switch_image"))
+        # A job that has run before under this name would otherwise look finished: its batches are done and its
+        # results counted, so the nodes and the Lambda would have nothing to do.
+        if outputs.get("StateTable"):
+            wiglaf.state.clear_job(outputs["StateTable"], manifest["JobName"])
+        # Uploading the manifest is what kicks off the job, so it always goes last and always gets uploaded.
+        wiglaf.s3.client("s3").put_object(Bucket=bucket, Key="manifest.json", Body=json.dumps(manifest, indent=4, sort_keys=True).encode("utf-8"))
+        print("Started job '{}'.".format(manifest["JobName"]))
 
     def abort_job(self, *args, **kwargs):
         print("abort_job not yet implemented")
         pass
 
     def describe_job(self, *args, **kwargs):
-        print("describe_job not yet implemented")
-        pass
+        return self._report("text")
 
+    @uses_aws
     def bake_image(self, *args, **kwargs):
-        print("bake_image not yet implemented")
-        pass
+        import wiglaf.bake
+        import wiglaf.cloudformation
+        import wiglaf.s3
+        manifest = self._load_manifest()
+        outputs = self._outputs
+        bucket = outputs["DataBucket"]
+        self._upload_resources(manifest, bucket)
+        stack = wiglaf.cloudformation.describe_stack(self._cluster_name)
+        base_image_id = self._base_image_id(stack)
+        digest = wiglaf.bake.install_hash(manifest, base_image_id)
+        record = wiglaf.bake.find_image(bucket, digest)
+        if record:
+            print("Image {} was already baked for this install section.".format(record["ImageId"]))
+        else:
+            settings = wiglaf.bake.launch_settings(outputs["AutoScalingGroup"], wiglaf.s3.client("autoscaling"), wiglaf.s3.client("ec2"))
+            record = wiglaf.bake.bake(bucket, manifest, base_image_id, settings, digest=digest)
+            print("Baked image {} for job '{}'.  Jobs with the same install section will use it.".format(record["ImageId"], manifest["JobName"]))
+        self._use_baked_image(manifest, bucket, switch=self.config.get("switch_image"))
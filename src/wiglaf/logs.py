@@ -0,0 +1,74 @@
+import gzip
+import logging
+import sys
+import time
+import wiglaf.s3
+
+# Reads back the logs nodes ship while they run (see wiglaf/node/log_shipper.py).  Each log is stored as numbered,
+# gzipped segments under jobs/<job>/logs/<instance>/<logfile>/, which are concatenated in key order to get the
+# whole file.  Jobs run before logs were shipped incrementally have one jobs/<job>/logs/<instance>.<logfile>
+# object per log instead, which is read as a single segment.
+
+DEFAULT_FOLLOW_INTERVAL = 5
+
+def _logs_prefix(job_name):
+    return "jobs/{}/logs/".format(job_name)
+
+def _parse_key(job_name, key):
+    """
+    Returns (instance, logfile, segment key) for a log object, or None if it isn't one.
+    """
+    rest = key[len(_logs_prefix(job_name)):]
+    parts = rest.split("/")
+    if len(parts) == 3 and parts[2].endswith(".gz"):
+        return parts[0], parts[1], key
+    if len(parts) == 1 and "." in rest:
+        instance, logfile = rest.split(".", 1)
+        return instance, logfile, key
+    return None
+
+def list_logs(bucket, job_name, instance=None, logfile=None, s3=None):
+    """
+    Returns {(instance, logfile): [segment keys in order]} for a job's logs, optionally just one instance or file.
+    """
+    prefix = _logs_prefix(job_name) + (instance if instance else "")
+    logs = {}
+    for obj in wiglaf.s3.iter_files(bucket, prefix, s3=s3):
+        parsed = _parse_key(job_name, obj["Key"])
+        if not parsed or (instance and parsed[0] != instance) or (logfile and parsed[1] != logfile):
+            continue
+        logs.setdefault(parsed[:2], []).append(parsed[2])
+    return logs
+
+def read_segment(bucket, key, s3=None):
+    s3 = s3 if s3 else wiglaf.s3.client("s3")
+    data = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    return gzip.decompress(data) if key.endswith(".gz") else data
+
+def read_log(bucket, job_name, instance, logfile, s3=None):
+    """
+    Reassembles one log from its segments.
+    """
+    segments = list_logs(bucket, job_name, instance=instance, logfile=logfile, s3=s3).get((instance, logfile), [])
+    return b"".join(read_segment(bucket, key, s3=s3) for key in segments)
+
+def tail_logs(bucket, job_name, instance=None, logfile=None, follow=False, interval=DEFAULT_FOLLOW_INTERVAL, out=None, s3=None):
+    """
+    Writes a job's logs to out (stdout by default), each line prefixed with its instance and file.  With follow,
+    keeps polling for new segments until interrupted.
+    """
+    out = out if out else sys.stdout
+    seen = set()
+    while True:
+        for (log_instance, log_name), keys in sorted(list_logs(bucket, job_name, instance=instance, logfile=logfile, s3=s3).items()):
+            for key in keys:
+                if key in seen:
+                    continue
+                seen.add(key)
+                for line in read_segment(bucket, key, s3=s3).decode("utf-8", "replace").splitlines():
+                    out.write("{} {}: {}\n".format(log_instance, log_name, line))
+        out.flush()
+        if not follow:
+            return
+        logging.debug("Waiting {}s for more log segments.".format(interval))
+        time.sleep(interval)
@@ -0,0 +1,120 @@
+import concurrent.futures
+import wiglaf.logs
+import wiglaf.s3
+import wiglaf.stats
+
+from calvin import json
+
+# Merges the metrics nodes record (see wiglaf/node/agent.py) into cluster-wide statistics.
+# Each node appends a JSON line per phase to its metrics file, which is shipped in gzipped segments to
+#   jobs/<job>/metrics/<instance>/wiglaf-metrics.jsonl/<n>.gz
+# "start" records mark a phase beginning; "end" records carry phase, start, end, wall, and (where they apply)
+# batch, slot, cpu, max_rss_kb, bytes_in and bytes_out.  Phases are named like the checkpoints: DownloadingFiles,
+# InstallCommands, CommandsToRun.<batch>, plus UploadingResults.<batch>, FlushingUploads and a Node summary.
+
+METRICS = ["wall", "cpu", "max_rss_kb", "bytes_in", "bytes_out"]
+# Histograms lump everything below these into one bucket, rather than running down to the smallest value.
+HISTOGRAM_MINIMUMS = {"wall":0.125, "cpu":0.125, "max_rss_kb":1024, "bytes_in":1024, "bytes_out":1024}
+DEFAULT_PERCENTILES = wiglaf.stats.DEFAULT_PERCENTILES
+
+# Summarizing is shared with the API call profiles.
+percentile = wiglaf.stats.percentile
+summarize = wiglaf.stats.summarize
+histogram = wiglaf.stats.histogram
+
+def read_metrics(bucket, job_name, concurrency=wiglaf.s3.DEFAULT_CONCURRENCY, s3=None):
+    """
+    Returns every metrics record a job's nodes have shipped so far.
+    """
+    s3 = s3 if s3 else wiglaf.s3.client("s3", max_pool_connections=concurrency)
+    keys = [obj["Key"] for obj in wiglaf.s3.iter_files(bucket, "jobs/{}/metrics/".format(job_name), s3=s3)]
+    records = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for segment in executor.map(lambda key: wiglaf.logs.read_segment(bucket, key, s3=s3), keys):
+            records.extend(json.loads(line) for line in segment.decode("utf-8").splitlines() if line.strip())
+    return records
+
+def timeline(records):
+    """
+    The same phase timeline wiglaf.report builds from checkpoints, built from metrics records instead.  The
+    per-node summary record is left out.
+    """
+    phases = {}
+    for record in records:
+        if record["phase"] == "Node":
+            continue
+        entry = phases.setdefault((record["instance"], record["phase"]), {"instance":record["instance"], "phase":record["phase"], "start":None, "end":None})
+        entry["start"] = record["start"]
+        if record["event"] == "end":
+            entry["end"] = record["end"]
+    entries = []
+    for entry in phases.values():
+        kind, _, batch = entry["phase"].partition(".")
+        entry["kind"] = kind
+        entry["batch"] = int(batch) if batch.isdigit() else None
+        entry["seconds"] = entry["end"] - entry["start"] if entry["end"] is not None else None
+        entries.append(entry)
+    return sorted(entries, key=lambda e: (e["start"], e["instance"]))
+
+def aggregate(records, percentiles=DEFAULT_PERCENTILES):
+    """
+    Merges finished-phase records into, for each kind of phase (CommandsToRun, DownloadingFiles, ...), a summary
+    and a histogram of each metric, plus cluster-wide totals.  The per-node summary record is left out.
+    """
+    by_kind = {}
+    for record in records:
+        if record["event"] == "end" and record["phase"] != "Node":
+            by_kind.setdefault(record["phase"].split(".")[0], []).append(record)
+    phases = {}
+    for kind, ends in sorted(by_kind.items()):
+        phases[kind] = {}
+        for metric in METRICS:
+            values = [end[metric] for end in ends if metric in end]
+            if values:
+                phases[kind][metric] = dict(summarize(values, percentiles), histogram=histogram(values, HISTOGRAM_MINIMUMS[metric]))
+    batches = by_kind.get("CommandsToRun", [])
+    wall = sum(end["wall"] for end in batches)
+    cpu = sum(end.get("cpu", 0) for end in batches)
+    totals = {
+        "instances":len(set(record["instance"] for record in records)),
+        "batches":len(batches),
+        "batch_seconds":wall,
+        "batch_cpu_seconds":cpu,
+        # Above 1 means batches are multi-threaded; well below 1 means they're waiting on something.
+        "cpu_per_wall_second":cpu / wall if wall else None,
+        "bytes_in":sum(end.get("bytes_in", 0) for ends in by_kind.values() for end in ends),
+        "bytes_out":sum(end.get("bytes_out", 0) for ends in by_kind.values() for end in ends)
+    }
+    return {"phases":phases, "totals":totals}
+
+def _format_value(metric, value):
+    if metric in ("wall", "cpu"):
+        return "{:.3g}s".format(value)
+    if metric == "max_rss_kb":
+        return "{:.0f}MB".format(value / 1024.0)
+    return "{:.1f}MB".format(value / 1e6)
+
+def format_text(aggregated):
+    totals = aggregated["totals"]
+    lines = [
+        "{} instances, {} batches".format(totals["instances"], totals["batches"]),
+        "Batch time: {:.1f}s wall, {:.1f}s CPU{}".format(totals["batch_seconds"], totals["batch_cpu_seconds"],
+                                                         " ({:.2f} CPU/wall)".format(totals["cpu_per_wall_second"]) if totals["cpu_per_wall_second"] is not None else ""),
+        "Transferred: {:.1f}MB in, {:.1f}MB out".format(totals["bytes_in"] / 1e6, totals["bytes_out"] / 1e6)
+    ]
+    for kind, metrics in aggregated["phases"].items():
+        for metric, summary in sorted(metrics.items()):
+            if not summary["total"] and metric != "wall":
+                continue
+            names = sorted(key for key in summary if key.startswith("p"))
+            lines.append("")
+            lines.append("{} {}: n={} mean {} {}".format(kind, metric, summary["count"], _format_value(metric, summary["mean"]),
+                                                        " ".join("{} {}".format(n, _format_value(metric, summary[n])) for n in names)))
+            peak = max(b["count"] for b in summary["histogram"]) or 1
+            for b in summary["histogram"]:
+                lines.append("  {:>10} - {:<10} {:>6} {}".format(_format_value(metric, b["low"]), _format_value(metric, b["high"]), b["count"],
+                                                               "#" * int(round(40.0 * b["count"] / peak))))
+    return "\n".join(lines)
+
+def format_json(aggregated):
+    return json.dumps(aggregated, indent=2, sort_keys=True)
@@ -0,0 +1,772 @@
+#!/usr/bin/env python3
+
+# Runs a wiglaf job on a node.
+#
+# The Lambda publishes the current job's manifest to wiglaf/current_manifest.json in the data bucket, and nodes
+# start this (via the fixed launcher it writes to do_stuff.sh).  The agent:
+#   - downloads the job's resources concurrently over one pooled client, through the on-node CAS cache
+#   - runs the InstallCommands once
+#     (both of which are skipped on an image baked for the job's install section; see wiglaf.bake, which runs the
+#     agent with --bake to do them once on a builder instance)
+#   - runs ConcurrencyPerNode slots, each pulling batches off the work queue and running CommandsToRun in its own
+#     copy of the work directory
+#   - uploads each batch's results in the background while the slot moves on to its next batch (see uploader.py),
+#     and makes sure they've all landed before terminating
+#   - once every batch is done, runs the job's reduce stage if it has one, a level of the tree at a time (see
+#     reducer.py)
+#   - records metrics for each phase and batch (wall and CPU time, peak memory, bytes moved) as JSON lines, which
+#     are shipped in batches to jobs/<job>/metrics/ and merged by wiglaf.metrics.  The per-phase checkpoint objects
+#     the old generated script wrote are still available with "Checkpoints": true in the manifest.
+#   - ships its logs as they grow (see log_shipper.py)
+#   - stops taking batches if EC2 recommends rebalancing away from it or gives notice that it's reclaiming a spot
+#     instance.  With notice, running batches are killed shortly before the deadline and handed back to the queue,
+#     so that what has finished can still be uploaded.
+#   - terminates the instance once the queue is drained
+# Like everything in wiglaf/node, it only depends on boto3 and the standard library.
+
+import argparse
+import calendar
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import resource
+import signal
+import stat
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import zipfile
+
+import boto3
+import botocore.config
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import log_shipper
+import reducer
+import uploader
+import work_queue
+
+CURRENT_MANIFEST_KEY = "wiglaf/current_manifest.json"
+WORK_DIRECTORY = "/tmp/wiglaf"
+# Baked images keep their work directory somewhere that survives a reboot.  BAKED_FILE matches the one in
+# wiglaf/cloudformation/templates.py.
+BAKED_WORK_DIRECTORY = "/var/lib/wiglaf/work"
+BAKED_FILE = "/etc/wiglaf/baked.json"
+SLOT_DIRECTORY = "/tmp/wiglaf-slots"
+CACHE_DIRECTORY = "/var/cache/wiglaf/cas"
+LOG_DIRECTORY = "/var/log"
+LOG_FILES = ["cloud-init.log", "cloud-init-output.log", "syslog", "wiglaf-agent.log"]
+METRICS_LOG = "wiglaf-metrics.jsonl"
+DEFAULT_METRICS_INTERVAL_SECONDS = 60
+DEFAULT_CONCURRENCY = 16
+METADATA_URL = "http://169.254.169.254/latest/"
+INTERRUPTION_POLL_SECONDS = 5
+# Running batches are killed this long before a spot instance is reclaimed, to leave time to upload finished ones.
+INTERRUPTION_MARGIN_SECONDS = 45
+
+def instance_metadata(path):
+    # IMDSv2 first, falling back to v1 for older images.
+    headers = {}
+    try:
+        request = urllib.request.Request(METADATA_URL + "api/token", method="PUT", headers={"X-aws-ec2-metadata-token-ttl-seconds":"300"})
+        headers["X-aws-ec2-metadata-token"] = urllib.request.urlopen(request, timeout=2).read().decode("utf-8")
+    except Exception:
+        pass
+    request = urllib.request.Request(METADATA_URL + "meta-data/" + path, headers=headers)
+    return urllib.request.urlopen(request, timeout=2).read().decode("utf-8")
+
+def spot_interruption_time(metadata=instance_metadata):
+    """
+    When EC2 is going to reclaim this spot instance, in epoch seconds, or None if it hasn't said.
+    """
+    try:
+        notice = json.loads(metadata("spot/instance-action"))
+    except Exception:
+        # It's a 404 until there's a notice (and always, on demand).
+        return None
+    return calendar.timegm(time.strptime(notice["time"], "%Y-%m-%dT%H:%M:%SZ"))
+
+def rebalance_recommended(metadata=instance_metadata):
+    try:
+        metadata("events/recommendations/rebalance")
+        return True
+    except Exception:
+        return False
+
+def slot_count(manifest):
+    concurrency = manifest.get("ConcurrencyPerNode", 1)
+    if concurrency != "auto":
+        return max(1, int(concurrency))
+    count = os.cpu_count() or 1
+    if manifest.get("MemoryPerBatchMB"):
+        with open("/proc/meminfo") as f:
+            total_kb = int([line.split()[1] for line in f if line.startswith("MemTotal")][0])
+        count = min(count, total_kb // 1024 // int(manifest["MemoryPerBatchMB"]))
+    return max(1, count)
+
+def tree_stats(root):
+    """
+    {path relative to root: (size, modification time)} for everything under root, with None for directories.
+    Symlinks are described rather than followed.
+    """
+    stats = {}
+    for directory, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(directory, name)
+            info = os.lstat(path)
+            stats[os.path.relpath(path, root)] = None if stat.S_ISDIR(info.st_mode) else (info.st_size, info.st_mtime_ns)
+    return stats
+
+class Phase(object):
+    """
+    Times a phase and adds up what it used: CPU time and peak RSS of the commands it ran, and bytes moved.
+    The start is recorded straight away, so that phases still running show up in reports.
+    """
+
+    def __init__(self, agent, name, index_name=None, **fields):
+        self.agent = agent
+        self.name = name
+        self.index_name = index_name
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.usage = {"cpu":0.0, "max_rss_kb":0, "bytes_in":0, "bytes_out":0}
+        self.start = None
+
+    def add(self, cpu=0.0, max_rss_kb=0, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.usage["cpu"] += cpu
+            self.usage["max_rss_kb"] = max(self.usage["max_rss_kb"], max_rss_kb)
+            self.usage["bytes_in"] += bytes_in
+            self.usage["bytes_out"] += bytes_out
+
+    def __enter__(self):
+        if self.agent.manifest.get("Checkpoints"):
+            self.agent.checkpoint(self.name, "begin", self.index_name)
+        self.start = time.time()
+        self.agent.emit(event="start", phase=self.name, start=round(self.start, 3), **self.fields)
+        return self
+
+    def __exit__(self, *exc):
+        fields = dict(self.fields, **self.usage)
+        fields["cpu"] = round(fields["cpu"], 3)
+        self.agent.record(self.name, self.start, time.time(), **fields)
+        if self.agent.manifest.get("Checkpoints"):
+            self.agent.checkpoint(self.name, "end", self.index_name)
+
+class Agent(object):
+
+    def __init__(self, bucket, table, instance_id=None, s3=None, ec2=None, queue=None,
+                 work_directory=WORK_DIRECTORY, slot_directory=SLOT_DIRECTORY, cache_directory=CACHE_DIRECTORY,
+                 log_directory=LOG_DIRECTORY, concurrency=DEFAULT_CONCURRENCY, metadata=instance_metadata, baked_file=BAKED_FILE):
+        self.bucket = bucket
+        self.metadata = metadata
+        self.instance_id = instance_id if instance_id else metadata("instance-id")
+        config = botocore.config.Config(max_pool_connections=concurrency * 2, retries={"max_attempts":10})
+        self.s3 = s3 if s3 else boto3.client("s3", config=config)
+        self.ec2 = ec2 if ec2 else boto3.client("ec2")
+        self.queue = queue if queue else work_queue.DynamoWorkQueue(table)
+        self.work_directory = work_directory
+        self.slot_directory = slot_directory
+        self.cache_directory = cache_directory
+        self.log_directory = log_directory
+        self.baked_file = baked_file
+        self.concurrency = concurrency
+        self.checkpoints = {}
+        self.metrics_lock = threading.Lock()
+        self.manifest = None
+        self.uploader = None
+        self.log_shipper = None
+        self.metrics_shipper = None
+        # Set once the node should stop taking batches, and once running ones have been killed.
+        self.draining = threading.Event()
+        self.interrupted = threading.Event()
+        self.processes = set()
+        self.process_lock = threading.Lock()
+        self.resource_stats = None
+        # {slot directory: tree_stats of it as prepare_slot left it}
+        self.slot_stats = {}
+
+    @property
+    def job_name(self):
+        return self.manifest["JobName"]
+
+    def job_key(self, *parts):
+        return "/".join(["jobs", self.job_name] + list(parts))
+
+    def load_manifest(self, key=CURRENT_MANIFEST_KEY):
+        body = self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        self.manifest = json.loads(body.decode("utf-8"))
+        return self.manifest
+
+    def checkpoint(self, name, step, index_name=None):
+        # Same keys the generated script used: <instance>.<index>-<name>-<begin|end>, one index per phase name.
+        index_name = index_name if index_name else name
+        with self.metrics_lock:
+            index = self.checkpoints.setdefault(index_name, len(self.checkpoints))
+        key = self.job_key("checkpoints", "{}.{}-{}-{}".format(self.instance_id, index, name, step))
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=time.strftime("%a %b %d %H:%M:%S UTC %Y\n", time.gmtime()).encode("utf-8"))
+
+    def emit(self, **fields):
+        """
+        Appends a record to the metrics file, which is shipped in batches along with the logs.
+        """
+        fields["instance"] = self.instance_id
+        line = json.dumps(fields, sort_keys=True)
+        with self.metrics_lock:
+            with open(os.path.join(self.log_directory, METRICS_LOG), "a") as f:
+                f.write(line + "\n")
+
+    def record(self, phase, start, end, **fields):
+        self.emit(event="end", phase=phase, start=round(start, 3), end=round(end, 3), wall=round(end - start, 3), **fields)
+        logging.info("{} took {:.1f}s.".format(phase, end - start))
+
+    def timed(self, name, index_name=None, **fields):
+        return Phase(self, name, index_name, **fields)
+
+    def fetch_cached(self, digest, phase):
+        cached = os.path.join(self.cache_directory, digest)
+        if not os.path.exists(cached):
+            partial = "{}.{}.part".format(cached, threading.get_ident())
+            self.s3.download_file(self.bucket, "cas/{}".format(digest), partial)
+            phase.add(bytes_in=os.path.getsize(partial))
+            os.replace(partial, cached)
+        return cached
+
+    def download_resources(self, phase):
+        os.makedirs(self.work_directory, exist_ok=True)
+        os.makedirs(self.cache_directory, exist_ok=True)
+
+        def resource(filename, digest):
+            target = os.path.join(self.work_directory, filename)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(self.fetch_cached(digest, phase), target)
+
+        def bundle(digest):
+            # Same as wiglaf.bundle.extract_bundle, which can't be imported here.
+            with zipfile.ZipFile(self.fetch_cached(digest, phase)) as z:
+                for info in z.infolist():
+                    target = z.extract(info, self.work_directory)
+                    mode = (info.external_attr >> 16) & 0o777
+                    if mode:
+                        os.chmod(target, mode)
+
+        def legacy(filename):
+            target = os.path.join(self.work_directory, filename)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            self.s3.download_file(self.bucket, self.job_key("resources", filename), target)
+            phase.add(bytes_in=os.path.getsize(target))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            if self.manifest.get("Resources") or self.manifest.get("Bundle"):
+                futures = [executor.submit(resource, f, d) for f, d in self.manifest.get("Resources", {}).items()]
+                if self.manifest.get("Bundle"):
+                    futures.append(executor.submit(bundle, self.manifest["Bundle"]))
+            else:
+                futures = [executor.submit(legacy, f) for f in self.manifest.get("FilesToDownload", [])]
+            for future in futures:
+                future.result()
+
+    def run_command(self, command, cwd, phase, env=None, log=None):
+        """
+        Runs a shell command, killing it (and anything it started) after the manifest's CommandTimeoutSeconds, if
+        given.  Output goes to the named log file under the log directory, or the agent's own output.  Its CPU time
+        and peak memory are added to the phase.  Returns the exit status, or None if it timed out or was stopped by
+        an interruption.
+        """
+        timeout = self.manifest.get("CommandTimeoutSeconds")
+        output = open(os.path.join(self.log_directory, log), "a") if log else sys.stdout
+        try:
+            output.write("Executing command {}\n".format(json.dumps(command)))
+            output.flush()
+            # Its own session, so that a timeout can kill the whole process group.
+            process = subprocess.Popen(command, shell=True, cwd=cwd, env=env, stdout=output, stderr=subprocess.STDOUT, start_new_session=True)
+            with self.process_lock:
+                self.processes.add(process.pid)
+            if self.interrupted.is_set():
+                self.kill(process.pid)
+            timed_out = threading.Event()
+
+            def kill():
+                timed_out.set()
+                self.kill(process.pid)
+
+            timer = threading.Timer(timeout, kill) if timeout else None
+            if timer:
+                timer.start()
+            # wait4 rather than Popen.wait, for the resource usage of the command and everything it waited on.
+            _, status, usage = os.wait4(process.pid, 0)
+            if timer:
+                timer.cancel()
+            with self.process_lock:
+                self.processes.discard(process.pid)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            phase.add(cpu=usage.ru_utime + usage.ru_stime, max_rss_kb=usage.ru_maxrss)
+            if self.interrupted.is_set() and process.returncode == -signal.SIGKILL:
+                logging.warning("Command {} was stopped because the instance is being reclaimed.".format(json.dumps(command)))
+                return None
+            if timed_out.is_set():
+                logging.warning("Command {} timed out after {} seconds.".format(json.dumps(command), timeout))
+                return None
+            if process.returncode:
+                logging.warning("Command {} exited with status {}.".format(json.dumps(command), process.returncode))
+            return process.returncode
+        finally:
+            if log:
+                output.close()
+
+    def kill(self, pid):
+        # Its process group, so that whatever the command started goes too.
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def interrupt(self):
+        """
+        Kills every running command, for when the instance is about to be reclaimed.
+        """
+        self.interrupted.set()
+        with self.process_lock:
+            pids = list(self.processes)
+        for pid in pids:
+            self.kill(pid)
+
+    def watch_interruptions(self, stop):
+        """
+        Polls the instance metadata until stop is set.  A rebalance recommendation means the instance is at higher
+        risk of being reclaimed (and with capacity rebalancing, the group is already launching its replacement), so
+        the node drains: it finishes its running batches but doesn't take any more.  A spot interruption notice
+        gives two minutes; the node drains, then kills whatever is still running INTERRUPTION_MARGIN_SECONDS
+        before the deadline, so that finished results can be uploaded and the rest handed back to the queue.
+        """
+        while not stop.wait(INTERRUPTION_POLL_SECONDS):
+            reclaim_at = spot_interruption_time(self.metadata)
+            if reclaim_at is None:
+                if not self.draining.is_set() and rebalance_recommended(self.metadata):
+                    logging.warning("EC2 recommends rebalancing away from this instance, so not taking any more batches.")
+                    self.draining.set()
+                continue
+            logging.warning("Instance will be reclaimed at {}, so not taking any more batches.".format(time.strftime("%H:%M:%S UTC", time.gmtime(reclaim_at))))
+            self.draining.set()
+            if stop.wait(max(0, reclaim_at - INTERRUPTION_MARGIN_SECONDS - time.time())):
+                return
+            logging.warning("Stopping running batches so that finished results can be uploaded.")
+            self.interrupt()
+            return
+
+    def install(self, phase):
+        """
+        Returns True if every install command succeeded.
+        """
+        statuses = [self.run_command(command, self.work_directory, phase) for command in self.manifest.get("InstallCommands", [])]
+        return all(status == 0 for status in statuses)
+
+    def baked_install(self):
+        """
+        The record left by bake() if this image was baked for the job's install section, otherwise None.
+        """
+        if not self.manifest.get("InstallHash") or not os.path.exists(self.baked_file):
+            return None
+        with open(self.baked_file) as f:
+            baked = json.load(f)
+        return baked if baked.get("InstallHash") == self.manifest["InstallHash"] else None
+
+    def bake(self, manifest_key):
+        """
+        Downloads the resources and runs the install commands of the manifest at manifest_key, and records that in
+        the baked file, for wiglaf.bake to snapshot into an image.  How it went is written to status.json next to
+        the manifest.
+        """
+        status_key = manifest_key.rsplit("/", 1)[0] + "/status.json"
+        try:
+            self.load_manifest(manifest_key)
+            with self.timed("DownloadingFiles") as phase:
+                self.download_resources(phase)
+            with self.timed("InstallCommands") as phase:
+                if not self.install(phase):
+                    raise RuntimeError("An install command failed.")
+            os.makedirs(os.path.dirname(self.baked_file), exist_ok=True)
+            with open(self.baked_file, "w") as f:
+                json.dump({"InstallHash":self.manifest["InstallHash"], "WorkDirectory":self.work_directory, "Baked":time.time()}, f)
+            status = {"ok":True}
+        except Exception as e:
+            logging.exception("Baking failed.")
+            status = {"ok":False, "error":str(e)}
+        self.s3.put_object(Bucket=self.bucket, Key=status_key, Body=json.dumps(status).encode("utf-8"))
+        return status["ok"]
+
+    def protect_resources(self):
+        """
+        With "LinkResources": true in the manifest, batches get symlinks to the work directory's files rather than
+        copies, which saves copying large resources for every batch but means the commands have to leave them
+        alone.  This makes them read-only (which stops commands that don't run as root) and notes their sizes and
+        modification times, for changed_resources to check after each batch.
+        """
+        stats = {}
+        for directory, _, filenames in os.walk(self.work_directory):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                os.chmod(path, os.stat(path).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+                info = os.stat(path)
+                stats[path] = (info.st_size, info.st_mtime_ns)
+        self.resource_stats = stats
+
+    def changed_resources(self):
+        changed = []
+        for path, recorded in self.resource_stats.items():
+            try:
+                info = os.stat(path)
+                current = (info.st_size, info.st_mtime_ns)
+            except OSError:
+                current = None
+            if current != recorded:
+                changed.append(path)
+        return changed
+
+    def prepare_slot(self, slot_directory):
+        """
+        Gives a batch a clean copy of the work directory, so that what one batch writes to its inputs isn't seen by
+        the others.  Each slot copies it once and keeps it for its batches: between them, whatever the last batch
+        added is removed, and only the files whose size or modification time it changed are copied again.  With
+        LinkResources, the files are symlinks to the shared ones instead (see protect_resources).
+        """
+        if self.manifest.get("LinkResources"):
+            copy = lambda src, dst: os.symlink(os.path.abspath(src), dst)
+        else:
+            copy = shutil.copy2
+        expected = self.slot_stats.get(slot_directory)
+        if expected is None or not os.path.isdir(slot_directory):
+            shutil.rmtree(slot_directory, ignore_errors=True)
+            shutil.copytree(self.work_directory, slot_directory, copy_function=copy)
+            self.slot_stats[slot_directory] = tree_stats(slot_directory)
+            return
+        current = tree_stats(slot_directory)
+        # Deepest first, so that a directory's contents are dealt with before it is.
+        for path in sorted(current, reverse=True):
+            if path in expected and current[path] == expected[path]:
+                continue
+            if current[path] is None:
+                shutil.rmtree(os.path.join(slot_directory, path))
+            else:
+                os.unlink(os.path.join(slot_directory, path))
+        for path in sorted(expected):
+            target = os.path.join(slot_directory, path)
+            if os.path.lexists(target):
+                continue
+            if expected[path] is None:
+                os.mkdir(target)
+            else:
+                copy(os.path.join(self.work_directory, path), target)
+                info = os.lstat(target)
+                expected[path] = (info.st_size, info.st_mtime_ns)
+
+    def collect_outputs(self, slot_directory, outbox):
+        """
+        Moves a batch's FilesToUpload out of its slot directory, so that they can upload while the slot moves on.
+        """
+        os.makedirs(outbox)
+        for filename in self.manifest["FilesToUpload"]:
+            path = os.path.join(slot_directory, filename)
+            if os.path.lexists(path):
+                target = os.path.join(outbox, filename)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.rename(path, target)
+
+    def upload_results(self, batch, slot, outbox, stop):
+        """
+        Queues the batch's results for upload.  Once they've all landed the batch is marked complete; if any of
+        them are missing or can't be uploaded it's left for its lease to run out, so that it gets run again.  (The
+        job is only finished once every batch has uploaded every one of FilesToUpload.)
+        """
+        start = time.time()
+        uploads = []
+        missing = []
+        size = 0
+        for filename in self.manifest["FilesToUpload"]:
+            path = os.path.join(outbox, filename)
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+                uploads.append(self.uploader.submit(path, self.job_key("results", "{}.{}.{}".format(filename, batch, self.instance_id))))
+            else:
+                missing.append(filename)
+        remaining = [len(uploads)]
+        lock = threading.Lock()
+
+        def finish():
+            try:
+                if missing:
+                    logging.error("Batch {} didn't produce {}, leaving it to be re-run.".format(batch, ", ".join(missing)))
+                elif all(upload.exception() is None for upload in uploads):
+                    self.queue.complete(self.job_name, batch, self.instance_id)
+                else:
+                    logging.error("Batch {} couldn't be uploaded, leaving it to be re-run.".format(batch))
+                self.record("UploadingResults.{}".format(batch), start, time.time(), batch=batch, slot=slot, bytes_out=size)
+            finally:
+                stop.set()
+                shutil.rmtree(outbox, ignore_errors=True)
+
+        def uploaded(future):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            finish()
+
+        if not uploads:
+            finish()
+        for upload in uploads:
+            upload.add_done_callback(uploaded)
+
+    def heartbeat(self, batch, stop, lease, job_name=None):
+        while not stop.wait(lease / 3.0):
+            if not self.queue.renew(job_name or self.job_name, batch, self.instance_id, lease):
+                return
+
+    def run_slot(self, slot):
+        """
+        Runs batches until there are none left, returning True, or until the node stops taking them.
+        """
+        lease = self.manifest.get("LeaseSeconds", 900)
+        runs = 0
+        while not self.draining.is_set():
+            batch = self.queue.claim(self.job_name, self.manifest["NumberOfBatches"], self.instance_id, lease)
+            if batch is None:
+                return True
+            if self.draining.is_set():
+                self.queue.release(self.job_name, batch, self.instance_id)
+                return
+            stop = threading.Event()
+            threading.Thread(target=self.heartbeat, args=(batch, stop, lease), daemon=True).start()
+            slot_directory = os.path.join(self.slot_directory, str(slot))
+            self.prepare_slot(slot_directory)
+            env = dict(os.environ, WIGLAF_BATCH=str(batch), WIGLAF_SLOT=str(slot))
+            with self.timed("CommandsToRun.{}".format(batch), index_name="CommandsToRun", batch=batch, slot=slot) as phase:
+                for command in self.manifest["CommandsToRun"]:
+                    status = None if self.interrupted.is_set() else self.run_command(command, slot_directory, phase, env=env, log="wiglaf-slot-{}.log".format(slot))
+                    if status is None and self.interrupted.is_set():
+                        phase.fields["interrupted"] = True
+                        break
+            if phase.fields.get("interrupted"):
+                # It won't finish before the instance goes, so let another node have it now.
+                stop.set()
+                self.queue.release(self.job_name, batch, self.instance_id)
+                shutil.rmtree(slot_directory, ignore_errors=True)
+                return
+            changed = self.changed_resources() if self.resource_stats is not None else []
+            if changed:
+                # Every batch on this node since could have seen the changes, so let other nodes run them.
+                logging.error("Batch {} wrote to the shared resources {}, which LinkResources needs left alone.  Not taking any more batches.".format(batch, ", ".join(sorted(changed))))
+                self.draining.set()
+                stop.set()
+                self.queue.release(self.job_name, batch, self.instance_id)
+                shutil.rmtree(slot_directory, ignore_errors=True)
+                return
+            # Move the outputs aside so the slot directory can be reused while they upload.  Named for the run as
+            # well as the batch: if the lease ran out before the upload finished, this slot can claim the batch again.
+            outbox = "{}.outbox.{}.{}".format(slot_directory, batch, runs)
+            self.collect_outputs(slot_directory, outbox)
+            self.upload_results(batch, slot, outbox, stop)
+            runs += 1
+            if self.manifest.get("RunsPerNode") and runs >= self.manifest["RunsPerNode"]:
+                return
+
+    def reduce_job(self, level):
+        return "{}/reduce/{}".format(self.job_name, level)
+
+    def reduce_inputs(self, level, task):
+        """
+        [(filename, index, key)] for what a reducer merges, in order.  Batch results are found by listing, since a
+        batch that was re-run after its lease expired can have results from either instance; batches that didn't
+        produce a file are left out.
+        """
+        indexes = reducer.inputs(self.manifest, level, task)
+        if level > 0:
+            return [(filename, i, self.job_key("reduce", str(level - 1), str(i), reducer.output_name(self.manifest, filename)))
+                    for filename in reducer.files(self.manifest) for i in indexes]
+
+        def find(entry):
+            filename, batch = entry
+            prefix = self.job_key("results", "{}.{}.".format(filename, batch))
+            contents = self.s3.list_objects_v2(Bucket=self.bucket, Prefix=prefix, MaxKeys=1).get("Contents", [])
+            if not contents:
+                logging.warning("Batch {} has no {} to reduce.".format(batch, filename))
+                return None
+            return (filename, batch, contents[0]["Key"])
+
+        entries = [(filename, batch) for filename in reducer.files(self.manifest) for batch in indexes]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return [found for found in executor.map(find, entries) if found]
+
+    def run_reducer(self, slot, level, task, final):
+        """
+        Merges a reducer's inputs and uploads what it made.  Returns True if it all worked.
+        """
+        reduce = self.manifest["Reduce"]
+        directory = os.path.join(self.slot_directory, "{}.reduce".format(slot))
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(os.path.join(directory, "inputs"))
+        try:
+            with self.timed("Reducing.{}".format(task), index_name="Reducing", level=level, task=task, slot=slot) as phase:
+                inputs = self.reduce_inputs(level, task)
+
+                def fetch(entry):
+                    filename, index, key = entry
+                    path = os.path.join(directory, "inputs", "{}.{}".format(filename, index))
+                    self.s3.download_file(self.bucket, key, path)
+                    phase.add(bytes_in=os.path.getsize(path))
+                    return path
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                    paths = list(executor.map(fetch, inputs))
+                if reduce["Type"] == "command":
+                    env = dict(os.environ, WIGLAF_REDUCE_LEVEL=str(level), WIGLAF_REDUCE_TASK=str(task), WIGLAF_REDUCE_FINAL="1" if final else "0")
+                    for command in reduce["Commands"]:
+                        if self.run_command(command, directory, phase, env=env, log="wiglaf-slot-{}.log".format(slot)) != 0:
+                            return False
+                for filename in reducer.files(self.manifest):
+                    mine = [(path, "{}.{}".format(filename, index)) for (name, index, _), path in zip(inputs, paths) if name == filename]
+                    output = os.path.join(directory, reducer.output_name(self.manifest, filename))
+                    if reduce["Type"] == "concatenate":
+                        reducer.concatenate([path for path, _ in mine], output)
+                    elif reduce["Type"] == "tar":
+                        reducer.pack(mine, output, merge=level > 0)
+                uploads = []
+                for filename in reducer.files(self.manifest):
+                    name = reducer.output_name(self.manifest, filename)
+                    path = os.path.join(directory, name)
+                    if not os.path.exists(path):
+                        logging.error("Reducer {} of level {} didn't produce {}.".format(task, level, name))
+                        return False
+                    phase.add(bytes_out=os.path.getsize(path))
+                    key = self.job_key("results", "reduced", name) if final else self.job_key("reduce", str(level), str(task), name)
+                    uploads.append(self.uploader.submit(path, key))
+                return all(upload.exception() is None for upload in uploads)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def reduce_slot(self, slot):
+        """
+        Runs reducers a level at a time.  A level is only started once the one below it has finished, so every
+        reducer's inputs are there by the time it's claimed.
+        """
+        lease = self.manifest.get("LeaseSeconds", 900)
+        counts = reducer.levels(self.manifest)
+        for level, count in enumerate(counts):
+            job_name = self.reduce_job(level)
+            while not self.draining.is_set():
+                task = self.queue.claim(job_name, count, self.instance_id, lease)
+                if task is None:
+                    break
+                stop = threading.Event()
+                threading.Thread(target=self.heartbeat, args=(task, stop, lease, job_name), daemon=True).start()
+                try:
+                    if self.run_reducer(slot, level, task, level == len(counts) - 1):
+                        self.queue.complete(job_name, task, self.instance_id)
+                    elif self.interrupted.is_set():
+                        self.queue.release(job_name, task, self.instance_id)
+                    else:
+                        logging.error("Reducer {} of level {} failed, leaving it to be re-run.".format(task, level))
+                finally:
+                    stop.set()
+            if self.draining.is_set():
+                return
+
+    def work(self, slot):
+        if self.run_slot(slot) and self.manifest.get("Reduce"):
+            self.reduce_slot(slot)
+
+    def terminate(self):
+        self.s3.put_object(Bucket=self.bucket, Key=self.job_key("terminate", self.instance_id), Body=self.instance_id.encode("utf-8"))
+        self.ec2.terminate_instances(InstanceIds=[self.instance_id])
+
+    def run(self, terminate=True):
+        start = time.time()
+        self.load_manifest()
+        self.log_shipper = log_shipper.LogShipper(self.s3, self.bucket, self.job_key("logs", self.instance_id), self.log_directory, LOG_FILES,
+                                                  interval=self.manifest.get("LogIntervalSeconds", log_shipper.DEFAULT_INTERVAL_SECONDS))
+        self.log_shipper.start()
+        self.metrics_shipper = log_shipper.LogShipper(self.s3, self.bucket, self.job_key("metrics", self.instance_id), self.log_directory, [METRICS_LOG],
+                                                      interval=self.manifest.get("MetricsIntervalSeconds", DEFAULT_METRICS_INTERVAL_SECONDS))
+        self.metrics_shipper.start()
+        finished = threading.Event()
+        threading.Thread(target=self.watch_interruptions, args=(finished,), daemon=True).start()
+        baked = None
+        slots = 0
+        # Whatever goes wrong, finished results are flushed, the logs shipped and the instance terminated, rather
+        # than left running idle.
+        try:
+            baked = self.baked_install()
+            if baked:
+                logging.info("This image was baked for the job, so skipping the download and install.")
+                self.work_directory = baked["WorkDirectory"]
+            else:
+                with self.timed("DownloadingFiles") as phase:
+                    # Nothing else is running yet, so all of the agent's CPU time is the download's.
+                    before = resource.getrusage(resource.RUSAGE_SELF)
+                    self.download_resources(phase)
+                    after = resource.getrusage(resource.RUSAGE_SELF)
+                    phase.add(cpu=after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime)
+                if "InstallCommands" in self.manifest:
+                    with self.timed("InstallCommands") as phase:
+                        self.install(phase)
+            if self.manifest.get("LinkResources"):
+                self.protect_resources()
+            slots = slot_count(self.manifest)
+            for slot in range(slots):
+                self.log_shipper.watch("wiglaf-slot-{}.log".format(slot))
+            logging.info("Running {} batches at a time.".format(slots))
+            self.uploader = uploader.Uploader(self.s3, self.bucket, concurrency=self.manifest.get("UploadConcurrency", uploader.DEFAULT_CONCURRENCY),
+                                              queue_size=self.manifest.get("UploadQueueSize", uploader.DEFAULT_QUEUE_SIZE))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=slots) as executor:
+                for future in [executor.submit(self.work, slot) for slot in range(slots)]:
+                    future.result()
+        except Exception:
+            # Logged here so that it's in the logs shipped below.
+            logging.exception("The node failed.")
+            raise
+        finally:
+            try:
+                finished.set()
+                if self.uploader:
+                    # Make sure everything has landed before the instance goes away.
+                    flush_start = time.time()
+                    failed = self.uploader.flush()
+                    missing = self.uploader.verify()
+                    self.uploader.close()
+                    self.record("FlushingUploads", flush_start, time.time(), failed=len(failed), missing=len(missing))
+                    if failed or missing:
+                        logging.error("{} uploads failed and {} are missing: {}".format(len(failed), len(missing), sorted(set(failed) | set(missing))))
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                self.record("Node", start, time.time(), slots=slots, baked=bool(baked), drained=self.draining.is_set(), interrupted=self.interrupted.is_set(),
+                            bytes_out=self.uploader.bytes if self.uploader else 0, upload_seconds=round(self.uploader.seconds, 3) if self.uploader else 0,
+                            log_bytes=self.log_shipper.shipped_bytes, agent_cpu=round(usage.ru_utime + usage.ru_stime, 3), agent_max_rss_kb=usage.ru_maxrss)
+            finally:
+                self.log_shipper.stop()
+                self.metrics_shipper.stop()
+                if terminate:
+                    self.terminate()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the current wiglaf job on this node.")
+    parser.add_argument("--bucket", required=True, help="The cluster's data bucket.")
+    parser.add_argument("--table", help="The cluster's state table.  Required unless baking.")
+    parser.add_argument("--no-terminate", dest="terminate", action="store_false", default=True, help="Don't terminate the instance when finished.")
+    parser.add_argument("--bake", metavar="MANIFEST_KEY", help="Just download and install for the manifest at this key, for baking an image.")
+    args = parser.parse_args()
+    if not (args.table or args.bake):
+        parser.error("--table is required unless baking.")
+    return args
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = parse_args()
+    if args.bake:
+        sys.exit(0 if Agent(args.bucket, args.table, work_directory=BAKED_WORK_DIRECTORY).bake(args.bake) else 1)
+    Agent(args.bucket, args.table).run(terminate=args.terminate)
+
+if __name__ == "__main__":
+    main()
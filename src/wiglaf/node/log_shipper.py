@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# Ships log files from a node to S3 as they grow, rather than re-uploading each whole file every batch.
+#
+# Each file's offset is tracked, and only the bytes past it are sent, as a gzipped segment:
+#   jobs/<job>/logs/<instance>/<logfile>/<segment number, zero-padded>.gz
+# Segments end on a line break (except the last one, when the agent finishes), so each one can be printed on its
+# own, and concatenating them in key order gives back the whole file.  wiglaf.logs reads them back.
+# Like everything in wiglaf/node, it only depends on boto3 and the standard library.
+
+import gzip
+import logging
+import os
+import threading
+
+DEFAULT_INTERVAL_SECONDS = 30
+MAX_SEGMENT_SIZE = 8 * 1024 * 1024
+# Zero-padded so that segments list in order.
+SEGMENT_FORMAT = "{:08d}.gz"
+
+class LogShipper(object):
+
+    def __init__(self, s3, bucket, prefix, directory, filenames, interval=DEFAULT_INTERVAL_SECONDS, max_segment_size=MAX_SEGMENT_SIZE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.directory = directory
+        self.interval = interval
+        self.max_segment_size = max_segment_size
+        self.lock = threading.Lock()
+        self.offsets = {filename:0 for filename in filenames}
+        self.segments = {filename:0 for filename in filenames}
+        self.shipped_bytes = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def watch(self, filename):
+        """
+        Adds a file to ship (relative to the log directory).  It doesn't need to exist yet.
+        """
+        with self.lock:
+            self.offsets.setdefault(filename, 0)
+            self.segments.setdefault(filename, 0)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread and ships whatever is left, including any unfinished last line.
+        """
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+        self.ship(final=True)
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            self.ship()
+
+    def ship(self, final=False):
+        with self.lock:
+            filenames = sorted(self.offsets)
+        for filename in filenames:
+            try:
+                while self._ship_segment(filename, final):
+                    pass
+            except Exception as e:
+                # The offset only moves once a segment is stored, so this is picked up again next time.
+                logging.warning("Couldn't ship {}: {}".format(filename, e))
+
+    def _ship_segment(self, filename, final):
+        path = os.path.join(self.directory, filename)
+        if not os.path.exists(path):
+            return False
+        with self.lock:
+            offset = self.offsets[filename]
+            segment = self.segments[filename]
+        size = os.path.getsize(path)
+        if size < offset:
+            # Truncated or rotated, so start again from the top.
+            logging.info("{} shrank, shipping it from the start.".format(filename))
+            offset = 0
+        if size == offset:
+            return False
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(min(size - offset, self.max_segment_size))
+        if not (final and offset + len(data) == size):
+            # Hold back a partial last line until it's finished (unless a single line fills a whole segment).
+            end = data.rfind(b"\n") + 1
+            if end:
+                data = data[:end]
+            elif len(data) < self.max_segment_size:
+                return False
+        key = "{}/{}/{}".format(self.prefix, filename, SEGMENT_FORMAT.format(segment))
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=gzip.compress(data), ContentType="text/plain", ContentEncoding="gzip")
+        with self.lock:
+            self.offsets[filename] = offset + len(data)
+            self.segments[filename] = segment + 1
+            self.shipped_bytes += len(data)
+        return True
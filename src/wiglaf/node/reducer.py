@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# The optional reduce stage, which merges a job's per-batch results on the cluster into a few artifacts, so that
+# fetching the results of a 10k-batch job isn't 10k downloads.  Declared in the manifest as:
+#   "Reduce":{
+#       "Type":"concatenate" | "tar" | "command",
+#       "Files":[...],        which of FilesToUpload to reduce (all of them by default)
+#       "Commands":[...],     for "command": run in a directory with the inputs under inputs/, named
+#                             <file>.<index>, and must leave each of Files in the directory
+#       "FanIn":100           how many inputs each reducer merges; by default one reducer takes every batch
+#   }
+# With FanIn, reducers form a tree: level 0 merges FanIn batches each, level 1 merges FanIn level-0 outputs, and
+# so on up to a single reducer, so a "command" reduce has to accept its own output as input.  Each level is run
+# through the work queue as the job <job>/reduce/<level> once the level below has finished.  Intermediate outputs
+# go to jobs/<job>/reduce/<level>/<task>/, and the final ones to jobs/<job>/results/reduced/.
+#
+# Only the standard library is used, so that the CLI can check manifests with it too, and the Lambda can count the
+# job's reducers with it (see lambda_zipfile in wiglaf/cloudformation).
+
+import shutil
+import tarfile
+
+REDUCE_TYPES = ["concatenate", "tar", "command"]
+
+def check(manifest):
+    """
+    Raises ValueError if the manifest's reduce stage doesn't make sense.
+    """
+    reduce = manifest.get("Reduce")
+    if not reduce:
+        return
+    if reduce.get("Type") not in REDUCE_TYPES:
+        raise ValueError("Reduce Type must be one of {}.".format(", ".join(REDUCE_TYPES)))
+    unknown = [f for f in files(manifest) if f not in manifest["FilesToUpload"]]
+    if unknown:
+        raise ValueError("Reduce Files must be in FilesToUpload, but {} aren't.".format(", ".join(unknown)))
+    if reduce["Type"] == "command" and not reduce.get("Commands"):
+        raise ValueError("A command reduce needs Commands.")
+    if reduce.get("FanIn") is not None and int(reduce["FanIn"]) < 2:
+        raise ValueError("Reduce FanIn must be at least 2.")
+
+def files(manifest):
+    return manifest["Reduce"].get("Files", manifest["FilesToUpload"])
+
+def output_name(manifest, filename):
+    return filename + ".tar" if manifest["Reduce"]["Type"] == "tar" else filename
+
+def levels(manifest):
+    """
+    How many reducers there are at each level of the tree, from the bottom, or none without a reduce stage.
+    """
+    if not manifest.get("Reduce"):
+        return []
+    fan_in = manifest["Reduce"].get("FanIn")
+    count = manifest["NumberOfBatches"]
+    if not fan_in:
+        return [1]
+    counts = []
+    while not counts or counts[-1] > 1:
+        count = -(-count // int(fan_in))
+        counts.append(count)
+    return counts
+
+def inputs(manifest, level, task):
+    """
+    The indexes of the batches (at level 0) or reducers of the level below that a reducer merges.
+    """
+    below = manifest["NumberOfBatches"] if level == 0 else levels(manifest)[level - 1]
+    fan_in = manifest["Reduce"].get("FanIn")
+    if not fan_in:
+        return range(below)
+    fan_in = int(fan_in)
+    return range(task * fan_in, min((task + 1) * fan_in, below))
+
+def concatenate(paths, output):
+    with open(output, "wb") as out:
+        for path in paths:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, out)
+
+def pack(members, output, merge=False):
+    """
+    Writes a tar of members, a list of (path, name in the archive).  With merge, the paths are tars themselves,
+    whose members are copied across rather than the tars being nested.
+    """
+    with tarfile.open(output, "w") as out:
+        for path, name in members:
+            if not merge:
+                out.add(path, arcname=name)
+                continue
+            with tarfile.open(path) as tar:
+                for member in tar:
+                    out.addfile(member, tar.extractfile(member) if member.isfile() else None)
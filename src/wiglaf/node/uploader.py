@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Background upload pipeline for the node agent, so a slot can start its next batch while the last one's results
+# are still going up.
+#
+# Uploads are queued (bounded, so a slot that produces output faster than it can be shipped is slowed down rather
+# than filling the disk) and handled by a fixed number of worker threads.  Large files go up in parts over a shared
+# part pool.  Every request carries the body's MD5 so S3 rejects anything that got corrupted on the way, and failed
+# requests are retried with exponential backoff.  flush() waits for everything queued so far, and verify() checks
+# that every uploaded object is there at the expected size.
+# Like everything in wiglaf/node, it only depends on boto3 and the standard library.
+
+import base64
+import concurrent.futures
+import hashlib
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_QUEUE_SIZE = 64
+# Same as wiglaf.s3.MULTIPART_CHUNKSIZE.
+PART_SIZE = 8 * 1024 * 1024
+DEFAULT_ATTEMPTS = 5
+DEFAULT_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60
+
+def content_md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+class Uploader(object):
+
+    def __init__(self, s3, bucket, concurrency=DEFAULT_CONCURRENCY, queue_size=DEFAULT_QUEUE_SIZE, part_size=PART_SIZE,
+                 attempts=DEFAULT_ATTEMPTS, backoff=DEFAULT_BACKOFF_SECONDS, sleep=time.sleep):
+        self.s3 = s3
+        self.bucket = bucket
+        self.part_size = part_size
+        self.attempts = attempts
+        self.backoff = backoff
+        self.sleep = sleep
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.part_executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.lock = threading.Lock()
+        self.uploaded = {}
+        self.failed = {}
+        self.bytes = 0
+        self.seconds = 0.0
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(concurrency)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, filename, key, verify=True):
+        """
+        Queues a file for upload, blocking while the queue is full.  Returns a Future that resolves to the key once
+        it's uploaded, or to the exception from the last attempt.  Files that are still being written to (logs)
+        should pass verify=False, since their size when verify() runs won't match.
+        """
+        future = concurrent.futures.Future()
+        self.queue.put((filename, key, verify, future))
+        return future
+
+    def flush(self):
+        """
+        Waits for everything submitted so far to finish.  Returns {key: exception} for uploads that gave up.
+        """
+        self.queue.join()
+        with self.lock:
+            return dict(self.failed)
+
+    def verify(self):
+        """
+        Checks that every verifiable upload is in S3 at the size it was uploaded at.  Returns the keys that aren't.
+        """
+        with self.lock:
+            expected = dict(self.uploaded)
+        missing = []
+        for key, size in sorted(expected.items()):
+            try:
+                if self._retry(self.s3.head_object, Bucket=self.bucket, Key=key)["ContentLength"] != size:
+                    missing.append(key)
+            except Exception:
+                missing.append(key)
+        return missing
+
+    def close(self):
+        self.flush()
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.part_executor.shutdown()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                filename, key, verify, future = item
+                start = time.time()
+                try:
+                    size = self._upload(filename, key)
+                except Exception as e:
+                    logging.error("Giving up uploading {} to s3://{}/{}: {}".format(filename, self.bucket, key, e))
+                    with self.lock:
+                        self.failed[key] = e
+                    future.set_exception(e)
+                    continue
+                with self.lock:
+                    self.failed.pop(key, None)
+                    if verify:
+                        self.uploaded[key] = size
+                    self.bytes += size
+                    self.seconds += time.time() - start
+                future.set_result(key)
+            finally:
+                self.queue.task_done()
+
+    def _retry(self, call, **kwargs):
+        for attempt in range(self.attempts):
+            try:
+                return call(**kwargs)
+            except Exception as e:
+                if attempt == self.attempts - 1:
+                    raise
+                delay = min(self.backoff * 2 ** attempt, MAX_BACKOFF_SECONDS) * random.uniform(0.5, 1.5)
+                logging.warning("{} for s3://{}/{} failed ({}), retrying in {:.1f}s.".format(call.__name__, self.bucket, kwargs.get("Key"), e, delay))
+                self.sleep(delay)
+
+    def _read(self, filename, offset, size):
+        with open(filename, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def _upload(self, filename, key):
+        # The size is fixed up front, so a file that's still growing is uploaded as it was at this point.
+        size = os.path.getsize(filename)
+        if size <= self.part_size:
+            data = self._read(filename, 0, size)
+            self._retry(self.s3.put_object, Bucket=self.bucket, Key=key, Body=data, ContentMD5=content_md5(data))
+            return size
+        upload_id = self._retry(self.s3.create_multipart_upload, Bucket=self.bucket, Key=key)["UploadId"]
+
+        def upload_part(number, offset):
+            data = self._read(filename, offset, min(self.part_size, size - offset))
+            response = self._retry(self.s3.upload_part, Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                                   Body=data, ContentMD5=content_md5(data))
+            return {"PartNumber":number, "ETag":response["ETag"]}
+
+        try:
+            futures = [self.part_executor.submit(upload_part, i + 1, offset) for i, offset in enumerate(range(0, size, self.part_size))]
+            parts = [future.result() for future in futures]
+            self._retry(self.s3.complete_multipart_upload, Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts":parts})
+        except Exception:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        return size
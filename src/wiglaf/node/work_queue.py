@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+# Pull-based queue of batch IDs that nodes claim work from until the job is drained.
+#
+# This runs on the nodes (it's uploaded to the data bucket with the rest of wiglaf/node), so it only depends on
+# boto3 and the standard library.  It shares the cluster's DynamoDB state table with the Lambda:
+#   jobs/<job>                 NextBatch: counter handing out never-claimed batch IDs
+#                              Finished: number of batches completed
+#   jobs/<job>/batches/<id>    Job, Owner, LeaseExpires, Attempts, Done, ClaimedAt, DoneAt
+# (The claim and completion times are for the Lambda's sizing of the cluster, from how long batches are taking.)
+# Fresh batches come off the counter in O(1).  Once it runs past the end, the job's batches are searched for
+# expired leases (a node died or was reclaimed), which are taken over and re-run.  That's a query of the table's
+# JobIndex, which holds just the work queue's items, by Job (the job's name), so it reads the job's batches rather
+# than the whole table.  The index is only eventually consistent, which is fine: taking over a lease is conditional
+# on it being the one that was read.  Slots that find nothing to take back off between looks.
+
+import random
+import threading
+import time
+
+DEFAULT_LEASE_SECONDS = 15 * 60
+MIN_POLL_SECONDS = 1
+MAX_POLL_SECONDS = 30
+# Matches the state table's index in wiglaf/cloudformation/templates.py.
+JOB_INDEX = "JobIndex"
+
+class WorkQueue(object):
+
+    def claim(self, job_name, batch_count, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Returns a batch ID for the owner to work on, or None once every batch is finished.
+        Blocks while all remaining batches are leased to other (still live) owners.
+        """
+        poll = MIN_POLL_SECONDS
+        while True:
+            batch = self.try_claim(job_name, batch_count, owner, lease_seconds)
+            if batch is not None:
+                return batch
+            wait = self.wait_time(job_name, batch_count)
+            if wait is None:
+                return None
+            # Until the next lease runs out, but looking less often the longer there's been nothing to take, and
+            # at different times on different slots.
+            time.sleep(min(max(wait, poll), MAX_POLL_SECONDS) * random.uniform(0.5, 1.5))
+            poll = min(poll * 2, MAX_POLL_SECONDS)
+
+    def try_claim(self, job_name, batch_count, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        raise NotImplementedError()
+
+    def wait_time(self, job_name, batch_count):
+        """
+        Seconds until the next outstanding lease expires, or None if there's nothing left to wait for.
+        """
+        raise NotImplementedError()
+
+    def renew(self, job_name, batch, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        raise NotImplementedError()
+
+    def complete(self, job_name, batch, owner):
+        raise NotImplementedError()
+
+    def release(self, job_name, batch, owner):
+        """
+        Gives up a claim (say, because the node is being reclaimed), so that another owner can take the batch
+        straight away rather than waiting for the lease to run out.
+        """
+        raise NotImplementedError()
+
+class DynamoWorkQueue(WorkQueue):
+
+    def __init__(self, table_name, client=None):
+        import boto3
+        self.table_name = table_name
+        self.dynamodb = client if client else boto3.client("dynamodb")
+
+    def _job_key(self, job_name):
+        return {"Id":{"S":"jobs/{}".format(job_name)}}
+
+    def _batch_key(self, job_name, batch):
+        return {"Id":{"S":"jobs/{}/batches/{}".format(job_name, batch)}}
+
+    def _index_job(self, job_name):
+        # Reducers queue under <job>/reduce/<level>, and are indexed with the job's batches.
+        return job_name.split("/")[0]
+
+    def _lease(self, job_name, batch, owner, lease_seconds, condition, values=None, claim=False):
+        values = dict(values or {})
+        values.update({":owner":{"S":owner}, ":expires":{"N":str(int(time.time() + lease_seconds))}, ":one":{"N":"1"},
+                       ":job":{"S":self._index_job(job_name)}})
+        update = "SET #owner = :owner, LeaseExpires = :expires, #job = :job"
+        if claim:
+            update += ", ClaimedAt = :now"
+            values[":now"] = {"N":str(int(time.time()))}
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key=self._batch_key(job_name, batch),
+                UpdateExpression=update + " ADD Attempts :one",
+                ConditionExpression=condition,
+                ExpressionAttributeNames={"#owner":"Owner", "#job":"Job"},
+                ExpressionAttributeValues=values
+            )
+            return True
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def _job(self, job_name):
+        return self.dynamodb.get_item(TableName=self.table_name, Key=self._job_key(job_name), ConsistentRead=True).get("Item", {})
+
+    def _unfinished(self, job_name, batch_count):
+        """
+        Returns {batch: lease expiry} for every batch that isn't done.  Batches that were handed out by the counter
+        but never got a lease (the claimer died in between) show up with an expiry of 0.
+        """
+        kwargs = {
+            "TableName":self.table_name,
+            "IndexName":JOB_INDEX,
+            "KeyConditionExpression":"#job = :job AND begins_with(Id, :prefix)",
+            "ExpressionAttributeNames":{"#job":"Job"},
+            "ExpressionAttributeValues":{":job":{"S":self._index_job(job_name)}, ":prefix":{"S":"jobs/{}/batches/".format(job_name)}}
+        }
+        unfinished = {batch:0 for batch in range(batch_count)}
+        while True:
+            response = self.dynamodb.query(**kwargs)
+            for item in response.get("Items", []):
+                batch = int(item["Id"]["S"].split("/")[-1])
+                if "Done" in item:
+                    unfinished.pop(batch, None)
+                else:
+                    unfinished[batch] = int(item.get("LeaseExpires", {}).get("N", "0"))
+            if not response.get("LastEvaluatedKey"):
+                return unfinished
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def try_claim(self, job_name, batch_count, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        job = self._job(job_name)
+        if int(job.get("NextBatch", {}).get("N", "0")) < batch_count:
+            response = self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key=self._job_key(job_name),
+                UpdateExpression="ADD NextBatch :one",
+                ExpressionAttributeValues={":one":{"N":"1"}},
+                ReturnValues="UPDATED_NEW"
+            )
+            batch = int(response["Attributes"]["NextBatch"]["N"]) - 1
+            if batch < batch_count:
+                self._lease(job_name, batch, owner, lease_seconds, "attribute_not_exists(Done)", claim=True)
+                return batch
+        if int(job.get("Finished", {}).get("N", "0")) >= batch_count:
+            return None
+        now = int(time.time())
+        for batch, expires in sorted(self._unfinished(job_name, batch_count).items()):
+            if expires >= now:
+                continue
+            if expires:
+                condition = "attribute_not_exists(Done) AND LeaseExpires = :old"
+                values = {":old":{"N":str(expires)}}
+            else:
+                condition = "attribute_not_exists(LeaseExpires)"
+                values = None
+            if self._lease(job_name, batch, owner, lease_seconds, condition, values, claim=True):
+                return batch
+        return None
+
+    def wait_time(self, job_name, batch_count):
+        if int(self._job(job_name).get("Finished", {}).get("N", "0")) >= batch_count:
+            return None
+        unfinished = self._unfinished(job_name, batch_count)
+        if not unfinished:
+            return None
+        return min(unfinished.values()) - time.time()
+
+    def renew(self, job_name, batch, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        return self._lease(job_name, batch, owner, lease_seconds, "attribute_not_exists(Done) AND #owner = :owner")
+
+    def complete(self, job_name, batch, owner):
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key=self._batch_key(job_name, batch),
+                UpdateExpression="SET Done = :true, DoneAt = :now",
+                ConditionExpression="attribute_not_exists(Done)",
+                ExpressionAttributeValues={":true":{"BOOL":True}, ":now":{"N":str(int(time.time()))}}
+            )
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            # Someone else finished it first after our lease expired.
+            return False
+        self.dynamodb.update_item(
+            TableName=self.table_name,
+            Key=self._job_key(job_name),
+            UpdateExpression="ADD Finished :one",
+            ExpressionAttributeValues={":one":{"N":"1"}}
+        )
+        return True
+
+    def release(self, job_name, batch, owner):
+        try:
+            # Expired long ago, rather than removed, so that try_claim takes it over like any other expired lease.
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key=self._batch_key(job_name, batch),
+                UpdateExpression="SET LeaseExpires = :expired",
+                ConditionExpression="attribute_not_exists(Done) AND #owner = :owner",
+                ExpressionAttributeNames={"#owner":"Owner"},
+                ExpressionAttributeValues={":owner":{"S":owner}, ":expired":{"N":"1"}}
+            )
+            return True
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            return False
+
+class LocalWorkQueue(WorkQueue):
+    """
+    In-process stand-in for the DynamoDB queue, for simulations and local runs.  clock can be swapped out
+    to run simulations faster than real time.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def _job(self, job_name):
+        if job_name not in self.jobs:
+            self.jobs[job_name] = {"next":0, "leases":{}, "done":set()}
+        return self.jobs[job_name]
+
+    def try_claim(self, job_name, batch_count, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        with self.lock:
+            job = self._job(job_name)
+            now = self.clock()
+            if job["next"] < batch_count:
+                batch = job["next"]
+                job["next"] += 1
+            else:
+                expired = [b for b, (o, expires) in job["leases"].items() if b not in job["done"] and expires < now]
+                if not expired:
+                    return None
+                batch = min(expired)
+            job["leases"][batch] = (owner, now + lease_seconds)
+            return batch
+
+    def wait_time(self, job_name, batch_count):
+        with self.lock:
+            job = self._job(job_name)
+            if len(job["done"]) >= batch_count:
+                return None
+            expiries = [expires for b, (o, expires) in job["leases"].items() if b not in job["done"]]
+            return min(expiries) - self.clock() if expiries else 1
+
+    def renew(self, job_name, batch, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        with self.lock:
+            job = self._job(job_name)
+            if batch in job["done"] or job["leases"].get(batch, (None,))[0] != owner:
+                return False
+            job["leases"][batch] = (owner, self.clock() + lease_seconds)
+            return True
+
+    def complete(self, job_name, batch, owner):
+        with self.lock:
+            job = self._job(job_name)
+            if batch in job["done"]:
+                return False
+            job["done"].add(batch)
+            return True
+
+    def release(self, job_name, batch, owner):
+        with self.lock:
+            job = self._job(job_name)
+            if batch in job["done"] or job["leases"].get(batch, (None,))[0] != owner:
+                return False
+            job["leases"][batch] = (owner, 0)
+            return True
+
+    def clear(self, job_name):
+        """
+        Forgets the job's batches, as wiglaf.state.clear_job does for the DynamoDB queue before a job is started.
+        """
+        with self.lock:
+            for name in [name for name in self.jobs if name == job_name or name.startswith(job_name + "/")]:
+                del self.jobs[name]
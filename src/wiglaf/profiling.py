@@ -0,0 +1,98 @@
+import json
+import threading
+import time
+import wiglaf.stats
+
+# Counts the AWS API calls a command makes, per service and operation, with their latencies, retries and errors,
+# from botocore's before-call and after-call events.  Clients copy their session's event handlers when they're made,
+# so a profile attached to the default session (see Wiglaf._connect) sees every client made after it, whether through
+# wiglaf.s3.client or boto3.client.  Latencies are per call, retries and backoff included; RetryAttempts says how
+# many of those there were, and throttling shows up as retries and as errors like Throttling or SlowDown.
+#
+# The Lambda keeps one per invocation too (see lambda/handlers.py), attached to each client it makes, so only the
+# standard library is used here (see lambda_zipfile in wiglaf/cloudformation).
+
+# Calls quicker than this (about a millisecond) share the first bucket of the latency histograms.
+HISTOGRAM_MINIMUM = 2.0 ** -10
+
+class CallProfile(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Starts the profile over, as the Lambda does at the start of each invocation.
+        """
+        with self._lock:
+            # {(service, operation): {"latencies", "retries", "errors"}}
+            self._calls = {}
+            self.started = time.time()
+
+    def attach(self, events):
+        """
+        Hooks into a botocore event emitter: a session's (session.events), for every client made from it afterwards,
+        or a client's (client.meta.events).
+        """
+        events.register("before-call", self._before_call, unique_id="wiglaf-profile-before-call")
+        events.register("after-call", self._after_call, unique_id="wiglaf-profile-after-call")
+        events.register("after-call-error", self._after_call_error, unique_id="wiglaf-profile-after-call-error")
+
+    def _before_call(self, model, context, **kwargs):
+        context["wiglaf_profile"] = (model.service_model.service_name, model.name, time.perf_counter())
+
+    def _after_call(self, http_response, parsed, context, **kwargs):
+        error = None
+        if http_response.status_code >= 300:
+            error = parsed.get("Error", {}).get("Code") or str(http_response.status_code)
+        self._record(context, parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0), error)
+
+    def _after_call_error(self, exception, context, **kwargs):
+        # Couldn't get a response at all (after retrying), like a connection that keeps timing out.
+        self._record(context, 0, type(exception).__name__)
+
+    def _record(self, context, retries, error):
+        # Nothing's started if another before-call handler answered the call itself (like botocore's Stubber).
+        if "wiglaf_profile" not in context:
+            return
+        service, operation, start = context.pop("wiglaf_profile")
+        seconds = time.perf_counter() - start
+        with self._lock:
+            calls = self._calls.setdefault((service, operation), {"latencies":[], "retries":0, "errors":{}})
+            calls["latencies"].append(seconds)
+            calls["retries"] += retries
+            if error:
+                calls["errors"][error] = calls["errors"].get(error, 0) + 1
+
+    def as_dict(self, **labels):
+        """
+        The profile so far: labels (the CLI's command, the Lambda's request_id), totals, then {service: {operation:
+        {"calls", "retries", "errors", "latency", "histogram"}}}, with latencies in seconds summarized and bucketed
+        as wiglaf.metrics does.
+        """
+        with self._lock:
+            calls = {k:dict(v, latencies=list(v["latencies"]), errors=dict(v["errors"])) for k, v in self._calls.items()}
+            started = self.started
+        services = {}
+        for (service, operation), c in sorted(calls.items()):
+            services.setdefault(service, {})[operation] = {
+                "calls":len(c["latencies"]),
+                "retries":c["retries"],
+                "errors":c["errors"],
+                "latency":wiglaf.stats.summarize(c["latencies"]),
+                "histogram":wiglaf.stats.histogram(c["latencies"], minimum=HISTOGRAM_MINIMUM)
+            }
+        profile = dict(labels)
+        profile.update({
+            "seconds":time.time() - started,
+            "calls":sum(len(c["latencies"]) for c in calls.values()),
+            "retries":sum(c["retries"] for c in calls.values()),
+            "errors":sum(sum(c["errors"].values()) for c in calls.values()),
+            "call_seconds":sum(sum(c["latencies"]) for c in calls.values()),
+            "services":services
+        })
+        return profile
+
+def format_json(profile):
+    return json.dumps(profile, indent=2, sort_keys=True)
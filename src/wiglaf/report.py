@@ -0,0 +1,230 @@
+import time
+import wiglaf.metrics
+import wiglaf.s3
+
+from calvin import json
+
+# Works out where a job's time went from the phase timings nodes record: the metrics they ship (see wiglaf.metrics),
+# or for jobs without metrics, the checkpoint objects written at the start and end of each phase:
+#   jobs/<job>/checkpoints/<instance>.<index>-<name>-<begin|end>
+# The objects' LastModified times are the timestamps, so only the listing is read, never the objects themselves.
+# Phase names are DownloadingFiles, InstallCommands and CommandsToRun.<batch>.
+
+# A batch is a straggler if it's taken this many times the median batch time.
+STRAGGLER_FACTOR = 2.0
+THROUGHPUT_BUCKET_SECONDS = 60
+# How far back to look when estimating the current rate of completion.
+ETA_WINDOW_SECONDS = 15 * 60
+
+def parse_checkpoint(key):
+    """
+    Returns (instance, phase, step) for a checkpoint key, or None if it isn't one.
+    """
+    name = key.rsplit("/", 1)[-1]
+    if "." not in name:
+        return None
+    instance, rest = name.split(".", 1)
+    parts = rest.split("-", 1)
+    if len(parts) != 2 or not parts[0].isdigit() or "-" not in parts[1]:
+        return None
+    phase, step = parts[1].rsplit("-", 1)
+    if step not in ("begin", "end"):
+        return None
+    return instance, phase, step
+
+def iter_checkpoints(bucket, job_name, s3=None):
+    """
+    Streams (instance, phase, step, epoch seconds) for every checkpoint in a job.
+    """
+    for obj in wiglaf.s3.iter_files(bucket, "jobs/{}/checkpoints/".format(job_name), s3=s3):
+        parsed = parse_checkpoint(obj["Key"])
+        if parsed:
+            yield parsed + (obj["LastModified"].timestamp(),)
+
+def build_timeline(checkpoints):
+    """
+    Pairs up begin and end checkpoints into phases: a list of dicts with instance, phase, kind, batch, start and
+    end (None if still running), and seconds.  A batch that was re-run after its lease expired shows up once per
+    instance that ran it.
+    """
+    phases = {}
+    for instance, phase, step, timestamp in checkpoints:
+        entry = phases.setdefault((instance, phase), {"instance":instance, "phase":phase, "start":None, "end":None})
+        entry["start" if step == "begin" else "end"] = timestamp
+    timeline = []
+    for entry in phases.values():
+        if entry["start"] is None:
+            continue
+        kind, _, batch = entry["phase"].partition(".")
+        entry["kind"] = kind
+        entry["batch"] = int(batch) if batch.isdigit() else None
+        entry["seconds"] = entry["end"] - entry["start"] if entry["end"] is not None else None
+        timeline.append(entry)
+    return sorted(timeline, key=lambda e: (e["start"], e["instance"]))
+
+def covered_seconds(intervals):
+    """
+    How long at least one of a list of (start, end) intervals covers, with overlaps counted once.
+    """
+    covered = 0
+    reach = None
+    for start, end in sorted(intervals):
+        if reach is None or start > reach:
+            covered += end - start
+            reach = end
+        elif end > reach:
+            covered += end - reach
+            reach = end
+    return covered
+
+def analyze(timeline, batch_count=None, now=None, percentiles=wiglaf.metrics.DEFAULT_PERCENTILES, straggler_factor=STRAGGLER_FACTOR,
+            bucket_seconds=THROUGHPUT_BUCKET_SECONDS, eta_window=ETA_WINDOW_SECONDS):
+    """
+    Turns a timeline into a report (a JSON-serializable dict) of phase statistics, per-instance utilization,
+    stragglers, batches finished over time and, given the job's batch count, an estimated time to completion.
+    """
+    now = now if now is not None else time.time()
+    report = {"generated":now, "phases":{}, "instances":{}, "stragglers":[], "throughput":[], "throughput_interval":bucket_seconds}
+    if not timeline:
+        report["batches"] = {"total":batch_count, "finished":0, "running":0}
+        return report
+    start = min(e["start"] for e in timeline)
+    report["start"] = start
+    report["elapsed"] = now - start
+
+    by_kind = {}
+    for e in timeline:
+        by_kind.setdefault(e["kind"], [])
+        if e["seconds"] is not None:
+            by_kind[e["kind"]].append(e["seconds"])
+    for kind, durations in by_kind.items():
+        report["phases"][kind] = wiglaf.metrics.summarize(durations, percentiles)
+
+    by_instance = {}
+    for e in timeline:
+        by_instance.setdefault(e["instance"], []).append(e)
+    for instance, entries in sorted(by_instance.items()):
+        first = min(e["start"] for e in entries)
+        last = max(e["end"] if e["end"] is not None else now for e in entries)
+        seconds = {}
+        for e in entries:
+            seconds[e["kind"]] = seconds.get(e["kind"], 0) + ((e["end"] if e["end"] is not None else now) - e["start"])
+        batch_intervals = [(e["start"], e["end"] if e["end"] is not None else now) for e in entries if e["kind"] == "CommandsToRun"]
+        report["instances"][instance] = {
+            "first":first,
+            "last":last,
+            "batches":len([e for e in entries if e["kind"] == "CommandsToRun" and e["end"] is not None]),
+            "seconds":seconds,
+            # The share of the node's time it had a batch running.  Uploads are left out, as they run in the
+            # background alongside batches, and batches running side by side in several slots count once.
+            "busy":covered_seconds(batch_intervals) / (last - first) if last > first else None
+        }
+
+    batches = [e for e in timeline if e["kind"] == "CommandsToRun" and e["batch"] is not None]
+    finished = {}
+    for e in batches:
+        if e["end"] is not None and (e["batch"] not in finished or e["end"] < finished[e["batch"]]):
+            finished[e["batch"]] = e["end"]
+    running = [e for e in batches if e["end"] is None and e["batch"] not in finished]
+    report["batches"] = {"total":batch_count, "finished":len(finished), "running":len(running)}
+
+    durations = [e["seconds"] for e in batches if e["seconds"] is not None]
+    if durations:
+        threshold = wiglaf.metrics.percentile(durations, 50) * straggler_factor
+        for e in batches:
+            seconds = e["seconds"] if e["seconds"] is not None else now - e["start"]
+            if seconds > threshold:
+                report["stragglers"].append({"instance":e["instance"], "batch":e["batch"], "seconds":seconds, "running":e["end"] is None})
+        report["stragglers"].sort(key=lambda s: -s["seconds"])
+
+    if finished:
+        counts = {}
+        for end in finished.values():
+            bucket = int((end - start) // bucket_seconds)
+            counts[bucket] = counts.get(bucket, 0) + 1
+        total = 0
+        for bucket in range(max(counts) + 1):
+            total += counts.get(bucket, 0)
+            report["throughput"].append({"offset":bucket * bucket_seconds, "finished":counts.get(bucket, 0), "cumulative":total})
+
+    if batch_count is not None:
+        remaining = batch_count - len(finished)
+        recent = [end for end in finished.values() if end >= now - eta_window]
+        window = min(eta_window, now - start)
+        rate = len(recent) / window if recent and window > 0 else (len(finished) / (now - start) if now > start else 0)
+        report["batches"]["rate_per_minute"] = rate * 60
+        if remaining <= 0:
+            report["eta_seconds"] = 0
+        elif rate > 0:
+            report["eta_seconds"] = remaining / rate
+        else:
+            report["eta_seconds"] = None
+    return report
+
+def job_report(bucket, job_name, s3=None, **kwargs):
+    """
+    Reads a job's metrics (or checkpoints) and manifest from S3 and analyzes them.
+    """
+    s3 = s3 if s3 else wiglaf.s3.client("s3")
+    manifest_key = "jobs/{}/resources/wiglaf_manifest.json".format(job_name)
+    manifest = json.loads(s3.get_object(Bucket=bucket, Key=manifest_key)["Body"].read().decode("utf-8"))
+    records = wiglaf.metrics.read_metrics(bucket, job_name, s3=s3)
+    timeline = wiglaf.metrics.timeline(records) if records else build_timeline(iter_checkpoints(bucket, job_name, s3=s3))
+    report = analyze(timeline, batch_count=manifest.get("NumberOfBatches"), **kwargs)
+    report["job"] = job_name
+    return report
+
+def _duration(seconds):
+    if seconds is None:
+        return "-"
+    seconds = int(round(seconds))
+    hours, rem = divmod(seconds, 3600)
+    minutes, seconds = divmod(rem, 60)
+    if hours:
+        return "{}h{:02d}m{:02d}s".format(hours, minutes, seconds)
+    if minutes:
+        return "{}m{:02d}s".format(minutes, seconds)
+    return "{}s".format(seconds)
+
+def format_text(report, max_stragglers=10):
+    batches = report["batches"]
+    lines = ["Job '{}'".format(report.get("job", "")), ""]
+    progress = "{} of {}".format(batches["finished"], batches["total"]) if batches.get("total") is not None else str(batches["finished"])
+    lines.append("Batches finished: {} ({} running)".format(progress, batches["running"]))
+    if "elapsed" in report:
+        lines.append("Elapsed: {}".format(_duration(report["elapsed"])))
+    if batches.get("rate_per_minute") is not None:
+        lines.append("Rate: {:.2f} batches/minute".format(batches["rate_per_minute"]))
+    if "eta_seconds" in report:
+        lines.append("Estimated time remaining: {}".format(_duration(report["eta_seconds"]) if report["eta_seconds"] is not None else "unknown"))
+    if report["phases"]:
+        lines.extend(["", "Phase durations:"])
+        names = [key for key in sorted(next(iter(report["phases"].values())).keys()) if key.startswith("p")]
+        lines.append("  {:<18} {:>6} {:>10} {:>10} {}".format("phase", "count", "total", "mean", " ".join("{:>10}".format(n) for n in names)))
+        for kind, summary in sorted(report["phases"].items()):
+            if not summary["count"]:
+                continue
+            lines.append("  {:<18} {:>6} {:>10} {:>10} {}".format(kind, summary["count"], _duration(summary["total"]), _duration(summary["mean"]),
+                                                             " ".join("{:>10}".format(_duration(summary.get(n))) for n in names)))
+    if report["instances"]:
+        lines.extend(["", "Instances:"])
+        for instance, info in sorted(report["instances"].items()):
+            busy = "{:.0f}%".format(info["busy"] * 100) if info["busy"] is not None else "-"
+            lines.append("  {:<20} {:>5} batches  busy {:>5}  {}".format(instance, info["batches"], busy,
+                                                                         ", ".join("{} {}".format(k, _duration(v)) for k, v in sorted(info["seconds"].items()))))
+    if report["stragglers"]:
+        lines.extend(["", "Stragglers:"])
+        for straggler in report["stragglers"][:max_stragglers]:
+            lines.append("  batch {:<6} on {:<20} {}{}".format(straggler["batch"], straggler["instance"], _duration(straggler["seconds"]),
+                                                          " (still running)" if straggler["running"] else ""))
+        if len(report["stragglers"]) > max_stragglers:
+            lines.append("  ...and {} more".format(len(report["stragglers"]) - max_stragglers))
+    if report["throughput"]:
+        lines.extend(["", "Batches finished per {}:".format(_duration(report["throughput_interval"]))])
+        peak = max(t["finished"] for t in report["throughput"]) or 1
+        for t in report["throughput"]:
+            lines.append("  +{:>9} {:>6} {}".format(_duration(t["offset"]), t["finished"], "#" * int(round(40.0 * t["finished"] / peak))))
+    return "\n".join(lines)
+
+def format_json(report):
+    return json.dumps(report, indent=2, sort_keys=True)
@@ -0,0 +1,13 @@
+# How batch results are named under jobs/<job>/results/.  The Lambda parses them when it writes the results index
+# (see write_results_index in lambda/handlers.py) and wiglaf/results.py when it lists results without one, so only
+# the standard library is used here (see lambda_zipfile in wiglaf/cloudformation).
+
+def parse_result_key(result_key):
+    """
+    (batch, instance) for a result's key relative to the results prefix: batch results are named
+    <file>.<batch>.<instance>.  Both are None for anything else, like the reduce stage's outputs.
+    """
+    parts = result_key.rsplit(".", 2)
+    if "/" not in result_key and len(parts) == 3 and parts[1].isdigit() and parts[2].startswith("i-"):
+        return int(parts[1]), parts[2]
+    return None, None
@@ -0,0 +1,81 @@
+import botocore.exceptions
+import gzip
+import wiglaf.s3
+
+from calvin import json
+from wiglaf.result_keys import parse_result_key
+
+# Reads the index of a job's results that the Lambda writes when the job finishes (see finish_job in
+# lambda/handlers.py): jobs/<job>/results/wiglaf_results.json holds a summary, with Files, Bytes, ReducedFiles
+# and the keys of the index's Shards, gzipped JSON lines of
+#   {"key", "size", "etag", "batch", "instance"}
+# with keys relative to jobs/<job>/results/.  For jobs that haven't finished, or finished before there was an
+# index, the entries come from listing the results instead.  Download links are only made when asked for.
+
+RESULTS_FILE = "wiglaf_results.json"
+# How long presigned links work for.  Seven days is as long as S3 allows.
+PRESIGN_SECONDS = 60 * 60 * 24 * 7
+
+def results_prefix(job_name):
+    return "jobs/{}/results/".format(job_name)
+
+def load_summary(bucket, job_name, s3=None):
+    """
+    The summary the Lambda wrote when the job finished, or None if there isn't one (or it's the list of links
+    older versions wrote).
+    """
+    s3 = s3 if s3 else wiglaf.s3.client("s3")
+    try:
+        summary = json.loads(s3.get_object(Bucket=bucket, Key=results_prefix(job_name) + RESULTS_FILE)["Body"].read().decode("utf-8"))
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return summary if isinstance(summary, dict) and "Shards" in summary else None
+
+def iter_listed(bucket, job_name, s3=None):
+    prefix = results_prefix(job_name)
+    for obj in wiglaf.s3.iter_files(bucket, prefix, s3=s3):
+        key = obj["Key"][len(prefix):]
+        if not key or key == RESULTS_FILE or key.endswith("/"):
+            continue
+        batch, instance = parse_result_key(key)
+        yield {"key":key, "size":obj["Size"], "etag":obj["ETag"].strip('"'), "batch":batch, "instance":instance}
+
+def iter_results(bucket, job_name, summary=None, s3=None):
+    """
+    Streams a job's result entries, one index shard at a time.  Falls back to listing without a summary.
+    """
+    s3 = s3 if s3 else wiglaf.s3.client("s3")
+    if summary is None:
+        summary = load_summary(bucket, job_name, s3=s3)
+    if summary is None:
+        yield from iter_listed(bucket, job_name, s3=s3)
+        return
+    for shard in summary["Shards"]:
+        lines = gzip.decompress(s3.get_object(Bucket=bucket, Key=shard)["Body"].read()).decode("utf-8")
+        for line in lines.splitlines():
+            if line:
+                yield json.loads(line)
+
+def select(entries, reduced=False):
+    """
+    Just the reduce stage's merged outputs with reduced, otherwise everything.
+    """
+    return (e for e in entries if e["key"].startswith("reduced/")) if reduced else entries
+
+def presign(bucket, job_name, entry, s3=None):
+    s3 = s3 if s3 else wiglaf.s3.client("s3")
+    return s3.generate_presigned_url(ClientMethod="get_object", Params={"Bucket":bucket, "Key":results_prefix(job_name) + entry["key"]},
+                                     ExpiresIn=PRESIGN_SECONDS)
+
+def as_listing(job_name, entry):
+    """
+    An entry in the shape of a listed object, for wiglaf.s3.download_files.
+    """
+    return {"Key":results_prefix(job_name) + entry["key"], "Size":entry["size"], "ETag":'"{}"'.format(entry["etag"])}
+
+def format_text(entry, link=None):
+    batch = "-" if entry["batch"] is None else entry["batch"]
+    line = "{:>12}  {:>6}  {:<19}  {}".format(entry["size"], batch, entry["instance"] or "-", entry["key"])
+    return line + "  " + link if link else line
@@ -1,5 +1,35 @@
 import boto3
-from calvin import files, json
+import botocore.config
+import botocore.exceptions
+import concurrent.futures
+import hashlib
+import logging
+import mmap
+import os
+import queue
+import threading
+import time
+from calvin import json
+
+DEFAULT_CONCURRENCY = 16
+CHUNK_SIZE = 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def client(service="s3", max_pool_connections=DEFAULT_CONCURRENCY):
+    """
+    Returns a client shared between threads, with a connection pool big enough for the given concurrency.
+    Clients are tied to the default session, so calling boto3.setup_default_session gets you fresh ones.
+    """
+    cache_key = (id(boto3.DEFAULT_SESSION), service, max_pool_connections)
+    with _clients_lock:
+        if cache_key not in _clients:
+            config = botocore.config.Config(max_pool_connections=max_pool_connections)
+            _clients[cache_key] = boto3.client(service, config=config)
+        return _clients[cache_key]
 
 def bucket_and_key(bucket, key, *args, **kwargs):
     bucket = bucket if not bucket.startswith("s3://") else bucket[5:]
@@ -32,46 +62,390 @@ def read(*args, **kwargs):
 def load(*args, **kwargs):
     return json.loads(read(*args, **kwargs))
 
-def upload_file(*args, **kwargs):
+def remote_matches(head, filename, md5=None):
+    """
+    Whether the object described by a head_object response has the same contents as the file on disk.
+    Checks our md5 metadata tag first, then the ETag.  md5 can be passed in if it's already been computed.
+    """
+    if head["ContentLength"] != os.path.getsize(filename):
+        return False
+    etag = head.get("ETag", "").strip('"')
+    tagged = head.get("Metadata", {}).get("md5")
+    if tagged or "-" not in etag:
+        md5 = md5 if md5 else file_md5(filename)
+        return md5 in (tagged, etag)
+    return matches_local_file({"Size":head["ContentLength"], "ETag":etag}, filename)
+
+def _upload_multipart(s3, bucket, key, filename, metadata, part_size, executor):
+    size = os.path.getsize(filename)
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, Metadata=metadata)["UploadId"]
+
+    def upload_part(number, offset):
+        with open(filename, "rb") as f:
+            f.seek(offset)
+            data = f.read(part_size)
+        response = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data)
+        return {"PartNumber":number, "ETag":response["ETag"]}
+
+    try:
+        futures = [executor.submit(upload_part, i + 1, offset) for i, offset in enumerate(range(0, size, part_size))]
+        parts = [future.result() for future in futures]
+        s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts":parts})
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+def head(s3, bucket, key):
+    """
+    head_object, but returns None if the object doesn't exist.
+    """
+    try:
+        return s3.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+def _sync_file(s3, filename, bucket, key, force, part_size, part_executor):
+    md5 = file_md5(filename)
+    if not force:
+        existing = head(s3, bucket, key)
+        if existing and remote_matches(existing, filename, md5=md5):
+            logging.debug("s3://{}/{} is unchanged, skipping upload.".format(bucket, key))
+            return False
+    metadata = {"md5":md5}
+    if os.path.getsize(filename) > part_size:
+        _upload_multipart(s3, bucket, key, filename, metadata, part_size, part_executor)
+    else:
+        with open(filename, "rb") as f:
+            s3.put_object(Bucket=bucket, Key=key, Body=f, Metadata=metadata)
+    logging.debug("Uploaded {} to s3://{}/{}.".format(filename, bucket, key))
+    return True
+
+def upload_file(filename, *args, force=False, part_size=MULTIPART_CHUNKSIZE, concurrency=DEFAULT_CONCURRENCY, s3=None, **kwargs):
+    """
+    Uploads the file unless S3 already has an identical copy (by md5 tag or ETag).  force=True always uploads,
+    which is what you want if the point is to re-trigger the Lambda watching the bucket.
+    Files bigger than part_size are uploaded in parts, concurrency parts at a time.
+    Returns True if the file was uploaded and False if it was skipped.
+    """
     bucket, key = bucket_and_key(*args, **kwargs)
-    # Check if file already in S3.
-    # If no, or if force=True, upload. (Even if the file is the same, uploading re-triggers the lambda watching the bucket.)
-    # If yes, see if it has an etag or MD5 tag.
-    # If so, take MD5 of the file on disk.  If it matches either S3 object tag, skip the upload.
-    # If they don't match, upload the new file and attach the MD5 tag.
-    pass
+    s3 = s3 if s3 else client("s3", max_pool_connections=concurrency)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return _sync_file(s3, filename, bucket, key, force, part_size, executor)
+
+def upload_files(uploads, bucket, force=False, part_size=MULTIPART_CHUNKSIZE, concurrency=DEFAULT_CONCURRENCY, s3=None):
+    """
+    Uploads many files at once.  uploads is a list of (filename, key) pairs.  Unchanged files are skipped as in
+    upload_file; large files are split into parts.
+    Returns a dict of stats about the transfer.
+    """
+    s3 = s3 if s3 else client("s3", max_pool_connections=concurrency * 2)
+    stats = {"files":0, "skipped":0, "bytes":0}
+    stats_lock = threading.Lock()
+
+    def upload(filename, key):
+        uploaded = _sync_file(s3, filename, bucket, key, force, part_size, part_executor)
+        with stats_lock:
+            if uploaded:
+                stats["files"] += 1
+                stats["bytes"] += os.path.getsize(filename)
+            else:
+                stats["skipped"] += 1
+
+    start = time.time()
+    # Parts get their own pool so big files can't deadlock waiting on threads held by whole-file uploads.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as part_executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(upload, filename, key) for filename, key in uploads]:
+                future.result()
+    stats["seconds"] = time.time() - start
+    stats["bytes_per_second"] = stats["bytes"] / stats["seconds"] if stats["seconds"] else 0
+    logging.info("Uploaded {files} files ({bytes} bytes) in {seconds:.1f}s, {bytes_per_second:.0f} bytes/s.  {skipped} unchanged files skipped.".format(**stats))
+    return stats
 
 def delete_file(*args, **kwargs):
     bucket, key = bucket_and_key(*args, **kwargs)
-    pass
-
-def delete_file(bucket, prefix, *args, **kwargs):
-    pass
-
-def list_bucket(bucket, prefix, *args, **kwargs):
-    pass
-
-def list_files(bucket, prefix=""):
-    s3 = boto3.client("s3")
-    response = s3.list_objects_v2(
-        Bucket=bucket,
-        Prefix=prefix,
-        MaxKeys=1000,
-    )
-    objects = response.get('Contents', [])
-    token = response.get('NextContinuationToken', None)
-    while token:
-        response = s3.list_objects_v2(
+    client("s3").delete_object(Bucket=bucket, Key=key)
+
+def delete_keys(s3, bucket, keys, attempts=5):
+    """
+    Deletes up to 1000 keys in a single call, retrying any keys S3 reports per-key errors for.
+    Returns the list of keys that still couldn't be deleted.
+    """
+    remaining = list(keys)
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(min(0.1 * 2 ** attempt, 5))
+        response = s3.delete_objects(
             Bucket=bucket,
-            Prefix=prefix,
-            MaxKeys=1000,
-            ContinuationToken=token
+            Delete={
+                "Objects": [{"Key":k} for k in remaining],
+                "Quiet":True
+            }
         )
-        objects.extend(response['Contents'])
-        token = response.get('NextContinuationToken', None)
-    return objects
-
-def download_files(bucket, prefix, directory):
-    for fileobj in list_files(bucket=bucket, prefix=prefix):
-        files.writeb(os.path.join(directory, remove_prefix(filename=fileobj["Key"], prefix=prefix)),
-                     body(bucket=bucket, key=fileobj["Key"]).read())
+        errors = response.get("Errors", [])
+        for error in errors:
+            logging.debug("Error deleting s3://{}/{}: {} {}".format(bucket, error["Key"], error.get("Code"), error.get("Message")))
+        remaining = [error["Key"] for error in errors]
+        if not remaining:
+            break
+    return remaining
+
+def delete_prefix(bucket, prefix="", concurrency=DEFAULT_CONCURRENCY, s3=None):
+    """
+    Deletes everything under the prefix.  Batches of up to 1000 keys are sent off to a pool of threads as soon
+    as each page is listed, so deletion starts right away and overlaps with the rest of the listing.
+    Returns a dict of stats about the deletion.
+    """
+    s3 = s3 if s3 else client("s3", max_pool_connections=concurrency + 1)
+    stats = {"deleted":0, "failed":0}
+    stats_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(concurrency * 2)
+
+    def delete_batch(keys):
+        try:
+            failed = len(delete_keys(s3, bucket, keys))
+        except Exception:
+            logging.exception("Failed to delete batch of {} keys from s3://{}".format(len(keys), bucket))
+            failed = len(keys)
+        finally:
+            slots.release()
+        with stats_lock:
+            stats["deleted"] += len(keys) - failed
+            stats["failed"] += failed
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for page in iter_pages(bucket, prefix, s3=s3):
+            slots.acquire()
+            executor.submit(delete_batch, [obj["Key"] for obj in page])
+    stats["seconds"] = time.time() - start
+    stats["keys_per_second"] = stats["deleted"] / stats["seconds"] if stats["seconds"] else 0
+    logging.info("Deleted {deleted} objects in {seconds:.1f}s, {keys_per_second:.0f} keys/s.  {failed} failed.".format(**stats))
+    return stats
+
+def _iter_responses(s3, **kwargs):
+    response = s3.list_objects_v2(**kwargs)
+    yield response
+    while response.get("NextContinuationToken"):
+        response = s3.list_objects_v2(ContinuationToken=response["NextContinuationToken"], **kwargs)
+        yield response
+
+def iter_pages(bucket, prefix="", start_after=None, end_before=None, page_size=1000, s3=None):
+    """
+    Lazily yields the objects under the prefix one page (list of dicts) at a time, in key order.
+    Only one page is held in memory, and the caller can stop iterating at any point to stop listing.
+    If given, only keys after start_after and before end_before are listed.
+    """
+    s3 = s3 if s3 else client("s3")
+    kwargs = {"Bucket":bucket, "Prefix":prefix, "MaxKeys":page_size}
+    if start_after:
+        kwargs["StartAfter"] = start_after
+    for response in _iter_responses(s3, **kwargs):
+        objects = response.get("Contents", [])
+        if end_before is not None and objects and objects[-1]["Key"] >= end_before:
+            objects = [obj for obj in objects if obj["Key"] < end_before]
+            if objects:
+                yield objects
+            return
+        if objects:
+            yield objects
+
+def iter_files(*args, **kwargs):
+    """
+    Lazily yields the objects under a prefix one at a time.  Takes the same arguments as iter_pages.
+    """
+    for page in iter_pages(*args, **kwargs):
+        for obj in page:
+            yield obj
+
+def list_prefixes(bucket, prefix="", delimiter="/", s3=None):
+    """
+    Returns the common prefixes one level below the prefix, along with any objects directly under it.
+    """
+    s3 = s3 if s3 else client("s3")
+    prefixes = []
+    objects = []
+    for response in _iter_responses(s3, Bucket=bucket, Prefix=prefix, Delimiter=delimiter, MaxKeys=1000):
+        prefixes.extend(p["Prefix"] for p in response.get("CommonPrefixes", []))
+        objects.extend(response.get("Contents", []))
+    return prefixes, objects
+
+def iter_pages_parallel(bucket, prefix="", delimiter="/", boundaries=None, concurrency=DEFAULT_CONCURRENCY, s3=None):
+    """
+    Like iter_pages, but splits the listing into ranges that are listed at the same time.
+    By default the ranges are the common prefixes one delimiter below the prefix.  If boundaries is given
+    instead, it's a sorted list of keys, and each range runs from one boundary to the next.
+    Pages come back in whatever order they finish, and at most a few pages per worker are buffered.
+    """
+    s3 = s3 if s3 else client("s3", max_pool_connections=concurrency)
+    if boundaries:
+        # StartAfter is exclusive, so each boundary key itself belongs to the range below it.
+        edges = [None] + list(boundaries) + [None]
+        ranges = [{"prefix":prefix, "start_after":lo, "end_before":hi + "\0" if hi else None} for lo, hi in zip(edges[:-1], edges[1:])]
+    else:
+        subprefixes, objects = list_prefixes(bucket, prefix, delimiter=delimiter, s3=s3)
+        if objects:
+            yield objects
+        ranges = [{"prefix":subprefix} for subprefix in subprefixes]
+    if not ranges:
+        return
+
+    pages = queue.Queue(maxsize=concurrency * 2)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker(r):
+        try:
+            for page in iter_pages(bucket, s3=s3, **r):
+                if not put(page):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        for r in ranges:
+            executor.submit(worker, r)
+        remaining = len(ranges)
+        while remaining:
+            page = pages.get()
+            if page is done:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield page
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+def list_files(bucket, prefix="", s3=None):
+    """
+    Returns every object under the prefix as a list.  Prefer iter_files unless you really need them all at once.
+    """
+    return list(iter_files(bucket, prefix, s3=s3))
+
+def _iter_blocks(filename, block_size):
+    # Large files are memory-mapped so hashing them doesn't copy every block into a new bytes object.
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        if size < MMAP_THRESHOLD:
+            for block in iter(lambda: f.read(block_size), b""):
+                yield block
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for offset in range(0, size, block_size):
+                with memoryview(mapped)[offset:offset+block_size] as block:
+                    yield block
+
+def file_md5(filename):
+    md5 = hashlib.md5()
+    for block in _iter_blocks(filename, CHUNK_SIZE):
+        md5.update(block)
+    return md5.hexdigest()
+
+def file_sha256(filename):
+    sha256 = hashlib.sha256()
+    for block in _iter_blocks(filename, CHUNK_SIZE):
+        sha256.update(block)
+    return sha256.hexdigest()
+
+def file_etag(filename, part_count=None, part_size=MULTIPART_CHUNKSIZE):
+    """
+    Computes the ETag S3 would give the file if uploaded in parts of part_size (or in one piece if part_count is None).
+    """
+    if not part_count:
+        return file_md5(filename)
+    digests = [hashlib.md5(part).digest() for part in _iter_blocks(filename, part_size)]
+    return "{}-{}".format(hashlib.md5(b"".join(digests)).hexdigest(), len(digests))
+
+def matches_local_file(fileobj, filename):
+    """
+    Whether the file on disk is the same as the listed S3 object, going by size and then ETag.
+    """
+    if not os.path.isfile(filename) or os.path.getsize(filename) != fileobj["Size"]:
+        return False
+    etag = fileobj["ETag"].strip('"')
+    if "-" not in etag:
+        return file_etag(filename) == etag
+    part_count = int(etag.split("-")[1])
+    # We don't know what part size the uploader used, so try the boto3 default and the smallest size that fits.
+    candidates = [MULTIPART_CHUNKSIZE, -(-fileobj["Size"] // part_count // (1024 * 1024)) * 1024 * 1024]
+    return any(file_etag(filename, part_count=part_count, part_size=size) == etag for size in candidates if size)
+
+def download_file(s3, bucket, key, filename, chunk_size=CHUNK_SIZE):
+    """
+    Streams an object to disk without holding the whole body in memory.  Returns the number of bytes written.
+    """
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    partial = "{}.{}.part".format(filename, threading.get_ident())
+    written = 0
+    response = s3.get_object(Bucket=bucket, Key=key)
+    try:
+        with open(partial, "wb") as f:
+            for chunk in response["Body"].iter_chunks(chunk_size):
+                f.write(chunk)
+                written += len(chunk)
+        os.replace(partial, filename)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return written
+
+def download_files(bucket, prefix, directory, concurrency=DEFAULT_CONCURRENCY, chunk_size=CHUNK_SIZE, s3=None, objects=None):
+    """
+    Downloads everything under the prefix into the directory using a pool of threads sharing one client.
+    objects, an iterable of listed objects (dicts with Key, Size and ETag), downloads just those instead of
+    listing the prefix.  Files already on disk with matching size and ETag are skipped.
+    Returns a dict of stats about the transfer.
+    """
+    s3 = s3 if s3 else client("s3", max_pool_connections=concurrency)
+    stats = {"files":0, "skipped":0, "bytes":0, "errors":0}
+    stats_lock = threading.Lock()
+    # Bounds how many downloads are queued up at once so huge listings don't pile up futures in memory.
+    slots = threading.BoundedSemaphore(concurrency * 2)
+
+    def fetch(fileobj, filename):
+        try:
+            if matches_local_file(fileobj, filename):
+                with stats_lock:
+                    stats["skipped"] += 1
+                return
+            written = download_file(s3, bucket, fileobj["Key"], filename, chunk_size=chunk_size)
+            with stats_lock:
+                stats["files"] += 1
+                stats["bytes"] += written
+        except Exception:
+            logging.exception("Failed to download s3://{}/{}".format(bucket, fileobj["Key"]))
+            with stats_lock:
+                stats["errors"] += 1
+        finally:
+            slots.release()
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for fileobj in objects if objects is not None else iter_files(bucket=bucket, prefix=prefix, s3=s3):
+            relative = remove_prefix(filename=fileobj["Key"], prefix=prefix)
+            if not relative or fileobj["Key"].endswith("/"):
+                continue
+            slots.acquire()
+            executor.submit(fetch, fileobj, os.path.join(directory, relative))
+    stats["seconds"] = time.time() - start
+    stats["bytes_per_second"] = stats["bytes"] / stats["seconds"] if stats["seconds"] else 0
+    logging.info("Downloaded {files} files ({bytes} bytes) in {seconds:.1f}s, {bytes_per_second:.0f} bytes/s.  {skipped} unchanged files skipped, {errors} errors.".format(**stats))
+    return stats
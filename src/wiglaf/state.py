@@ -0,0 +1,79 @@
+import boto3
+import logging
+import random
+import time
+
+# Client side of the per-job state kept in the cluster's DynamoDB table by the Lambda (see lambda/tracker.py)
+# and by the nodes' work queue (see wiglaf.node.work_queue).
+
+# Items DynamoDB doesn't get to in a batch write (because it's throttling) are retried this many times, backing off
+# exponentially with jitter, as botocore does for throttled calls.
+UNPROCESSED_RETRIES = 10
+UNPROCESSED_BACKOFF_SECONDS = 0.05
+UNPROCESSED_BACKOFF_MAX_SECONDS = 20
+
+def _job_id(job_name):
+    return "jobs/{}".format(job_name)
+
+def _scan_ids(dynamodb, table_name, prefix):
+    kwargs = {
+        "TableName":table_name,
+        "ProjectionExpression":"Id",
+        "FilterExpression":"begins_with(Id, :prefix)",
+        "ExpressionAttributeValues":{":prefix":{"S":prefix}}
+    }
+    while True:
+        response = dynamodb.scan(**kwargs)
+        for item in response.get("Items", []):
+            yield item["Id"]["S"]
+        if not response.get("LastEvaluatedKey"):
+            return
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+def _delete_ids(dynamodb, table_name, ids):
+    batch = []
+    for item_id in ids:
+        batch.append({"DeleteRequest":{"Key":{"Id":{"S":item_id}}}})
+        if len(batch) == 25:
+            _write_batch(dynamodb, table_name, batch)
+            batch = []
+    if batch:
+        _write_batch(dynamodb, table_name, batch)
+
+def _write_batch(dynamodb, table_name, requests, sleep=time.sleep):
+    for attempt in range(UNPROCESSED_RETRIES + 1):
+        response = dynamodb.batch_write_item(RequestItems={table_name:requests})
+        requests = response.get("UnprocessedItems", {}).get(table_name, [])
+        if not requests:
+            return
+        if attempt < UNPROCESSED_RETRIES:
+            sleep(random.uniform(0, min(UNPROCESSED_BACKOFF_MAX_SECONDS, UNPROCESSED_BACKOFF_SECONDS * 2 ** attempt)))
+    raise RuntimeError("DynamoDB left {} items in {} unprocessed after {} retries.".format(len(requests), table_name, UNPROCESSED_RETRIES))
+
+def clear_results(table_name, job_name):
+    """
+    Forgets which results have been seen and which batches and reducers have been run for a job, keeping its target.
+    """
+    dynamodb = boto3.client("dynamodb")
+    for kind in ["results", "batches", "reduce"]:
+        _delete_ids(dynamodb, table_name, _scan_ids(dynamodb, table_name, "{}/{}/".format(_job_id(job_name), kind)))
+    dynamodb.update_item(
+        TableName=table_name,
+        Key={"Id":{"S":_job_id(job_name)}},
+        UpdateExpression="REMOVE NextBatch, Finished"
+    )
+    dynamodb.update_item(
+        TableName=table_name,
+        Key={"Id":{"S":"{}/completion".format(_job_id(job_name))}},
+        UpdateExpression="REMOVE Completed, Done, ClaimExpires"
+    )
+    logging.debug("Cleared result state for job '{}'.".format(job_name))
+
+def clear_job(table_name, job_name, dynamodb=None):
+    """
+    Removes all state for a job, so that a job of the same name can be run again from the start.
+    """
+    dynamodb = dynamodb if dynamodb else boto3.client("dynamodb")
+    _delete_ids(dynamodb, table_name, _scan_ids(dynamodb, table_name, "{}/".format(_job_id(job_name))))
+    _delete_ids(dynamodb, table_name, [_job_id(job_name)])
+    logging.debug("Cleared all state for job '{}'.".format(job_name))
@@ -0,0 +1,42 @@
+import math
+
+# Summaries of lists of numbers, for metrics (see wiglaf/metrics.py) and API call latencies (see
+# wiglaf/profiling.py).  Only the standard library is used, so that the Lambda can import this too (see
+# lambda_zipfile in wiglaf/cloudformation).
+
+DEFAULT_PERCENTILES = [50, 90, 99]
+
+def percentile(values, p):
+    """
+    Linearly interpolated percentile of a non-empty list.
+    """
+    values = sorted(values)
+    position = (len(values) - 1) * p / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def summarize(values, percentiles=DEFAULT_PERCENTILES):
+    if not values:
+        return {"count":0}
+    summary = {"count":len(values), "total":sum(values), "mean":sum(values) / len(values), "min":min(values), "max":max(values)}
+    for p in percentiles:
+        summary["p{}".format(p)] = percentile(values, p)
+    return summary
+
+def histogram(values, minimum=1):
+    """
+    Counts values into power-of-two buckets: a list of {"low", "high", "count"}.  Values below minimum (which
+    should be a power of two) share a bucket starting at 0.
+    """
+    counts = {}
+    for value in values:
+        exponent = None if value < minimum else math.floor(math.log2(value))
+        counts[exponent] = counts.get(exponent, 0) + 1
+    buckets = []
+    if None in counts:
+        buckets.append({"low":0, "high":minimum, "count":counts.pop(None)})
+    if counts:
+        for exponent in range(min(counts), max(counts) + 1):
+            buckets.append({"low":2.0 ** exponent, "high":2.0 ** (exponent + 1), "count":counts.get(exponent, 0)})
+    return buckets
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The Lambda's modules and the nodes' scripts are imported the way they're run, as top-level modules, and the AWS
+# clients are the in-process stand-ins from benchmarks/fakes.py.
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+for directory in ["src", os.path.join("src", "wiglaf", "node"), "lambda", "benchmarks"]:
+    sys.path.insert(0, os.path.join(ROOT, directory))
@@ -0,0 +1,126 @@
+import gzip
+import json
+import os
+import pytest
+import agent
+import uploader
+import work_queue
+from fakes import FakeEC2, FakeS3
+
+BUCKET = "wiglaf-data"
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+@pytest.fixture
+def node(tmp_path, clock):
+    s3 = FakeS3()
+    directories = {}
+    for name in ["work", "slots", "cache", "logs"]:
+        directories[name] = str(tmp_path / name)
+        (tmp_path / name).mkdir()
+    node = agent.Agent(BUCKET, "unused", instance_id="i-1", s3=s3, ec2=FakeEC2(), queue=work_queue.LocalWorkQueue(clock=clock.time),
+                       work_directory=directories["work"], slot_directory=directories["slots"], cache_directory=directories["cache"],
+                       log_directory=directories["logs"], metadata=lambda path: None)
+    node.manifest = {"JobName":"job", "NumberOfBatches":2, "FilesToUpload":["out.dat"], "LeaseSeconds":60}
+    node.uploader = uploader.Uploader(s3, BUCKET)
+    yield node
+    node.uploader.close()
+
+def test_batches_missing_outputs_are_left_to_be_run_again(node, clock):
+    # Batch 1 doesn't write its output.
+    node.manifest["CommandsToRun"] = ['[ "$WIGLAF_BATCH" = 1 ] || echo done > out.dat']
+    node.manifest["RunsPerNode"] = 2
+    node.run_slot(0)
+    node.uploader.flush()
+    assert list(node.s3.objects) == ["jobs/job/results/out.dat.0.i-1"]
+    clock.now += 61
+    assert node.queue.try_claim("job", 2, "i-2", 60) == 1
+    assert node.queue.try_claim("job", 2, "i-2", 60) is None
+
+def test_batches_get_their_own_copies_of_the_resources(node):
+    with open(os.path.join(node.work_directory, "input.dat"), "w") as f:
+        f.write("input\n")
+    # Each batch's output is what it found in its input, after it has added to it.
+    node.manifest["CommandsToRun"] = ["echo $WIGLAF_BATCH >> input.dat && cp input.dat out.dat"]
+    node.manifest["RunsPerNode"] = 2
+    node.run_slot(0)
+    node.uploader.flush()
+    assert node.s3.objects["jobs/job/results/out.dat.1.i-1"] == b"input\n1\n"
+    with open(os.path.join(node.work_directory, "input.dat")) as f:
+        assert f.read() == "input\n"
+
+def test_slots_only_copy_again_what_a_batch_changed(node):
+    for name, body in [("input.dat", "input\n"), ("large.dat", "large\n")]:
+        with open(os.path.join(node.work_directory, name), "w") as f:
+            f.write(body)
+    # Fails if anything the previous batch made or changed is still around.
+    node.manifest["CommandsToRun"] = ["test ! -e scratch && mkdir scratch && echo $WIGLAF_BATCH >> input.dat && cat input.dat > out.dat"]
+    node.manifest["RunsPerNode"] = 1
+    large = os.path.join(node.slot_directory, "0", "large.dat")
+    node.run_slot(0)
+    copied = os.stat(large).st_ino
+    node.run_slot(0)
+    node.uploader.flush()
+    assert node.s3.objects["jobs/job/results/out.dat.0.i-1"] == b"input\n0\n"
+    assert node.s3.objects["jobs/job/results/out.dat.1.i-1"] == b"input\n1\n"
+    assert os.stat(large).st_ino == copied
+
+def test_linked_resources_are_read_only(node):
+    with open(os.path.join(node.work_directory, "input.dat"), "w") as f:
+        f.write("input\n")
+    node.manifest["LinkResources"] = True
+    node.protect_resources()
+    assert not os.stat(os.path.join(node.work_directory, "input.dat")).st_mode & 0o222
+    node.manifest["CommandsToRun"] = ["cat input.dat > out.dat"]
+    node.manifest["RunsPerNode"] = 1
+    node.run_slot(0)
+    node.uploader.flush()
+    assert node.s3.objects["jobs/job/results/out.dat.0.i-1"] == b"input\n"
+    assert not node.draining.is_set()
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="Only root can write to the read-only resources.")
+def test_writing_to_linked_resources_stops_the_node(node, clock):
+    with open(os.path.join(node.work_directory, "input.dat"), "w") as f:
+        f.write("input\n")
+    node.manifest["LinkResources"] = True
+    node.protect_resources()
+    node.manifest["CommandsToRun"] = ["echo changed >> input.dat && cp input.dat out.dat"]
+    node.run_slot(0)
+    node.uploader.flush()
+    assert node.draining.is_set()
+    assert not node.s3.objects
+    # Handed back straight away, for another node.
+    assert sorted([node.queue.try_claim("job", 2, "i-2", 60), node.queue.try_claim("job", 2, "i-2", 60)]) == [0, 1]
+
+def test_a_failing_node_still_uploads_and_terminates(node):
+    claim = node.queue.claim
+    claims = []
+
+    def flaky_claim(*args, **kwargs):
+        claims.append(args)
+        if len(claims) > 1:
+            raise RuntimeError("The queue went away.")
+        return claim(*args, **kwargs)
+
+    node.queue.claim = flaky_claim
+    node.uploader = None
+    node.manifest["CommandsToRun"] = ["echo done > out.dat"]
+    node.s3.put_object(Bucket=BUCKET, Key=agent.CURRENT_MANIFEST_KEY, Body=json.dumps(node.manifest).encode("utf-8"))
+    with pytest.raises(RuntimeError):
+        node.run()
+    assert "jobs/job/results/out.dat.0.i-1" in node.s3.objects
+    assert "jobs/job/terminate/i-1" in node.s3.objects
+    assert node.ec2.calls["TerminateInstances"] == 1
+    metrics = b"".join(gzip.decompress(body) for key, body in node.s3.objects.items() if key.startswith("jobs/job/metrics/"))
+    phases = [json.loads(line).get("phase") for line in metrics.decode("utf-8").splitlines()]
+    assert "FlushingUploads" in phases and "Node" in phases
@@ -0,0 +1,24 @@
+import json
+import wiglaf.bake
+from fakes import FakeEC2, FakeS3
+
+BUCKET = "wiglaf-data"
+SETTINGS = {"ImageId":"ami-base", "InstanceType":"c5.large", "KeyName":None, "IamInstanceProfile":None, "SubnetId":"subnet-1"}
+
+def bake(s3, manifest):
+    digest = wiglaf.bake.install_hash(manifest, "ami-base")
+
+    def boot(instance):
+        # Stands in for the builder's agent, reporting that the install worked.
+        s3.put_object(Bucket=BUCKET, Key="images/{}/status.json".format(digest), Body=json.dumps({"ok":True}).encode("utf-8"))
+
+    return wiglaf.bake.bake(BUCKET, manifest, "ami-base", SETTINGS, s3=s3, ec2=FakeEC2(boot=boot), poll_seconds=0)
+
+def test_baked_images_are_found_by_id_with_one_request():
+    s3 = FakeS3()
+    records = [bake(s3, {"JobName":"job", "InstallCommands":[command]}) for command in ["true", "make", "make install"]]
+    calls = dict(s3.calls)
+    assert wiglaf.bake.find_image_by_id(BUCKET, records[1]["ImageId"], s3=s3) == records[1]
+    assert wiglaf.bake.find_image_by_id(BUCKET, "ami-base", s3=s3) is None
+    assert {k:v - calls.get(k, 0) for k, v in s3.calls.items() if v != calls.get(k, 0)} == {"GetObject":1}
+    assert wiglaf.bake.find_image(BUCKET, records[2]["InstallHash"], s3=s3) == records[2]
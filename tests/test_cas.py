@@ -0,0 +1,77 @@
+import json
+import pytest
+import time
+import wiglaf.cas
+from fakes import FakeS3
+
+BUCKET = "wiglaf-data"
+DAY = 24 * 60 * 60
+
+class Clock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock():
+    return Clock(time.time())
+
+@pytest.fixture
+def s3(clock):
+    return FakeS3(clock=clock.time)
+
+def store(s3, tmp_path, content):
+    path = tmp_path / content
+    path.write_text(content)
+    return wiglaf.cas.put_file(str(path), BUCKET, s3=s3)
+
+def submit(s3, job_name, digests):
+    manifest = {"JobName":job_name, "Resources":{"file{}".format(i):digest for i, digest in enumerate(digests)}}
+    s3.put_object(Bucket=BUCKET, Key="jobs/{}/resources/wiglaf_manifest.json".format(job_name), Body=json.dumps(manifest).encode("utf-8"))
+
+def test_unreferenced_objects_are_collected_after_the_grace_period(s3, clock, tmp_path):
+    clock.now -= 2 * DAY
+    kept, erased = store(s3, tmp_path, "kept"), store(s3, tmp_path, "erased")
+    clock.now += 2 * DAY
+    recent = store(s3, tmp_path, "recent")
+    submit(s3, "job", [kept])
+    stats = wiglaf.cas.collect_garbage(BUCKET, s3=s3)
+    assert (stats["deleted"], stats["kept"]) == (1, 2)
+    assert set(s3.objects) >= {wiglaf.cas.key(kept), wiglaf.cas.key(recent)}
+    assert wiglaf.cas.key(erased) not in s3.objects
+
+def test_a_dry_run_deletes_nothing(s3, clock, tmp_path):
+    clock.now -= 2 * DAY
+    digest = store(s3, tmp_path, "erased")
+    clock.now += 2 * DAY
+    assert wiglaf.cas.collect_garbage(BUCKET, dry_run=True, s3=s3)["deleted"] == 1
+    assert wiglaf.cas.key(digest) in s3.objects
+
+def test_reusing_an_old_object_keeps_it_from_being_collected(s3, clock, tmp_path):
+    clock.now -= 2 * DAY
+    digest = store(s3, tmp_path, "reused")
+    clock.now += 2 * DAY
+    # Stored again by a job whose manifest isn't written yet.
+    assert store(s3, tmp_path, "reused") == digest
+    assert s3.calls.get("CopyObject") == 1
+    assert wiglaf.cas.collect_garbage(BUCKET, s3=s3)["deleted"] == 0
+    assert s3.objects[wiglaf.cas.key(digest)] == b"reused"
+
+def test_recently_stored_objects_are_reused_as_they_are(s3, tmp_path):
+    store(s3, tmp_path, "reused")
+    store(s3, tmp_path, "reused")
+    assert s3.calls.get("PutObject") == 1
+    assert not s3.calls.get("CopyObject")
+
+def test_an_object_collected_while_being_reused_is_stored_again(s3, clock, tmp_path):
+    clock.now -= 2 * DAY
+    digest = store(s3, tmp_path, "reused")
+    clock.now += 2 * DAY
+    head = s3.head_object(Bucket=BUCKET, Key=wiglaf.cas.key(digest))
+    del s3.objects[wiglaf.cas.key(digest)]
+    assert not wiglaf.cas.refresh(BUCKET, digest, head, s3=s3)
+    store(s3, tmp_path, "reused")
+    assert s3.objects[wiglaf.cas.key(digest)] == b"reused"
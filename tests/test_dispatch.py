@@ -0,0 +1,59 @@
+import json
+import pytest
+import boto3
+import wiglaf.bake
+import wiglaf.cloudformation
+import wiglaf.dispatch
+import wiglaf.s3
+from fakes import FakeAWS
+
+CLUSTER = "wiglaf-test"
+BUCKET = "wiglaf-data"
+
+@pytest.fixture
+def aws(monkeypatch, tmp_path):
+    aws = FakeAWS()
+    aws.cloudformation.add_stack(CLUSTER, {"ImageId":"ami-base", "InstanceType":"c5.large", "MaxInstanceCount":"4"},
+                                 {"DataBucket":BUCKET, "LambdaBucket":"wiglaf-lambda", "StateTable":"wiglaf-state", "AutoScalingGroup":aws.autoscaling.asg_name})
+    # The CLI's clients are whatever boto3.client returns, and the session is never set up for real.
+    monkeypatch.setattr(boto3, "client", lambda service, *args, **kwargs: aws.client(service, "cli"))
+    monkeypatch.setattr(boto3, "setup_default_session", lambda *args, **kwargs: None)
+    monkeypatch.setattr(wiglaf.s3, "_clients", {})
+    monkeypatch.setattr(wiglaf.cloudformation, "STACK_CACHE_DIRECTORY", str(tmp_path / "stacks"))
+    # An image has been baked for every install section.
+    monkeypatch.setattr(wiglaf.bake, "find_image", lambda bucket, digest, s3=None: {"ImageId":"ami-baked", "InstallHash":digest, "BaseImageId":"ami-base"})
+    return aws
+
+@pytest.fixture
+def wig(tmp_path):
+    (tmp_path / "input.txt").write_text("input")
+    manifest = {"JobName":"job", "NumberOfBatches":2, "LocalDirectory":str(tmp_path), "FilesToDownload":["input.txt"],
+                "InstallCommands":["make"], "CommandsToRun":["true"], "FilesToUpload":["out.txt"]}
+    (tmp_path / "manifest.json").write_text(json.dumps(manifest))
+    return wiglaf.dispatch.Wiglaf(profile="test", region="us-east-1", cluster_name=CLUSTER, manifest=str(tmp_path / "manifest.json"))
+
+def image(aws):
+    return aws.cloudformation.describe_stacks(StackName=CLUSTER)["Stacks"][0]["Parameters"]
+
+def started_manifest(aws):
+    return json.loads(aws.s3.objects["manifest.json"].decode("utf-8"))
+
+def test_an_idle_cluster_switches_to_the_baked_image(aws, wig):
+    wig.start_job()
+    assert {p["ParameterKey"]:p["ParameterValue"] for p in image(aws)}["ImageId"] == "ami-baked"
+    assert started_manifest(aws)["InstallHash"]
+
+def test_a_busy_cluster_keeps_its_image(aws, wig, capsys):
+    aws.autoscaling.instances = ["i-1"]
+    wig.start_job()
+    assert {p["ParameterKey"]:p["ParameterValue"] for p in image(aws)}["ImageId"] == "ami-base"
+    assert "UpdateStack" not in aws.cloudformation.calls
+    assert "--switch-image" in capsys.readouterr().out
+    # The job still starts, and its nodes install it themselves.
+    assert started_manifest(aws)["InstallHash"]
+
+def test_switch_image_switches_a_busy_cluster(aws, wig):
+    aws.autoscaling.instances = ["i-1"]
+    wig.config["switch_image"] = True
+    wig.start_job()
+    assert {p["ParameterKey"]:p["ParameterValue"] for p in image(aws)}["ImageId"] == "ami-baked"
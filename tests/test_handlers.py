@@ -0,0 +1,79 @@
+import json
+import pytest
+import handlers
+import tracker
+import work_queue
+from fakes import FakeAutoScaling, FakeDynamoDB, FakeS3, FakeSNS
+
+BUCKET = "wiglaf-data"
+
+@pytest.fixture
+def aws(monkeypatch):
+    monkeypatch.setenv("STACK_NAME", "wiglaf-test")
+    monkeypatch.setenv("STATE_TABLE", "wiglaf-state")
+    monkeypatch.setenv("SNS_TOPIC", "arn:aws:sns:us-east-1:123456789012:wiglaf")
+    clients = {"s3":FakeS3(), "autoscaling":FakeAutoScaling(), "dynamodb":FakeDynamoDB(), "sns":FakeSNS()}
+    monkeypatch.setattr(handlers, "_clients", clients)
+    for name, value in [("_tracker", None), ("_asg_name", None), ("_finished_jobs", {}), ("_manifests", {}), ("_sized_jobs", {})]:
+        monkeypatch.setattr(handlers, name, value)
+    manifest = {"JobName":"job", "NumberOfBatches":2, "FilesToUpload":["out.csv"], "AdaptiveSizing":False}
+    clients["s3"].put_object(Bucket=BUCKET, Key="jobs/job/resources/wiglaf_manifest.json", Body=json.dumps(manifest).encode("utf-8"))
+    handlers.completion_tracker().set_target("job", 2)
+    for batch in range(2):
+        clients["s3"].put_object(Bucket=BUCKET, Key="jobs/job/results/out.csv.{}.i-0000000{}".format(batch, batch), Body=b"result")
+    return clients
+
+def results(*batches):
+    return ["jobs/job/results/out.csv.{}.i-0000000{}".format(batch, batch) for batch in batches]
+
+def test_the_job_finishes_once(aws):
+    handlers.process_results(BUCKET, "job", results(0))
+    assert not aws["sns"].messages
+    handlers.process_results(BUCKET, "job", results(1))
+    handlers._finished_jobs.clear()
+    handlers.process_results(BUCKET, "job", results(1))
+    assert len(aws["sns"].messages) == 1
+    assert json.loads(aws["s3"].objects["jobs/job/results/wiglaf_results.json"].decode("utf-8"))["Files"] == 2
+
+def test_a_failed_finish_is_done_again_on_retry(aws, monkeypatch):
+    finish_job = handlers.finish_job
+
+    def fail(bucket_name, job_name):
+        raise RuntimeError("Timed out writing the index.")
+
+    monkeypatch.setattr(handlers, "finish_job", fail)
+    with pytest.raises(RuntimeError):
+        handlers.process_results(BUCKET, "job", results(0, 1))
+    monkeypatch.setattr(handlers, "finish_job", finish_job)
+    handlers.process_results(BUCKET, "job", results(0, 1))
+    assert len(aws["sns"].messages) == 1
+    assert "jobs/job/results/wiglaf_results.json" in aws["s3"].objects
+
+def test_results_during_someone_elses_finish_are_retried(aws):
+    handlers.process_results(BUCKET, "job", results(0))
+    assert handlers.completion_tracker().claim_completion("job", handlers.COMPLETION_LEASE_SECONDS) == tracker.CLAIMED
+    with pytest.raises(RuntimeError):
+        handlers.process_results(BUCKET, "job", results(1))
+    handlers.completion_tracker().finish_completion("job")
+    handlers.process_results(BUCKET, "job", results(1))
+    assert aws["autoscaling"].desired_capacity == 0
+    assert not aws["sns"].messages
+
+def test_direct_invocations_fail_so_that_lambda_retries_them(aws, monkeypatch):
+    monkeypatch.setattr(handlers, "process_results", lambda *args: 1 / 0)
+    event = {"Records":[{"s3":{"bucket":{"name":BUCKET}, "object":{"key":results(0)[0]}}}]}
+    with pytest.raises(RuntimeError):
+        handlers.handle_event(event)
+    queued = {"Records":[{"eventSource":"aws:sqs", "messageId":"m1", "body":json.dumps(event)}]}
+    assert handlers.handle_event(queued) == {"batchItemFailures":[{"itemIdentifier":"m1"}]}
+
+def test_work_queue_state_only_reads_the_jobs_items(aws):
+    queue = work_queue.DynamoWorkQueue("wiglaf-state", client=aws["dynamodb"])
+    assert queue.try_claim("job", 2, "i-1", 60) == 0
+    assert queue.complete("job", 0, "i-1")
+    assert queue.try_claim("job", 2, "i-2", 60) == 1
+    assert queue.try_claim("job/reduce/0", 1, "i-1", 60) == 0
+    assert queue.try_claim("other", 1, "i-3", 60) == 0
+    finished, running, durations = handlers.work_queue_state("job")
+    assert (finished, running, durations) == (1, {"i-1":1, "i-2":1}, [0])
+    assert "Scan" not in aws["dynamodb"].calls
@@ -0,0 +1,24 @@
+import wiglaf.report
+
+def phase(instance, phase, start, end):
+    kind, _, batch = phase.partition(".")
+    return {"instance":instance, "phase":phase, "kind":kind, "batch":int(batch) if batch else None, "start":start, "end":end,
+            "seconds":end - start if end is not None else None}
+
+def test_busy_counts_time_with_a_batch_running_once():
+    # Two slots side by side with uploads in the background, then nothing for the last 40 seconds.
+    timeline = [
+        phase("i-1", "DownloadingFiles", 0, 10),
+        phase("i-1", "CommandsToRun.0", 10, 40),
+        phase("i-1", "CommandsToRun.1", 20, 60),
+        phase("i-1", "UploadingResults.0", 40, 50),
+        phase("i-1", "UploadingResults.1", 60, 100),
+        phase("i-2", "CommandsToRun.2", 0, 50),
+        phase("i-2", "CommandsToRun.3", 50, None),
+    ]
+    report = wiglaf.report.analyze(timeline, batch_count=4, now=100)
+    assert report["instances"]["i-1"]["busy"] == 0.5
+    assert report["instances"]["i-1"]["seconds"]["UploadingResults"] == 50
+    # A batch still running counts up to now.
+    assert report["instances"]["i-2"]["busy"] == 1.0
+    assert (report["batches"]["finished"], report["batches"]["running"]) == (3, 1)
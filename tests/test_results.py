@@ -0,0 +1,33 @@
+import json
+import handlers
+import wiglaf.results
+from fakes import FakeS3
+
+BUCKET = "wiglaf-data"
+
+def test_the_results_index_is_sharded_and_read_back(monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(handlers, "_clients", {"s3":s3})
+    monkeypatch.setattr(handlers, "INDEX_SHARD_SIZE", 1000)
+    # More than a page of listing, and shards that don't line up with the pages.
+    for batch in range(2400):
+        s3.put_object(Bucket=BUCKET, Key="jobs/job/results/out.csv.{}.i-{:08x}".format(batch, batch % 7), Body=b"x" * (batch % 5))
+    s3.put_object(Bucket=BUCKET, Key="jobs/job/results/reduced/out.csv", Body=b"merged")
+    summary = handlers.write_results_index(BUCKET, "job")
+    assert summary["Shards"] == ["jobs/job/results-index/{:05d}.jsonl.gz".format(i) for i in range(3)]
+    assert summary["Files"] == 2401
+    assert summary["Bytes"] == sum(batch % 5 for batch in range(2400)) + len(b"merged")
+    assert summary["ReducedFiles"] == ["out.csv"]
+    s3.put_object(Bucket=BUCKET, Key="jobs/job/results/wiglaf_results.json", Body=json.dumps(summary).encode("utf-8"))
+    indexed = list(wiglaf.results.iter_results(BUCKET, "job", s3=s3))
+    listed = list(wiglaf.results.iter_listed(BUCKET, "job", s3=s3))
+    assert len(indexed) == 2401
+    assert sorted(indexed, key=lambda e: e["key"]) == sorted(listed, key=lambda e: e["key"])
+    assert [e["key"] for e in wiglaf.results.select(indexed, reduced=True)] == ["reduced/out.csv"]
+
+def test_jobs_without_an_index_are_listed():
+    s3 = FakeS3()
+    s3.put_object(Bucket=BUCKET, Key="jobs/job/results/out.csv.0.i-00000001", Body=b"result")
+    assert list(wiglaf.results.iter_results(BUCKET, "job", s3=s3)) == [
+        {"key":"out.csv.0.i-00000001", "size":6, "etag":s3.head_object(Bucket=BUCKET, Key="jobs/job/results/out.csv.0.i-00000001")["ETag"].strip('"'),
+         "batch":0, "instance":"i-00000001"}]
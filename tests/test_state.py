@@ -0,0 +1,86 @@
+import pytest
+import tracker
+import wiglaf.state
+import work_queue
+from fakes import FakeDynamoDB
+
+TABLE = "wiglaf-state"
+
+class ThrottlingDynamoDB(object):
+    """
+    Leaves all but the first of a batch write's items unprocessed, throttled times.
+    """
+
+    def __init__(self, throttled):
+        self.throttled = throttled
+        self.written = []
+        self.calls = 0
+
+    def batch_write_item(self, RequestItems):
+        self.calls += 1
+        (table_name, requests), = RequestItems.items()
+        if self.throttled:
+            self.throttled -= 1
+            self.written.extend(requests[:1])
+            return {"UnprocessedItems":{table_name:requests[1:]}} if requests[1:] else {}
+        self.written.extend(requests)
+        return {}
+
+def requests(count):
+    return [{"DeleteRequest":{"Key":{"Id":{"S":"jobs/job/results/{}".format(i)}}}} for i in range(count)]
+
+def test_unprocessed_items_are_retried_with_backoff():
+    dynamodb = ThrottlingDynamoDB(throttled=3)
+    sleeps = []
+    wiglaf.state._write_batch(dynamodb, "table", requests(10), sleep=sleeps.append)
+    assert len(dynamodb.written) == 10
+    assert len(sleeps) == 3
+    assert all(delay <= wiglaf.state.UNPROCESSED_BACKOFF_SECONDS * 2 ** attempt for attempt, delay in enumerate(sleeps))
+
+def test_unprocessed_items_are_given_up_on():
+    dynamodb = ThrottlingDynamoDB(throttled=100)
+    sleeps = []
+    with pytest.raises(RuntimeError):
+        wiglaf.state._write_batch(dynamodb, "table", requests(25), sleep=sleeps.append)
+    assert dynamodb.calls == wiglaf.state.UNPROCESSED_RETRIES + 1
+    assert len(sleeps) == wiglaf.state.UNPROCESSED_RETRIES
+
+def run_job(queue, completions, job_name, batch_count):
+    # What the nodes and the Lambda do: claim and complete each batch, and count its result.
+    completions.set_target(job_name, batch_count)
+    ran = []
+    while True:
+        batch = queue.claim(job_name, batch_count, "i-1", 60)
+        if batch is None:
+            break
+        ran.append(batch)
+        queue.complete(job_name, batch, "i-1")
+        completed, target = completions.record(job_name, "out.{}.i-1".format(batch))
+        if completed >= target:
+            assert completions.claim_completion(job_name, 60) == tracker.CLAIMED
+            completions.finish_completion(job_name)
+    return sorted(ran)
+
+def clear_local(queue, completions, job_name):
+    queue.clear(job_name)
+    completions.clear(job_name)
+
+def clear_dynamo(queue, completions, job_name):
+    wiglaf.state.clear_job(TABLE, job_name, dynamodb=queue.dynamodb)
+
+@pytest.fixture(params=["dynamo", "local"])
+def job_state(request):
+    if request.param == "dynamo":
+        dynamodb = FakeDynamoDB()
+        return work_queue.DynamoWorkQueue(TABLE, client=dynamodb), tracker.DynamoCompletionTracker(TABLE, client=dynamodb), clear_dynamo
+    return work_queue.LocalWorkQueue(), tracker.LocalCompletionTracker(), clear_local
+
+def test_a_job_of_the_same_name_runs_again_once_cleared(job_state):
+    queue, completions, clear = job_state
+    assert run_job(queue, completions, "job", 3) == [0, 1, 2]
+    assert run_job(queue, completions, "other", 2) == [0, 1]
+    # Without clearing, there's nothing left to do.
+    assert run_job(queue, completions, "job", 3) == []
+    clear(queue, completions, "job")
+    assert run_job(queue, completions, "job", 3) == [0, 1, 2]
+    assert completions.claim_completion("other", 60) == tracker.FINISHED
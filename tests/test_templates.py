@@ -0,0 +1,93 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import zipfile
+from fakes import FakeCloudFormation, VirtualClock
+from wiglaf.cloudformation import lambda_zipfile
+from wiglaf.cloudformation.templates import cluster_template
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def test_failing_events_go_to_a_dead_letter_queue():
+    resources = cluster_template()["Resources"]
+    redrive = resources["EventQueue"]["Properties"]["RedrivePolicy"]
+    assert redrive["deadLetterTargetArn"] == {"Fn::GetAtt":["EventDeadLetterQueue","Arn"]}
+    assert redrive["maxReceiveCount"] > 1
+    assert resources["EventDeadLetterQueue"]["Condition"] == resources["EventQueue"]["Condition"]
+
+def references(value):
+    if isinstance(value, dict):
+        found = set()
+        if "Ref" in value:
+            found.add(value["Ref"])
+        if "Fn::GetAtt" in value:
+            found.add(value["Fn::GetAtt"][0])
+        for item in value.values():
+            found |= references(item)
+        return found
+    if isinstance(value, list):
+        return set().union(*[references(item) for item in value]) if value else set()
+    return set()
+
+def assert_resolves(template):
+    names = set(template["Parameters"]) | set(template["Resources"])
+    unresolved = set(name for name in references(template["Resources"]) | references(template["Outputs"])
+                     if not name.startswith("AWS::")) - names
+    assert not unresolved
+
+def test_the_fleet_template():
+    template = cluster_template(["c5.large", "m5.large", "c5a.large"], 3)
+    resources = template["Resources"]
+    assert_resolves(template)
+    assert "LaunchConfiguration" not in resources and "Subnet" not in resources
+    assert "SubnetRouteTableAssociation" not in resources
+    group = resources["AutoScalingGroup"]["Properties"]
+    assert "LaunchConfigurationName" not in group
+    policy = group["MixedInstancesPolicy"]
+    assert policy["LaunchTemplate"]["Overrides"] == [{"InstanceType":"c5.large"}, {"InstanceType":"m5.large"}, {"InstanceType":"c5a.large"}]
+    assert policy["LaunchTemplate"]["LaunchTemplateSpecification"]["LaunchTemplateId"] == {"Ref":"LaunchTemplate"}
+    assert policy["InstancesDistribution"] == {
+        "OnDemandBaseCapacity":{"Ref":"OnDemandBaseCapacity"},
+        "OnDemandPercentageAboveBaseCapacity":{"Ref":"OnDemandPercentage"},
+        "SpotAllocationStrategy":{"Ref":"SpotAllocationStrategy"}
+    }
+    assert group["CapacityRebalance"] is True
+    assert group["VPCZoneIdentifier"] == [{"Ref":"FleetSubnet{}".format(i)} for i in range(3)]
+    zones = [resources["FleetSubnet{}".format(i)]["Properties"]["AvailabilityZone"]["Fn::Select"][0] for i in range(3)]
+    assert zones == ["0", "1", "2"]
+    blocks = [resources["FleetSubnet{}".format(i)]["Properties"]["CidrBlock"] for i in range(3)]
+    assert len(set(blocks)) == 3
+    assert all("FleetSubnet{}RouteTableAssociation".format(i) in resources for i in range(3))
+    for name in ["OnDemandBaseCapacity", "OnDemandPercentage", "SpotAllocationStrategy"]:
+        assert name in template["Parameters"]
+
+def test_the_default_template_is_unchanged_by_fleets():
+    cluster_template(["c5.large"], 2)
+    template = cluster_template()
+    assert_resolves(template)
+    assert "LaunchConfiguration" in template["Resources"] and "MixedInstancesPolicy" not in template["Resources"]["AutoScalingGroup"]["Properties"]
+    assert "SpotAllocationStrategy" not in template["Parameters"]
+
+def test_cluster_cf_json_is_up_to_date():
+    with open(os.path.join(ROOT, "cluster.cf.json")) as f:
+        assert json.load(f) == cluster_template()
+
+def test_the_fleet_stack_can_be_created():
+    clock = VirtualClock()
+    cf = FakeCloudFormation(clock=clock)
+    template = cluster_template(["c5.large", "m5.large"], 2)
+    cf.create_stack(StackName="fleet", TemplateBody=json.dumps(template),
+                    Parameters=[{"ParameterKey":"SpotAllocationStrategy", "ParameterValue":"capacity-optimized"}, {"ParameterKey":"EventBatchSize", "ParameterValue":"10"}])
+    clock.sleep(3600)
+    stack = cf.describe_stacks(StackName="fleet")["Stacks"][0]
+    assert stack["StackStatus"] == "CREATE_COMPLETE"
+    assert set(output["OutputKey"] for output in stack["Outputs"]) >= {"AutoScalingGroup", "EventDeadLetterQueue"}
+
+def test_the_lambda_zip_brings_the_wiglaf_modules_it_imports(tmp_path):
+    with zipfile.ZipFile(io.BytesIO(lambda_zipfile(os.path.join(ROOT, "lambda")))) as zipf:
+        zipf.extractall(str(tmp_path))
+    # On its own, as Lambda runs it: nothing from src/ on the path.
+    check = "import sys; sys.path.insert(0, {!r}); import handlers, wiglaf.node.reducer, wiglaf.profiling, wiglaf.result_keys; assert wiglaf.profiling.__file__.startswith({!r})"
+    subprocess.run([sys.executable, "-c", check.format(str(tmp_path), str(tmp_path))], cwd=str(tmp_path), env={"PATH":os.environ.get("PATH", "")}, check=True)
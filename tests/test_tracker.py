@@ -0,0 +1,101 @@
+import pytest
+import tracker
+from botocore.exceptions import ClientError
+from fakes import FakeDynamoDB, FakeExceptions
+
+TABLE = "wiglaf-state"
+
+class FlakyDynamoDB(FakeDynamoDB):
+    """
+    Fails the next failures transactions with error before (or, with conflict, instead of) doing anything.
+    """
+
+    def __init__(self, failures=0, conflict=False):
+        super(FlakyDynamoDB, self).__init__()
+        self.failures = failures
+        self.conflict = conflict
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            if self.conflict:
+                raise FakeExceptions.TransactionCanceledException("TransactWriteItems", [{"Code":"TransactionConflict"}] * len(TransactItems))
+            raise ClientError({"Error":{"Code":"InternalServerError", "Message":"Timed out"}}, "TransactWriteItems")
+        return super(FlakyDynamoDB, self).transact_write_items(TransactItems, **kwargs)
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1700000000
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(tracker.time, "time", clock.time)
+    monkeypatch.setattr(tracker.time, "sleep", lambda seconds: None)
+    return clock
+
+@pytest.fixture(params=["dynamo", "local"])
+def completions(request, clock):
+    if request.param == "dynamo":
+        return tracker.DynamoCompletionTracker(TABLE, client=FakeDynamoDB())
+    return tracker.LocalCompletionTracker(clock=clock.time)
+
+def test_duplicates_are_counted_once(completions):
+    completions.set_target("job", 3)
+    assert completions.record("job", "out.0") == (1, 3)
+    assert completions.record("job", "out.0") == (1, 3)
+    assert completions.record_many("job", ["out.0", "out.1", "out.1"]) == (2, 3)
+    assert completions.record_many("job", ["out.1", "out.2"]) == (3, 3)
+
+def test_jobs_are_counted_separately(completions):
+    completions.record_many("one", ["out.0", "out.1"])
+    assert completions.record("two", "out.0") == (1, None)
+
+def test_many_keys_are_recorded_in_chunks():
+    dynamodb = FakeDynamoDB()
+    completions = tracker.DynamoCompletionTracker(TABLE, client=dynamodb)
+    keys = ["out.{}".format(i) for i in range(250)]
+    assert completions.record_many("job", keys[:10]) == (10, None)
+    # 240 new keys and 10 seen ones, more than one transaction takes.
+    assert completions.record_many("job", keys) == (250, None)
+    assert len([item_id for item_id in dynamodb.items if "/results/" in item_id]) == 250
+
+def test_a_failed_transaction_leaves_nothing_behind(clock):
+    dynamodb = FlakyDynamoDB(failures=1)
+    completions = tracker.DynamoCompletionTracker(TABLE, client=dynamodb)
+    with pytest.raises(ClientError):
+        completions.record_many("job", ["out.0", "out.1"])
+    assert not [item_id for item_id in dynamodb.items if "/results/" in item_id]
+    # So the retry counts them, rather than taking them for duplicates.
+    assert completions.record_many("job", ["out.0", "out.1"]) == (2, None)
+
+def test_conflicting_transactions_are_retried(clock):
+    completions = tracker.DynamoCompletionTracker(TABLE, client=FlakyDynamoDB(failures=2, conflict=True))
+    assert completions.record_many("job", ["out.0", "out.1"]) == (2, None)
+
+def test_conflicts_that_keep_happening_are_raised(clock):
+    completions = tracker.DynamoCompletionTracker(TABLE, client=FlakyDynamoDB(failures=tracker.CONFLICT_RETRIES + 1, conflict=True))
+    with pytest.raises(FakeExceptions.TransactionCanceledException):
+        completions.record("job", "out.0")
+
+def test_completion_is_claimed_once(completions):
+    assert completions.claim_completion("job", 60) == tracker.CLAIMED
+    assert completions.claim_completion("job", 60) == tracker.IN_PROGRESS
+    completions.finish_completion("job")
+    assert completions.claim_completion("job", 60) == tracker.FINISHED
+
+def test_an_expired_claim_can_be_taken_over(completions, clock):
+    assert completions.claim_completion("job", 60) == tracker.CLAIMED
+    clock.now += 30
+    assert completions.claim_completion("job", 60) == tracker.IN_PROGRESS
+    clock.now += 31
+    assert completions.claim_completion("job", 60) == tracker.CLAIMED
+
+def test_a_released_claim_can_be_taken_straight_away(completions):
+    assert completions.claim_completion("job", 60) == tracker.CLAIMED
+    completions.release_completion("job")
+    assert completions.claim_completion("job", 60) == tracker.CLAIMED
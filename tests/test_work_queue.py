@@ -0,0 +1,102 @@
+import pytest
+import work_queue
+from fakes import FakeDynamoDB
+
+TABLE = "wiglaf-state"
+
+class Clock(object):
+    """
+    Stands in for the time module.
+    """
+
+    def __init__(self):
+        self.now = 1700000000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(work_queue, "time", clock)
+    return clock
+
+@pytest.fixture
+def dynamodb():
+    return FakeDynamoDB()
+
+@pytest.fixture(params=["dynamo", "local"])
+def queue(request, clock, dynamodb):
+    if request.param == "dynamo":
+        return work_queue.DynamoWorkQueue(TABLE, client=dynamodb)
+    return work_queue.LocalWorkQueue(clock=clock.time)
+
+def test_each_batch_is_handed_out_once(queue):
+    claimed = [queue.try_claim("job", 3, "i-1", 60) for _ in range(3)]
+    assert sorted(claimed) == [0, 1, 2]
+    assert queue.try_claim("job", 3, "i-2", 60) is None
+
+def test_an_expired_lease_is_taken_over(queue, clock):
+    batch = queue.try_claim("job", 1, "i-1", 60)
+    clock.now += 30
+    assert queue.try_claim("job", 1, "i-2", 60) is None
+    assert queue.renew("job", batch, "i-1", 60)
+    clock.now += 61
+    assert queue.try_claim("job", 1, "i-2", 60) == batch
+    # The first owner has lost it.
+    assert not queue.renew("job", batch, "i-1", 60)
+    assert queue.renew("job", batch, "i-2", 60)
+
+def test_a_released_batch_is_taken_straight_away(queue):
+    batch = queue.try_claim("job", 1, "i-1", 60)
+    assert queue.release("job", batch, "i-1")
+    assert queue.try_claim("job", 1, "i-2", 60) == batch
+
+def test_finished_batches_are_not_run_again(queue, clock):
+    first, second = queue.try_claim("job", 2, "i-1", 60), queue.try_claim("job", 2, "i-1", 60)
+    assert queue.complete("job", first, "i-1")
+    assert not queue.complete("job", first, "i-2")
+    clock.now += 61
+    assert queue.try_claim("job", 2, "i-2", 60) == second
+    assert queue.complete("job", second, "i-2")
+    assert queue.claim("job", 2, "i-3", 60) is None
+
+def test_claim_waits_for_leases_to_run_out(queue, clock):
+    batch = queue.try_claim("job", 1, "i-1", 100)
+    assert queue.claim("job", 1, "i-2", 100) == batch
+    assert 100 < sum(clock.sleeps) < 100 + 1.5 * work_queue.MAX_POLL_SECONDS
+
+def test_claim_backs_off_while_there_is_nothing_to_take(dynamodb, clock):
+    queue = work_queue.DynamoWorkQueue(TABLE, client=dynamodb)
+    queue.try_claim("job", 1, "i-1", 3600)
+    queue.complete("job", 0, "i-1")
+    # Handed out by the counter but never leased (the claimer died), so there's no expiry to wait for.
+    dynamodb.update_item(TableName=TABLE, Key={"Id":{"S":"jobs/job"}}, UpdateExpression="ADD NextBatch :one", ExpressionAttributeValues={":one":{"N":"1"}})
+    original = queue._lease
+    leases = []
+
+    def lease(*args, **kwargs):
+        # Someone else keeps winning the race for it, until the tenth look.
+        leases.append(args)
+        return len(leases) >= 10 and original(*args, **kwargs)
+
+    queue._lease = lease
+    assert queue.claim("job", 2, "i-2", 60) == 1
+    assert len(clock.sleeps) == 9
+    assert clock.sleeps[-1] >= 0.5 * work_queue.MAX_POLL_SECONDS
+    assert sum(clock.sleeps) > 60
+
+def test_unfinished_batches_are_queried_by_job(dynamodb):
+    queue = work_queue.DynamoWorkQueue(TABLE, client=dynamodb)
+    for job_name in ["other", "job", "job/reduce/0"]:
+        queue.try_claim(job_name, 2, "i-1", 60)
+    # The completion tracker's result markers aren't in the index.
+    dynamodb.put_item(TableName=TABLE, Item={"Id":{"S":"jobs/job/results/out.0"}})
+    assert sorted(queue._unfinished("job", 3)) == [0, 1, 2]
+    assert sorted(queue._unfinished("job/reduce/0", 2)) == [0, 1]
+    assert "Scan" not in dynamodb.calls